@@ -1,22 +1,99 @@
-import nibabel as nib
-import nrrd
 import os
+import time
 import numpy as np
 from nipype.interfaces.base import (
     BaseInterface, TraitedSpec,
     BaseInterfaceInputSpec, traits,
-    Directory)
+    Directory, File, InputMultiPath, OutputMultiPath)
+from nipype.interfaces.base import isdefined
 from core.utils.filemanip import split_filename
 from skimage.transform import resize
 from skimage.filters.thresholding import threshold_otsu
 from radiants.utils.networks import unet_lung
+from radiants.utils.model_cache import MODEL_CACHE
+from radiants.utils.quantization import sample_patches
+from radiants.utils.autotune import load_profile
+from radiants.utils.dataloader import (
+    reconstruct_volume_2D, TensorStack, nearest_indices)
+from radiants.utils.image_io import read_header, write_image, SlabWriter
 
 
 class LungSegmentationInferenceInputSpec(BaseInterfaceInputSpec):
     
-    tensor = traits.Array(desc='Tensor to be fed to the network.')
+    tensor = traits.Array(desc='Tensor to be fed to the network.',
+                          xor=['tensor_file'])
+    tensor_file = traits.File(exists=True, xor=['tensor'], desc=(
+        'Tensor to be fed to the network, saved as .npy file. It will be '
+        'memory-mapped instead of loaded.'))
     image_info = traits.Dict(desc='Dictionary with information about the image.')
     weights = traits.List(desc='List of network weights.')
+    cache_size = traits.Int(2048, usedefault=True, desc=(
+        'Maximum memory (in MB) used to keep the network weights in memory, '
+        'shared by all the lung inference nodes running in the same process.'
+        ' Set it to 0 to re-read the weights at every run.'))
+    ensemble_chunk = traits.Int(0, usedefault=True, desc=(
+        'Number of patches predicted by all the folds before moving to the '
+        'next ones. With 0 (default) each fold predicts the whole tensor. '
+        'Smaller chunks bound the memory needed by memory-mapped tensors, '
+        'but the fold weights are switched once per chunk. In streaming '
+        'mode each fold predicts the whole tensor anyway, in chunks of '
+        'this size (with 0, slab_size slices).'))
+    batch_size = traits.Int(32, desc=(
+        'Number of patches fed to the network at once. If not given, the one '
+        'tuned for this host (see use_profile) is used, otherwise 32.'))
+    blending = traits.Enum('mean', 'gaussian', usedefault=True, desc=(
+        'How to blend the overlapping patches. "mean" (default) averages '
+        'them, "gaussian" gives more weight to the centre of each patch.'))
+    adaptive_tolerance = traits.Float(0.0, usedefault=True, desc=(
+        'If greater than 0, a patch is not fed to the remaining folds once '
+        'the mean absolute difference between the last fold prediction and '
+        'the running mean of the previous ones is below this value. With 0 '
+        '(default) all the folds predict all the patches.'))
+    min_folds = traits.Int(2, usedefault=True, desc=(
+        'Minimum number of folds predicting each patch when '
+        'adaptive_tolerance is used.'))
+    compression_level = traits.Range(0, 9, 6, usedefault=True, desc=(
+        'Gzip level used to save the masks, 0 means no compression.'))
+    save_probabilities = traits.Bool(False, usedefault=True, desc=(
+        'Whether or not to save also the ensemble probability map, '
+        'quantized to 8 bits (for NIfTI the scaling is stored in the header, '
+        'for NRRD the values go from 0 to 255).'))
+    streaming = traits.Bool(False, usedefault=True, desc=(
+        'Whether or not to predict, reconstruct and save slab_size slices '
+        'at a time, instead of keeping the prediction of the whole tensor '
+        'in memory. The Otsu threshold is computed on a 256-bin histogram '
+        'of the probabilities, so it can differ slightly from the one '
+        'computed on the whole image.'))
+    slab_size = traits.Int(32, usedefault=True, desc=(
+        'Number of slices of the original image segmented at once in '
+        'streaming mode.'))
+    engine = traits.Enum('keras', 'frozen_graph', 'int8', usedefault=True, desc=(
+        'Which runner to use for the network. "keras" (default) uses the '
+        'Keras models, "frozen_graph" exports each fold, with the batch '
+        'normalizations folded, to a frozen TensorFlow graph (once, see '
+        'frozen_dir) and runs it in a plain TensorFlow session. "int8" '
+        'quantizes the frozen graphs with TensorFlow Lite, calibrating them '
+        'on patches of the tensor (once), and uses them only if they agree '
+        'with the float ones (see quantization_threshold) and are faster.'))
+    frozen_dir = Directory(exists=True, desc=(
+        'Folder where to save the frozen graphs and the int8 models. By '
+        'default they are saved next to the weights.'))
+    quantization_threshold = traits.Float(0.98, usedefault=True, desc=(
+        'Minimum Dice coefficient between the int8 and float predictions of '
+        'the held-out patches for the int8 model of a fold to be used.'))
+    calibration_patches = traits.Int(256, usedefault=True, desc=(
+        'Number of patches used to calibrate (3/4) and validate (1/4) the '
+        'int8 models.'))
+    use_profile = traits.Bool(True, usedefault=True, desc=(
+        'Whether or not to use the batch size and the TensorFlow threads '
+        'tuned for this host (see tune_lung_inference.py), if available. '
+        'The tuned batch size is only used if batch_size is not given.'))
+    profile_dir = Directory(exists=True, desc=(
+        'Folder with the tuning profiles. By default $RADIANTS_PROFILE_DIR '
+        'or ~/.radiants.'))
+    parallel_workers = traits.Int(1, usedefault=True, desc=(
+        'Number of inference nodes running at the same time on this host, '
+        'used to choose the tuning profile.'))
     outdir = Directory('segmented', usedefault=True,
                        desc='Folder to store the preprocessing results.')
 
@@ -24,6 +101,16 @@ class LungSegmentationInferenceInputSpec(BaseInterfaceInputSpec):
 class LungSegmentationInferenceOutputSpec(TraitedSpec):
     
     segmented_lungs = traits.File(exists=True, desc='Segmented lungs')
+    probability_map = traits.File(desc=(
+        'Ensemble probability map, if save_probabilities is True.'))
+    skip_ratio = traits.Float(desc='Fraction of patches skipped as background.')
+    time_saved = traits.Float(desc=(
+        'Estimated inference time (in seconds) saved by skipping the '
+        'background patches.'))
+    fold_counts = traits.Dict(desc=(
+        'Average number of folds used to predict the patches of each image.'))
+    inference_time = traits.Float(desc=(
+        'Time (in seconds) spent to segment and save the image(s).'))
 
 
 class LungSegmentationInference(BaseInterface):
@@ -33,77 +120,403 @@ class LungSegmentationInference(BaseInterface):
     
     def _run_interface(self, runtime):
         "Function to run the CNN inference"
+        start = time.time()
         self.image_info = self.inputs.image_info
         outdir = os.path.abspath(self.inputs.outdir)
         if not os.path.isdir(outdir):
             os.makedirs(outdir)
-        test_set = np.asarray(self.inputs.tensor)
-        predictions = []
-        model = unet_lung()
-        for i, weight in enumerate(self.inputs.weights):
-            print('Segmentation inference fold {}.'.format(i+1))
-            model.load_weights(weight)
-            predictions.append(model.predict(test_set))
-
-        predictions = np.asarray(predictions, dtype=np.float16)
-        self.prediction = np.mean(predictions, axis=0)
-        self.segmentation = self.save_inference(outdir)
+        if isdefined(self.inputs.tensor_file):
+            test_set = np.load(self.inputs.tensor_file, mmap_mode='r')
+        else:
+            test_set = np.asarray(self.inputs.tensor)
+        MODEL_CACHE.max_memory = self.inputs.cache_size
+        self.apply_profile()
+        if self.inputs.streaming:
+            self.segmentation = self.streaming_inference(test_set, outdir)
+        else:
+            self.prediction = self.ensemble_prediction(
+                test_set, chunk_size=self.inputs.ensemble_chunk,
+                foreground=self.foreground_patches(),
+                tolerance=self.inputs.adaptive_tolerance,
+                min_folds=self.inputs.min_folds)
+        if self.skip_ratio:
+            print('{0:.1f}% of the patches skipped as background, estimated '
+                  'time saved: {1:.1f} s.'.format(self.skip_ratio*100,
+                                                 self.time_saved))
+        if not self.inputs.streaming:
+            self.segmentation = self.save_inference(outdir)
+        self.report_time(test_set.shape[0], start)
 
         return runtime
 
-    def save_inference(self, outdir, binarize=True):
-        "Function to save the segmented masks"
+    def report_time(self, n_patches, start):
+        "Function to print and store the end-to-end inference time"
+        self.inference_time = time.time() - start
+        print('Lung segmentation of {0} image(s), {1} patches, done in {2:.1f} '
+              's ({3:.1f} patches/s).'.format(
+                  len(self.image_info), n_patches, self.inference_time,
+                  n_patches/max(self.inference_time, 1e-6)))
+
+    def apply_profile(self):
+        "Function to use the batch size and threads tuned for this host, if any"
+        given = isdefined(self.inputs.batch_size)
+        self.batch_size = (self.inputs.batch_size if given
+                           else self.inputs.trait('batch_size').default)
+        if not self.inputs.use_profile:
+            return
+        profile_dir = (self.inputs.profile_dir if isdefined(self.inputs.profile_dir)
+                       else None)
+        best = load_profile(
+            self.inputs.engine,
+            self.network_kwargs().get('input_size', (96, 96, 1))[:2],
+            self.inputs.parallel_workers, profile_dir)
+        if best is None:
+            return
+        if not given:
+            self.batch_size = best['batch_size']
+        MODEL_CACHE.configure_threads(best['intra_op_threads'],
+                                      best['inter_op_threads'])
+        print('Tuned inference profile: {0} intra-op and {1} inter-op threads, '
+              'batch size {2} ({3:.1f} patches/s when tuned with batch size '
+              '{4}).'.format(best['intra_op_threads'], best['inter_op_threads'],
+                             self.batch_size, best['patches_per_second'],
+                             best['batch_size']))
+
+    def ensemble_prediction(self, test_set, chunk_size=0, foreground=None,
+                            fold_major=False, prediction=None, tolerance=0,
+                            min_folds=2):
+        """Function to average the fold predictions into one float32 buffer.
+        If foreground is provided, only the patches flagged as True are fed
+        to the network and the others are predicted as background (0).
+        The patches are read in chunks of chunk_size; with fold_major each
+        fold predicts all the chunks before moving to the next fold,
+        otherwise all the folds predict one chunk before moving to the next.
+        With tolerance > 0 the adaptive ensemble is used instead (see
+        adaptive_prediction).
+        """
+        weights = self.inputs.weights
+        n_patches = test_set.shape[0]
+        if foreground is None or np.all(foreground):
+            to_predict = None
+            n_predicted = n_patches
+        else:
+            to_predict = np.nonzero(foreground)[0]
+            n_predicted = to_predict.shape[0]
+        if not chunk_size:
+            chunk_size = max(n_predicted, 1)
+        if prediction is None:
+            prediction = np.zeros(test_set.shape[:-1]+(1,), dtype=np.float32)
+        if tolerance > 0:
+            return self.adaptive_prediction(
+                test_set, prediction, to_predict, chunk_size, tolerance,
+                min_folds)
+        chunks = []
+        for z0 in range(0, n_predicted, chunk_size):
+            if to_predict is None:
+                chunks.append(slice(z0, z0+chunk_size))
+            else:
+                chunks.append(to_predict[z0:z0+chunk_size])
+        if fold_major:
+            jobs = [(i, n) for i in range(len(weights)) for n in range(len(chunks))]
+        else:
+            jobs = [(i, n) for n in range(len(chunks)) for i in range(len(weights))]
+
+        start = time.time()
+        current_fold = current_chunk = None
+        for i, n in jobs:
+            if i != current_fold:
+                if n == 0:
+                    print('Segmentation inference fold {}.'.format(i+1))
+                model = self.load_model(weights[i], test_set)
+                current_fold = i
+            if n != current_chunk:
+                chunk = test_set[chunks[n]]
+                current_chunk = n
+            prediction[chunks[n]] += model.predict(
+                chunk, batch_size=self.batch_size)
+        prediction /= len(weights)
+        elapsed = time.time() - start
+        self.skip_ratio = 1 - float(n_predicted)/n_patches
+        self.time_saved = (elapsed/n_predicted*(n_patches-n_predicted)
+                           if n_predicted else 0.0)
+        self.folds = np.zeros(n_patches, dtype=np.uint8)
+        self.folds[slice(None) if to_predict is None else to_predict] = len(weights)
+
+        return prediction
+
+    def adaptive_prediction(self, test_set, prediction, to_predict, chunk_size,
+                            tolerance, min_folds=2):
+        """Function to run the folds one after the other, feeding each fold
+        only with the patches whose prediction is not stable yet. After
+        min_folds folds, a patch is considered stable when the mean absolute
+        difference between the new fold prediction and the running mean of
+        the previous folds is below tolerance. Each patch is then averaged
+        over the number of folds that actually predicted it, stored in
+        self.folds.
+        """
+        weights = self.inputs.weights
+        n_patches = test_set.shape[0]
+        if to_predict is None:
+            to_predict = np.arange(n_patches)
+        n_predicted = to_predict.shape[0]
+        self.folds = np.zeros(n_patches, dtype=np.uint8)
+        active = to_predict
+        start = time.time()
+        for i, weight in enumerate(weights):
+            if not active.shape[0]:
+                break
+            print('Segmentation inference fold {0}, {1} patches.'.format(
+                i+1, active.shape[0]))
+            model = self.load_model(weight, test_set)
+            stable = []
+            for z0 in range(0, active.shape[0], chunk_size):
+                indexes = active[z0:z0+chunk_size]
+                fold_prediction = model.predict(
+                    test_set[indexes], batch_size=self.batch_size)
+                if i > 0 and i+1 >= min_folds:
+                    # all the active patches have been predicted by i folds
+                    change = np.abs(fold_prediction - prediction[indexes]/i)
+                    change = change.reshape(change.shape[0], -1).mean(axis=1)
+                    stable.append(indexes[change < tolerance])
+                prediction[indexes] += fold_prediction
+            self.folds[active] += 1
+            if stable:
+                active = np.setdiff1d(active, np.concatenate(stable),
+                                      assume_unique=True)
+        prediction /= np.maximum(self.folds, 1)[:, None, None, None]
+        elapsed = time.time() - start
+        self.skip_ratio = 1 - float(n_predicted)/n_patches
+        self.time_saved = (elapsed/n_predicted*(n_patches-n_predicted)
+                           if n_predicted else 0.0)
+        saved = 1 - self.folds.sum()/float(max(n_predicted, 1)*len(weights))
+        print('{:.1f}% of the fold predictions skipped by the adaptive '
+              'ensemble.'.format(saved*100))
+
+        return prediction
+
+    def fold_counts(self):
+        "Function to compute the average number of folds used for each image"
+        counts = {}
+        z0 = 0
+        for image in self.image_info:
+            n = self.image_info[image]['patches']*self.image_info[image]['slices']
+            folds = self.folds[z0:z0+n]
+            z0 = z0+n
+            # background patches skipped during preprocessing are not counted
+            folds = folds[folds > 0]
+            counts[image] = float(folds.mean()) if folds.size else 0.0
+
+        return counts
+
+    def load_model(self, weight_file, test_set=None):
+        """Function to return the network of one fold, for the selected engine.
+        test_set is only used to calibrate the int8 models.
+        """
+        outdir = (self.inputs.frozen_dir if isdefined(self.inputs.frozen_dir)
+                  else None)
+        if self.inputs.engine == 'frozen_graph':
+            return MODEL_CACHE.load_frozen(weight_file, architecture=unet_lung,
+                                           outdir=outdir, **self.network_kwargs())
+        elif self.inputs.engine == 'int8':
+            return MODEL_CACHE.load_quantized(
+                weight_file, lambda: sample_patches(
+                    test_set, self.inputs.calibration_patches),
+                architecture=unet_lung, outdir=outdir,
+                threshold=self.inputs.quantization_threshold,
+                **self.network_kwargs())
+
+        return MODEL_CACHE.load(weight_file, architecture=unet_lung,
+                                **self.network_kwargs())
+
+    def network_kwargs(self):
+        "Function to build the network for the patch size used to tile the images"
+        sizes = set(tuple(self.image_info[image].get('patch_size', (96, 96)))
+                    for image in self.image_info)
+        if len(sizes) > 1:
+            raise Exception('All the images must be tiled with the same patch '
+                            'size, found {}!'.format(sorted(sizes)))
+        size = sizes.pop() if sizes else (96, 96)
+        if size == (96, 96):
+            return {}
+
+        return {'input_size': size+(1,)}
+
+    def foreground_patches(self):
+        "Function to collect the foreground flags computed during preprocessing"
+        flags = [self.image_info[image]['foreground'] for image in self.image_info
+                 if 'foreground' in self.image_info[image]]
+        if not flags or len(flags) != len(self.image_info):
+            return None
+
+        return np.concatenate([np.asarray(f, dtype=bool) for f in flags])
+
+    def save_inference(self, outdir, binarize=True, subfolders=False):
+        """Function to save the segmented masks. With subfolders, the mask of
+        the n-th image is saved in outdir/n, to avoid name clashes between
+        images coming from different subjects.
+        """
         prediction = self.prediction
+        self.outnames = []
+        self.probnames = []
+        outname = None
         z0 = 0
         for i, image in enumerate(self.image_info):
+            patches = self.image_info[image]['patches']
+            slices = self.image_info[image]['slices']
+            im = prediction[z0:z0+(slices*patches), :, :, 0]
+            z0 = z0+(slices*patches)
             try:
                 _, basename, ext = split_filename(image)
-                patches = self.image_info[image]['patches']
-                slices = self.image_info[image]['slices']
                 resampled_image_dim = self.image_info[image]['image_dim']
                 indexes = self.image_info[image]['indexes']
                 deltas = self.image_info[image]['deltas']
                 original_image_dim = self.image_info[image]['orig_size']
-                im = prediction[z0:z0+(slices*patches), :, :, 0]
                 final_prediction = self.inference_reshaping(
                     im, patches, slices, resampled_image_dim, indexes, deltas,
-                    original_image_dim, binarize=binarize)
-                outname = os.path.join(outdir, basename.split(
-                    '_resampled')[0]+'_lung_segmented{}'.format(ext))
+                    original_image_dim, blending=self.inputs.blending)
+                image_outdir = outdir
+                if subfolders:
+                    image_outdir = os.path.join(outdir, str(i))
+                    if not os.path.isdir(image_outdir):
+                        os.makedirs(image_outdir)
+                basename = basename.split('_resampled')[0]
+                outname = os.path.join(
+                    image_outdir, basename+'_lung_segmented{}'.format(ext))
                 reference = self.image_info[image]['orig_image']
-                if ext == '.nrrd':
-                    _, hd = nrrd.read(reference)
-                    nrrd.write(outname, final_prediction, header=hd)
-                elif ext == '.nii.gz' or ext == '.nii':
-                    ref = nib.load(reference)
-                    im2save = nib.Nifti1Image(final_prediction, affine=ref.affine)
-                    nib.save(im2save, outname)
-                z0 = z0+(slices*patches)
+                hd = read_header(reference)
+                if self.inputs.save_probabilities:
+                    probname = os.path.join(
+                        image_outdir, basename+'_lung_probabilities{}'.format(ext))
+                    write_image(np.clip(final_prediction, 0, 1), probname,
+                                reference, scale=1/255.,
+                                compression_level=self.inputs.compression_level,
+                                reference_header=hd)
+                    self.probnames.append(probname)
+                if binarize:
+                    final_prediction = self.binarization(final_prediction)
+                write_image(final_prediction, outname, reference,
+                            compression_level=self.inputs.compression_level,
+                            reference_header=hd)
+                self.outnames.append(outname)
             except:
                 continue
         return outname
 
+    def streaming_inference(self, test_set, outdir, binarize=True,
+                            subfolders=False):
+        """Function to segment the images slab_size slices (of the original
+        image) at a time. The folds predict the whole tensor one after the
+        other (so each fold is loaded once), in chunks, into a float32
+        prediction kept on disk as a memory-mapped .npy file. Then, for each
+        slab, the resampled slices it needs are reconstructed (each of them
+        only once), resized and written to a preallocated float16 .npy file,
+        while a 256-bin histogram of the probabilities is accumulated. The
+        mask is then binarized with the Otsu threshold of that histogram and
+        written slab by slab, so the prediction of the whole image is never
+        in memory.
+        """
+        slab_size = self.inputs.slab_size
+        chunk_size = self.inputs.ensemble_chunk or slab_size*max(
+            [self.image_info[image]['patches'] for image in self.image_info]
+            + [1])
+        prediction_file = os.path.join(outdir, 'streaming_prediction.npy')
+        prediction = np.lib.format.open_memmap(
+            prediction_file, mode='w+', dtype=np.float32,
+            shape=test_set.shape[:-1]+(1,))
+        prediction = self.ensemble_prediction(
+            test_set, chunk_size=chunk_size,
+            foreground=self.foreground_patches(), fold_major=True,
+            prediction=prediction, tolerance=self.inputs.adaptive_tolerance,
+            min_folds=self.inputs.min_folds)
+        self.outnames = []
+        self.probnames = []
+        outname = None
+        z0 = 0
+        for i, image in enumerate(self.image_info):
+            info = self.image_info[image]
+            patches = info['patches']
+            offset = z0
+            z0 = z0+(info['slices']*patches)
+            _, basename, ext = split_filename(image)
+            basename = basename.split('_resampled')[0]
+            image_outdir = outdir
+            if subfolders:
+                image_outdir = os.path.join(outdir, str(i))
+                if not os.path.isdir(image_outdir):
+                    os.makedirs(image_outdir)
+            outname = os.path.join(
+                image_outdir, basename+'_lung_segmented{}'.format(ext))
+            reference = info['orig_image']
+            hd = read_header(reference)
+            shape = tuple(info['orig_size'])
+            indexes = [nearest_indices(r, o) for o, r in zip(
+                shape, tuple(info['image_dim'])+(info['slices'],))]
+            tmp_file = os.path.join(image_outdir, basename+'_probabilities.npy')
+            probabilities = np.lib.format.open_memmap(
+                tmp_file, mode='w+', dtype=np.float16, shape=shape,
+                fortran_order=True)
+            histogram = np.zeros(256, dtype=np.int64)
+            if self.inputs.save_probabilities:
+                probname = os.path.join(
+                    image_outdir, basename+'_lung_probabilities{}'.format(ext))
+                prob_writer = SlabWriter(
+                    probname, reference, shape, scale=1/255.,
+                    compression_level=self.inputs.compression_level,
+                    reference_header=hd)
+
+            last = None
+            for k0 in range(0, shape[2], slab_size):
+                k1 = min(k0+slab_size, shape[2])
+                # resampled slices needed by this slab; the first one can be
+                # the last one of the previous slab, which is not
+                # reconstructed again
+                needed = indexes[2][k0:k1]
+                s0 = needed[0]
+                s1 = needed[-1]+1
+                if last is not None and last[0] == s0:
+                    s0 += 1
+                slab = reconstruct_volume_2D(
+                    prediction[offset+s0*patches:offset+s1*patches, :, :, 0],
+                    info['image_dim'], info['indexes'], info['deltas'],
+                    blending=self.inputs.blending)
+                if s0 > needed[0]:
+                    slab = np.concatenate([last[1][np.newaxis], slab])
+                last = (s1-1, slab[-1])
+                slab = slab[needed-needed[0]][:, indexes[0]][:, :, indexes[1]]
+                slab = np.clip(np.moveaxis(slab, 0, 2), 0, 1)
+                probabilities[:, :, k0:k1] = slab
+                histogram += np.histogram(slab, bins=256, range=(0, 1))[0]
+                if self.inputs.save_probabilities:
+                    prob_writer.write(slab)
+            if self.inputs.save_probabilities:
+                prob_writer.close()
+                self.probnames.append(probname)
+
+            threshold = self.histogram_otsu(
+                histogram, (np.arange(256)+0.5)/256)
+            writer = SlabWriter(
+                outname, reference, shape,
+                dtype=np.uint8 if binarize else np.float32,
+                compression_level=self.inputs.compression_level,
+                reference_header=hd)
+            for k0 in range(0, shape[2], slab_size):
+                slab = probabilities[:, :, k0:k0+slab_size]
+                writer.write(slab >= threshold if binarize else slab)
+            writer.close()
+            del probabilities
+            os.remove(tmp_file)
+            self.outnames.append(outname)
+        del prediction
+        os.remove(prediction_file)
+
+        return outname
+
     def inference_reshaping(self, generated_images, patches, slices,
                             dims, indexes, deltas, original_size,
-                            binarize=False):
+                            binarize=False, blending='mean'):
         "Function to reshape the predictions"
-        if patches > 1:
-            sl = 0
-            final_image = np.zeros((slices, dims[0], dims[1], patches),
-                                   dtype=np.float32)-2
-            for n in range(0, generated_images.shape[0], patches):
-                k = 0
-                for j in indexes[1]:
-                    for i in indexes[0]:
-                        final_image[sl, i[0]:i[1], j[0]:j[1], k] = (
-                            generated_images[n+k, deltas[0]:, deltas[1]:])
-                        k += 1
-                sl = sl + 1
-            final_image[final_image==-2] = np.nan
-            final_image = np.nanmean(final_image, axis=-1)
-            final_image[np.isnan(final_image)] = 0
-        else:
-            final_image = generated_images[:, deltas[0]:, deltas[1]:]
+        final_image = reconstruct_volume_2D(
+            generated_images, dims, indexes, deltas, blending=blending)
 
         final_image = np.swapaxes(final_image, 0, 2)
         final_image = np.swapaxes(final_image, 0, 1)
@@ -115,6 +528,28 @@ class LungSegmentationInference(BaseInterface):
 
         return final_image
 
+    @staticmethod
+    def histogram_otsu(histogram, bin_centers):
+        """Function to compute the Otsu threshold from a histogram, as
+        threshold_otsu(hist=...) does in scikit-image >= 0.19 (the empty bins
+        at both ends are ignored)
+        """
+        nonzero = np.nonzero(histogram)[0]
+        if not nonzero.size:
+            raise Exception('The Otsu threshold cannot be computed on an '
+                            'empty histogram!')
+        counts = np.asarray(histogram, dtype=np.float64)[nonzero[0]:nonzero[-1]+1]
+        bin_centers = np.asarray(bin_centers)[nonzero[0]:nonzero[-1]+1]
+        if counts.size == 1:
+            return bin_centers[0]
+        weight1 = np.cumsum(counts)
+        weight2 = np.cumsum(counts[::-1])[::-1]
+        mean1 = np.cumsum(counts*bin_centers)/weight1
+        mean2 = (np.cumsum((counts*bin_centers)[::-1])/weight2[::-1])[::-1]
+        variance12 = weight1[:-1]*weight2[1:]*(mean1[:-1]-mean2[1:])**2
+
+        return bin_centers[np.argmax(variance12)]
+
     @staticmethod
     def binarization(image):
 
@@ -127,5 +562,105 @@ class LungSegmentationInference(BaseInterface):
     def _list_outputs(self):
         outputs = self._outputs().get()
         outputs['segmented_lungs'] = self.segmentation
+        if self.probnames:
+            outputs['probability_map'] = self.probnames[-1]
+        outputs['skip_ratio'] = self.skip_ratio
+        outputs['time_saved'] = self.time_saved
+        outputs['fold_counts'] = self.fold_counts()
+        outputs['inference_time'] = self.inference_time
+
+        return outputs
+
+
+class LungSegmentationCohortInferenceInputSpec(LungSegmentationInferenceInputSpec):
+
+    tensor_files = InputMultiPath(File(exists=True), mandatory=True, desc=(
+        'Tensors (.npy files) of all the images of the cohort.'))
+    image_infos = traits.List(traits.Dict, mandatory=True, desc=(
+        'Image information dictionaries, in the same order as tensor_files.'))
+    ensemble_chunk = traits.Int(4096, usedefault=True, desc=(
+        'Number of patches, across all the images, read from disk and '
+        'predicted at once by each fold.'))
+    batch_size = traits.Int(128, desc=(
+        'Number of patches fed to the network at once. If not given, the one '
+        'tuned for this host (see use_profile) is used, otherwise 128.'))
+
+
+class LungSegmentationCohortInferenceOutputSpec(TraitedSpec):
+
+    segmented_lungs = OutputMultiPath(File(exists=True), desc=(
+        'Segmented lungs, in the same order as tensor_files.'))
+    probability_maps = OutputMultiPath(File(), desc=(
+        'Ensemble probability maps, if save_probabilities is True.'))
+    skip_ratio = traits.Float(desc='Fraction of patches skipped as background.')
+    time_saved = traits.Float(desc=(
+        'Estimated inference time (in seconds) saved by skipping the '
+        'background patches.'))
+    fold_counts = traits.Dict(desc=(
+        'Average number of folds used to predict the patches of each image.'))
+    inference_time = traits.Float(desc=(
+        'Time (in seconds) spent to segment and save the image(s).'))
+
+
+class LungSegmentationCohortInference(LungSegmentationInference):
+    """Lung segmentation of several images (subjects or timepoints) at once.
+    The tensors are memory-mapped and streamed as one, so each fold is loaded
+    only once for the whole cohort and the network always receives full
+    batches. The predictions are then split back per image using the
+    image_info bookkeeping.
+    """
+    input_spec = LungSegmentationCohortInferenceInputSpec
+    output_spec = LungSegmentationCohortInferenceOutputSpec
+
+    def _run_interface(self, runtime):
+
+        start = time.time()
+        if len(self.inputs.tensor_files) != len(self.inputs.image_infos):
+            raise Exception('The number of tensors ({0}) and of image information '
+                            'dictionaries ({1}) must be the same!'.format(
+                                len(self.inputs.tensor_files),
+                                len(self.inputs.image_infos)))
+        self.image_info = {}
+        for image_info in self.inputs.image_infos:
+            self.image_info.update(image_info)
+        outdir = os.path.abspath(self.inputs.outdir)
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        test_set = TensorStack([np.load(f, mmap_mode='r')
+                                for f in self.inputs.tensor_files])
+        MODEL_CACHE.max_memory = self.inputs.cache_size
+        self.apply_profile()
+        if self.inputs.streaming:
+            self.streaming_inference(test_set, outdir, subfolders=True)
+            self.report_time(test_set.shape[0], start)
+            return runtime
+        # the cohort prediction is kept on disk, as the tensors
+        prediction = np.lib.format.open_memmap(
+            os.path.join(outdir, 'cohort_prediction.npy'), mode='w+',
+            dtype=np.float32, shape=test_set.shape[:-1]+(1,))
+        self.prediction = self.ensemble_prediction(
+            test_set, chunk_size=self.inputs.ensemble_chunk,
+            foreground=self.foreground_patches(), fold_major=True,
+            prediction=prediction, tolerance=self.inputs.adaptive_tolerance,
+            min_folds=self.inputs.min_folds)
+        self.save_inference(outdir, subfolders=True)
+        if len(self.outnames) != len(self.image_info):
+            raise Exception('Only {0} out of {1} images were segmented!'.format(
+                len(self.outnames), len(self.image_info)))
+        del self.prediction, prediction
+        os.remove(os.path.join(outdir, 'cohort_prediction.npy'))
+        self.report_time(test_set.shape[0], start)
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['segmented_lungs'] = self.outnames
+        if self.probnames:
+            outputs['probability_maps'] = self.probnames
+        outputs['skip_ratio'] = self.skip_ratio
+        outputs['time_saved'] = self.time_saved
+        outputs['fold_counts'] = self.fold_counts()
+        outputs['inference_time'] = self.inference_time
 
         return outputs
@@ -1,14 +1,21 @@
 import os
+import shutil
 import nibabel as nib
 import nrrd
 import numpy as np
+import SimpleITK as sitk
 from nipype.interfaces.base import (
     BaseInterface, TraitedSpec, Directory,
     BaseInterfaceInputSpec, traits, InputMultiPath)
 from nipype.interfaces.base import isdefined
-from skimage.transform import resize
 from core.utils.filemanip import split_filename
-from radiants.utils.dataloader import load_data_2D
+from radiants.utils.dataloader import (
+    load_volume_2D, patch_tiling, nearest_indices)
+from radiants.utils.image_io import read_header, write_image, SlabReader
+
+
+INTERPOLATORS = {0: sitk.sitkNearestNeighbor, 1: sitk.sitkLinear,
+                 3: sitk.sitkBSpline}
 
 
 class LungSegmentationPreprocInputSpec(BaseInterfaceInputSpec):
@@ -19,12 +26,49 @@ class LungSegmentationPreprocInputSpec(BaseInterfaceInputSpec):
         'List of 3 Floats to be used to resample the input image.'))
     outdir = Directory('preproc', usedefault=True,
                         desc='Folder to store the preprocessing results.')
+    save_tensor = traits.Bool(False, usedefault=True, desc=(
+        'Whether or not to save the tensor as .npy file and return only its '
+        'path (tensor_file) instead of the tensor itself. This avoids pickling '
+        'the tensor into the nipype results file.'))
+    save_resampled = traits.Bool(True, usedefault=True, desc=(
+        'Whether or not to save the resampled image to file.'))
+    skip_background = traits.Bool(False, usedefault=True, desc=(
+        'Whether or not to flag the patches outside the body as background, '
+        'so that the inference can skip them.'))
+    body_threshold = traits.Float(0.15, usedefault=True, desc=(
+        'Threshold, on the 0-1 normalized slices, used to compute the body '
+        'mask when skip_background is True.'))
+    num_threads = traits.Int(0, usedefault=True, desc=(
+        'Number of threads used by SimpleITK to resample the image with '
+        'linear or B-spline interpolation. It has no effect with nearest '
+        'neighbour interpolation (the default), which is a single-threaded '
+        'numpy gather. Default is 0, which means all the available cores.'))
+    compression_level = traits.Range(0, 9, 1, usedefault=True, desc=(
+        'Gzip level used to save the resampled image. Default is 1, since '
+        'the resampled image is only an intermediate result.'))
+    stream_slabs = traits.Bool(False, usedefault=True, desc=(
+        'Whether or not to release the resampled image once saved and to '
+        'create the tensor reading slab_thickness slices at a time from the '
+        'saved file. Together with save_tensor, the tensor is also written '
+        'directly to disk, so only one slab is in memory at a time. '
+        'It implies save_resampled.'))
+    slab_thickness = traits.Int(16, usedefault=True, desc=(
+        'Number of slices processed at once to create the tensor.'))
+    min_overlap = traits.Int(desc=(
+        'If provided, the slices are tiled with the smallest grid of '
+        'patches covering them with at least this overlap (in voxels). '
+        'Otherwise the original tiling is used.'))
+    tile_size = traits.Int(96, usedefault=True, desc=(
+        'Size of the (square) patches. The network is fully convolutional, '
+        'so larger tiles (multiple of 16) can be used at inference time.'))
 
 
 class LungSegmentationPreprocOutputSpec(TraitedSpec):
     
     preproc_image = traits.File(exists=True, desc='Preprocessed image')
     tensor = traits.Array(desc='Tensor to be fed to the network.')
+    tensor_file = traits.File(exists=True, desc=(
+        'Tensor to be fed to the network, saved as .npy file.'))
     image_info = traits.Dict(desc='Dictionary with information about the image.')
 
 
@@ -42,85 +86,332 @@ class LungSegmentationPreproc(BaseInterface):
             os.makedirs(outdir)
         self.image_info = {}
 
-        _, _, img_path, orig_size = self.resize_image(image, new_spacing=new_spacing,
-                                                      outdir=outdir)
+        resampled, _, img_path, orig_size = self.resize_image(
+            image, new_spacing=new_spacing, outdir=outdir,
+            save2file=(self.inputs.save_resampled or self.inputs.stream_slabs),
+            return_array=not self.inputs.stream_slabs)
         self.image_info[img_path] = {}
         self.image_info[img_path]['orig_size'] = orig_size
         self.image_info[img_path]['orig_image'] = image
-        self.create_tensors(img_path)
         self.img_path = img_path
+        self.tensor_file = None
+        if self.inputs.save_tensor:
+            _, fname, ext = split_filename(img_path)
+            self.tensor_file = os.path.join(outdir, fname+'_tensor.npy')
+        patch_size = (self.inputs.tile_size, self.inputs.tile_size)
+        if self.inputs.tile_size % 16:
+            raise Exception('The tile size must be a multiple of 16, {} '
+                            'given.'.format(self.inputs.tile_size))
+        if self.inputs.stream_slabs:
+            self.create_tensors(img_path, patch_size=patch_size,
+                                out_file=self.tensor_file)
+        else:
+            self.create_tensors(img_path, array=resampled,
+                                patch_size=patch_size,
+                                out_file=self.tensor_file)
+        info = self.image_info[img_path]
+        print('Lung tiling of {0}: {1} patches of {2}x{2} voxels ({3} per '
+              'slice).'.format(img_path, info['patches']*info['slices'],
+                               self.inputs.tile_size, info['patches']))
         
         return runtime
     
     def resize_image(self, image, order=0, new_spacing=(0.1, 0.1, 0.1),
-                     save2file=True, outdir=None):
-
+                     save2file=True, outdir=None, return_array=True):
+        """Function to resample the image to new_spacing. The image is read
+        only once and resampled to float32. The output grid has the same size
+        and field of view that skimage resize used to give. Nearest neighbour
+        interpolation picks the same voxels as skimage (see nearest_indices),
+        the other orders are done by SimpleITK (multi-threaded). If the image
+        already has the requested size, it is copied without re-encoding it
+        (and, without return_array, without reading its data at all).
+        """
         if outdir is None:
             outdir, fname, ext = split_filename(image)
         else:
             _, fname, ext = split_filename(image)
         outname = os.path.join(outdir, fname+'_resampled'+ext)
+
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(image)
+        reader.ReadImageInformation()
+        orig_shape = reader.GetSize()
+        spacing = np.asarray(reader.GetSpacing())
+        # the output size is computed from the header spacing exactly as the
+        # skimage implementation did (float32 NIfTI zooms, NRRD space
+        # directions), since SimpleITK spacing can differ in the last digits
+        header = read_header(image)
         if ext == '.nrrd':
-            image, hd = nrrd.read(image)
-            space_x = np.abs(hd['space directions'][0, 0])
-            space_y = np.abs(hd['space directions'][1, 1])
-            space_z = np.abs(hd['space directions'][2, 2])
-        elif ext == '.nii.gz' or ext == '.nii':
-            hd = nib.load(image).header
-            affine = nib.load(image).affine
-            image = nib.load(image).get_data()
-            space_x, space_y, space_z = hd.get_zooms()
-    
-        resampling_factor = (new_spacing[0]/space_x, new_spacing[1]/space_y, new_spacing[2]/space_z)
-        new_shape = (image.shape[0]//resampling_factor[0], image.shape[1]//resampling_factor[1],
-                     image.shape[2]//resampling_factor[2])
-        new_image = resize(image.astype(np.float64), new_shape, order=order, mode='edge',
-                           cval=0, anti_aliasing=False)
-        if save2file:
-            if ext == '.nrrd':
-                hd['sizes'] = np.array(new_image.shape)
-                hd['space directions'][0, 0] = new_spacing[0]
-                hd['space directions'][1, 1] = new_spacing[1]
-                hd['space directions'][2, 2] = new_spacing[2]
-                nrrd.write(outname, new_image, header=hd)
-            elif ext == '.nii.gz' or ext == '.nii':
-                im2save = nib.Nifti1Image(new_image, affine=affine)
-                nib.save(im2save, outname)
-        return new_image, tuple(map(int, new_shape)), outname, image.shape
-
-    def create_tensors(self, image, patch_size=(96, 96)):
-        "Function to create the 2D tensor from the 3D images"
-        image_tensor = []
+            space = [np.abs(header['space directions'][i, i]) for i in range(3)]
+        else:
+            space = header.header.get_zooms()[:3]
+        resampling_factor = [new_spacing[i]/space[i] for i in range(3)]
+        new_shape = tuple(int(orig_shape[i]//resampling_factor[i])
+                          for i in range(3))
+
+        new_image = None
+        if new_shape == orig_shape:
+            if save2file:
+                shutil.copy(image, outname)
+            if return_array:
+                new_image = reader.Execute()
+        else:
+            # the image is read with its own pixel type, only the resampled
+            # one is float32
+            ref = reader.Execute()
+            scale = np.asarray(orig_shape, dtype=float)/new_shape
+            direction = np.asarray(ref.GetDirection()).reshape(3, 3)
+            # the centre of the first output voxel is moved to where skimage
+            # resize samples it, so the field of view stays the same
+            origin = (np.asarray(ref.GetOrigin())
+                      + direction.dot((scale-1)/2*spacing))
+            if order == 0:
+                # SimpleITK rounds the half-way samples differently, due to
+                # the physical point to index conversion
+                indices = [nearest_indices(n_in, n_out) for n_in, n_out
+                           in zip(orig_shape, new_shape)][::-1]
+                new_image = sitk.GetImageFromArray(
+                    sitk.GetArrayViewFromImage(ref)[np.ix_(*indices)].astype(
+                        np.float32))
+                new_image.SetOrigin(origin.tolist())
+                new_image.SetSpacing((spacing*scale).tolist())
+                new_image.SetDirection(ref.GetDirection())
+            else:
+                resampler = sitk.ResampleImageFilter()
+                resampler.SetSize(new_shape)
+                resampler.SetInterpolator(INTERPOLATORS[order])
+                resampler.SetOutputOrigin(origin.tolist())
+                resampler.SetOutputSpacing((spacing*scale).tolist())
+                resampler.SetOutputDirection(ref.GetDirection())
+                resampler.SetOutputPixelType(sitk.sitkFloat32)
+                if self.inputs.num_threads:
+                    resampler.SetNumberOfThreads(self.inputs.num_threads)
+                new_image = resampler.Execute(ref)
+            del ref
+            if save2file:
+                level = self.inputs.compression_level
+                sitk.WriteImage(new_image, outname, level > 0, level)
+        if return_array:
+            # SimpleITK arrays are (z, y, x), the transposed one is (x, y, z)
+            # as it was with nibabel and pynrrd
+            new_image = sitk.GetArrayFromImage(new_image).T.astype(
+                np.float32, copy=False)
+        else:
+            new_image = None
+
+        return new_image, new_shape, outname, orig_shape
+
+    def create_tensors(self, image, array=None, patch_size=(96, 96),
+                       out_file=None):
+        """Function to create the 2D tensor from the 3D images. If array is
+        not provided, the image is read in slabs from disk. With out_file the
+        tensor is written directly to that .npy file.
+        """
         im_base, im_name, ext = split_filename(image)
         im_path = os.path.join(im_base, im_name)
+        if array is not None:
+            volume = array
+        else:
+            volume = SlabReader(image)
+        body_threshold = (self.inputs.body_threshold
+                          if self.inputs.skip_background else None)
+        min_overlap = (self.inputs.min_overlap
+                       if isdefined(self.inputs.min_overlap) else None)
+        self.image_tensor, info_dict = load_volume_2D(
+            volume, patch_size=patch_size, binarize=False, normalization=True,
+            body_threshold=body_threshold, slab=self.inputs.slab_thickness,
+            out_file=out_file, min_overlap=min_overlap)
+        if array is None:
+            volume.close()
+
+        im_name = im_path+ext
+        for k in info_dict.keys():
+            self.image_info[im_name][k] = info_dict[k]
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        if self.inputs.save_resampled or self.inputs.stream_slabs:
+            outputs['preproc_image'] = self.img_path
+        if self.tensor_file is not None:
+            outputs['tensor_file'] = self.tensor_file
+        else:
+            outputs['tensor'] = self.image_tensor
+        outputs['image_info'] = self.image_info
+
+        return outputs
+
+
+class LungBoundingBoxCropInputSpec(BaseInterfaceInputSpec):
+
+    in_file = traits.File(exists=True, mandatory=True, desc=(
+        'Image to be cropped around the lungs.'))
+    coarse_mask = traits.File(exists=True, mandatory=True, desc=(
+        'Lung mask obtained from the coarse resolution segmentation, in the '
+        'same space as in_file.'))
+    margin = traits.Float(10.0, usedefault=True, desc=(
+        'Margin (in mm) added around the lung bounding box.'))
+    new_spacing = InputMultiPath([0.35, 0.35, 0.35], usedefault=True, desc=(
+        'Spacing used by the full resolution segmentation. Only used to report '
+        'the reduction of voxels and patches.'))
+    coarse_spacing = InputMultiPath([1.5, 1.5, 1.5], usedefault=True, desc=(
+        'Spacing used by the coarse resolution segmentation. Only used to '
+        'report the reduction of voxels and patches.'))
+    outdir = Directory('cropped', usedefault=True,
+                       desc='Folder to store the cropped image.')
+
+
+class LungBoundingBoxCropOutputSpec(TraitedSpec):
+
+    cropped_image = traits.File(exists=True, desc='Image cropped around the lungs.')
+    bounding_box = traits.List(desc=(
+        'Bounding box, as [[x0, x1], [y0, y1], [z0, z1]] voxels of in_file.'))
+    voxel_ratio = traits.Float(desc=(
+        'Number of voxels resampled by the two stages divided by the number '
+        'of voxels resampled in single-pass mode.'))
+    patch_ratio = traits.Float(desc=(
+        'Number of patches predicted by the two stages divided by the number '
+        'of patches predicted in single-pass mode.'))
+
+
+class LungBoundingBoxCrop(BaseInterface):
+    """Second stage of the coarse-to-fine lung segmentation: the image is
+    cropped to the bounding box (plus a margin) of the coarse lung mask, so
+    that only this region is resampled, tiled and segmented at full
+    resolution.
+    """
+    input_spec = LungBoundingBoxCropInputSpec
+    output_spec = LungBoundingBoxCropOutputSpec
+
+    def _run_interface(self, runtime):
+
+        image = self.inputs.in_file
+        outdir = os.path.abspath(self.inputs.outdir)
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        _, fname, ext = split_filename(image)
+        self.cropped_image = os.path.join(outdir, fname+'_cropped'+ext)
+
         if ext == '.nrrd':
-            image, _ = nrrd.read(image)
+            image, hd = nrrd.read(image)
+            mask, _ = nrrd.read(self.inputs.coarse_mask)
+            spacing = np.abs(np.diag(hd['space directions']))
         elif ext == '.nii.gz' or ext == '.nii':
-            image = nib.load(image).get_fdata()
-        im_size = image.shape[:2]
-        for n_slice in range(image.shape[2]):
-            im_array, info_dict = load_data_2D(
-                '', '', array=image[:, :, n_slice], img_size=im_size,
-                patch_size=patch_size, binarize=False, normalization=True,
-                mb=[], prediction=True)
-            for j in range(im_array.shape[0]):
-                image_tensor.append(im_array[j, :])
-
-        if info_dict is not None:
-            im_name = im_path+ext
-            self.image_info[im_name]['slices'] = n_slice+1
-            for k in info_dict[0].keys():
-                self.image_info[im_name][k] = info_dict[0][k]
-        if image_tensor:
-            self.image_tensor = (np.asarray(image_tensor).reshape(
-                -1, im_array.shape[1], im_array.shape[2], 1))
+            ref = nib.load(image)
+            image = np.asanyarray(ref.dataobj)
+            mask = np.asanyarray(nib.load(self.inputs.coarse_mask).dataobj)
+            spacing = np.asarray(ref.header.get_zooms()[:3])
+
+        coords = np.nonzero(mask)
+        if coords[0].size == 0:
+            print('The coarse lung mask is empty, the whole image will be '
+                  'segmented at full resolution.')
+            box = [[0, s] for s in image.shape[:3]]
         else:
-            self.image_tensor = np.zeros()
+            margin = np.ceil(self.inputs.margin/spacing).astype(int)
+            box = [[int(max(0, c.min()-m)), int(min(s, c.max()+1+m))]
+                   for c, m, s in zip(coords, margin, image.shape)]
+        self.bounding_box = box
+        cropped = image[box[0][0]:box[0][1], box[1][0]:box[1][1],
+                        box[2][0]:box[2][1]]
+        offset = np.asarray([b[0] for b in box], dtype=np.float64)
+
+        if ext == '.nrrd':
+            hd['sizes'] = np.array(cropped.shape)
+            origin = np.asarray(hd.get('space origin', np.zeros(3)),
+                                dtype=np.float64)
+            hd['space origin'] = origin + np.dot(offset, hd['space directions'])
+            nrrd.write(self.cropped_image, cropped, header=hd)
+        elif ext == '.nii.gz' or ext == '.nii':
+            affine = ref.affine.copy()
+            affine[:3, 3] = np.dot(affine[:3, :3], offset) + affine[:3, 3]
+            nib.save(nib.Nifti1Image(cropped, affine, header=ref.header),
+                     self.cropped_image)
+
+        full = self.counts(image.shape, spacing, self.inputs.new_spacing)
+        coarse = self.counts(image.shape, spacing, self.inputs.coarse_spacing)
+        fine = self.counts(cropped.shape, spacing, self.inputs.new_spacing)
+        self.voxel_ratio = float(coarse[0]+fine[0])/full[0]
+        self.patch_ratio = float(coarse[1]+fine[1])/full[1]
+        print('Coarse-to-fine lung segmentation: {0} -> {1} resampled voxels '
+              '({2:.1f}%), {3} -> {4} patches ({5:.1f}%).'.format(
+                  full[0], coarse[0]+fine[0], self.voxel_ratio*100,
+                  full[1], coarse[1]+fine[1], self.patch_ratio*100))
+
+        return runtime
+
+    @staticmethod
+    def counts(shape, spacing, new_spacing, patch_size=(96, 96)):
+        "Function to compute the number of voxels and patches after resampling"
+        new_shape = [int(s//(ns/sp)) for s, sp, ns in zip(shape, spacing, new_spacing)]
+        xx, yy = patch_tiling(new_shape[:2], patch_size, [])
+
+        return np.prod(new_shape), len(xx)*len(yy)*new_shape[2]
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs['preproc_image'] = self.img_path
-        outputs['tensor'] = self.image_tensor
-        outputs['image_info'] = self.image_info
+        outputs['cropped_image'] = self.cropped_image
+        outputs['bounding_box'] = self.bounding_box
+        outputs['voxel_ratio'] = self.voxel_ratio
+        outputs['patch_ratio'] = self.patch_ratio
+
+        return outputs
+
+
+class LungBoundingBoxPasteInputSpec(BaseInterfaceInputSpec):
+
+    in_file = traits.File(exists=True, mandatory=True, desc=(
+        'Lung mask of the cropped image.'))
+    reference = traits.File(exists=True, mandatory=True, desc=(
+        'Original, not cropped, image.'))
+    bounding_box = traits.List(mandatory=True, desc=(
+        'Bounding box used to crop the image (see LungBoundingBoxCrop).'))
+    compression_level = traits.Range(0, 9, 6, usedefault=True, desc=(
+        'Gzip level used to save the mask, 0 means no compression.'))
+    outdir = Directory('segmented', usedefault=True,
+                       desc='Folder to store the lung mask.')
+
+
+class LungBoundingBoxPasteOutputSpec(TraitedSpec):
+
+    out_file = traits.File(exists=True, desc='Lung mask in the original space.')
+
+
+class LungBoundingBoxPaste(BaseInterface):
+    """Last stage of the coarse-to-fine lung segmentation: the full
+    resolution mask of the cropped image is pasted back into the original
+    geometry.
+    """
+    input_spec = LungBoundingBoxPasteInputSpec
+    output_spec = LungBoundingBoxPasteOutputSpec
+
+    def _run_interface(self, runtime):
+
+        box = self.inputs.bounding_box
+        outdir = os.path.abspath(self.inputs.outdir)
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        _, fname, ext = split_filename(self.inputs.reference)
+        self.out_file = os.path.join(outdir, fname+'_lung_segmented'+ext)
+
+        hd = read_header(self.inputs.reference)
+        if ext == '.nrrd':
+            cropped, _ = nrrd.read(self.inputs.in_file)
+            shape = tuple(hd['sizes'])
+        elif ext == '.nii.gz' or ext == '.nii':
+            cropped = np.asanyarray(nib.load(self.inputs.in_file).dataobj)
+            shape = hd.shape
+        mask = np.zeros(shape[:3], dtype=np.uint8)
+        mask[box[0][0]:box[0][1], box[1][0]:box[1][1],
+             box[2][0]:box[2][1]] = cropped
+
+        write_image(mask, self.out_file, self.inputs.reference,
+                    compression_level=self.inputs.compression_level,
+                    reference_header=hd)
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = self.out_file
 
         return outputs
@@ -3,8 +3,12 @@ from nipype.interfaces.base import (
     BaseInterfaceInputSpec, Directory, BaseInterface)
 import os
 import glob
+import time
 from nipype.interfaces.base import isdefined
 from core.utils.filemanip import split_filename
+from radiants.utils.predictor_service import submit, service_socket
+from radiants.utils.nnunet_inference import predict_models
+from radiants.utils.ensemble import hd_bet_parallel, nnunet_parallel
 try:
     from nnunet.inference.predict import predict_from_folder
     import torch
@@ -17,6 +21,11 @@ BASH_PATH = os.path.abspath(os.path.join(os.path.split(__file__)[0],
                                          os.pardir, os.pardir, 'bash'))
 
 
+def defined_or_none(value):
+
+    return value if isdefined(value) else None
+
+
 class HDBetInputSpec(CommandLineInputSpec):
     
     _mode_types = ['accurate', 'fast']
@@ -46,6 +55,16 @@ class HDBetInputSpec(CommandLineInputSpec):
     overwrite_existing = traits.Int(argstr='--overwrite_existing %i',
                                     desc='Set this to 0 if you do not want to'
                                     ' overwrite existing predictions')
+    fold_parallel = traits.Bool(False, usedefault=True, desc=(
+        'Whether or not to evaluate the parameter sets of the ensemble in '
+        'parallel on CPU, one process per set, instead of running hd-bet. '
+        'device is ignored.'))
+    processes = traits.Int(desc=(
+        'Number of processes used with fold_parallel. By default one per '
+        'parameter set, up to the available cores.'))
+    threads_per_process = traits.Int(desc=(
+        'Number of threads of each process used with fold_parallel. By '
+        'default the available cores are divided among the processes.'))
 
 
 class HDBetOutputSpec(TraitedSpec):
@@ -60,6 +79,26 @@ class HDBet(CommandLine):
     input_spec = HDBetInputSpec
     output_spec = HDBetOutputSpec
 
+    def _run_interface(self, runtime):
+
+        if not self.inputs.fold_parallel:
+            return super()._run_interface(runtime)
+        kwargs = {}
+        for name, default in [('mode', 'accurate'), ('tta', 1),
+                              ('post_processing', 1), ('save_mask', 1)]:
+            value = getattr(self.inputs, name)
+            kwargs[name] = value if isdefined(value) else default
+        hd_bet_parallel(self.inputs.input_file, self._gen_outfilename('out_file'),
+                        self._gen_outfilename('out_mask'), mode=kwargs['mode'],
+                        tta=kwargs['tta'] != 0,
+                        postprocess=kwargs['post_processing'] != 0,
+                        keep_mask=kwargs['save_mask'] != 0,
+                        processes=defined_or_none(self.inputs.processes),
+                        threads=defined_or_none(self.inputs.threads_per_process))
+        runtime.returncode = 0
+
+        return runtime
+
     def _list_outputs(self):
         outputs = self.output_spec().get()
         outputs['out_file'] = self._gen_outfilename('out_file')
@@ -101,6 +140,97 @@ class HDBet(CommandLine):
         return None
 
 
+class HDBetBatchInputSpec(BaseInterfaceInputSpec):
+
+    in_files = traits.List(File(exists=True), mandatory=True, desc=(
+        'Images to be brain extracted.'))
+    out_names = traits.List(traits.Str, mandatory=True, desc=(
+        'Output name (without extension) of each image. The brain extracted '
+        'image i is saved as image<i>/<out_name> and its mask as '
+        'image<i>/<out_name>_mask, so the names do not have to be unique.'))
+    mode = traits.Enum('accurate', 'fast', usedefault=True, desc=(
+        'Fast will use only one set of parameters whereas accurate will use '
+        'the five sets of parameters that resulted from the cross-validation '
+        'as an ensemble.'))
+    device = traits.Str('0', usedefault=True, desc=(
+        'GPU id or "cpu". Ignored with fold_parallel.'))
+    tta = traits.Bool(True, usedefault=True, desc=(
+        'Whether or not to use test time data augmentation (mirroring).'))
+    post_processing = traits.Bool(True, usedefault=True, desc=(
+        'Whether or not to keep only the largest connected component of the '
+        'masks.'))
+    fold_parallel = traits.Bool(False, usedefault=True, desc=(
+        'Whether or not to evaluate the parameter sets of the ensemble in '
+        'parallel on CPU (see HDBet).'))
+    processes = traits.Int(desc='Number of processes used with fold_parallel.')
+    threads_per_process = traits.Int(desc=(
+        'Number of threads of each process used with fold_parallel.'))
+
+
+class HDBetBatchOutputSpec(TraitedSpec):
+
+    out_files = traits.List(File(exists=True), desc=(
+        'Brain extracted images, in the same order as in_files.'))
+    out_masks = traits.List(File(exists=True), desc=(
+        'Brain masks, in the same order as in_files.'))
+
+
+class HDBetBatch(BaseInterface):
+    """HD-BET brain extraction of several images in one process, through its
+    Python API, so that the network parameters are loaded once for all the
+    images instead of once per image.
+    """
+    input_spec = HDBetBatchInputSpec
+    output_spec = HDBetBatchOutputSpec
+
+    def _run_interface(self, runtime):
+
+        if len(self.inputs.in_files) != len(self.inputs.out_names):
+            raise Exception('{0} images but {1} output names provided!'.format(
+                len(self.inputs.in_files), len(self.inputs.out_names)))
+        out_files, out_masks = self._gen_outfilenames()
+        for out_file in out_files:
+            if not os.path.isdir(os.path.dirname(out_file)):
+                os.makedirs(os.path.dirname(out_file))
+        start = time.time()
+        if self.inputs.fold_parallel:
+            hd_bet_parallel(self.inputs.in_files, out_files, out_masks,
+                            mode=self.inputs.mode, tta=self.inputs.tta,
+                            postprocess=self.inputs.post_processing,
+                            processes=defined_or_none(self.inputs.processes),
+                            threads=defined_or_none(self.inputs.threads_per_process))
+        else:
+            from HD_BET.run import run_hd_bet
+            device = self.inputs.device
+            run_hd_bet(self.inputs.in_files, out_files, mode=self.inputs.mode,
+                       device=int(device) if device.isdigit() else device,
+                       postprocess=self.inputs.post_processing,
+                       do_tta=self.inputs.tta, keep_mask=True, overwrite=True)
+        print('Brain extraction of {0} images in {1:.1f} s.'.format(
+            len(out_files), time.time()-start))
+
+        return runtime
+
+    def _gen_outfilenames(self):
+
+        out_files = []
+        out_masks = []
+        for i, (in_file, out_name) in enumerate(zip(self.inputs.in_files,
+                                                    self.inputs.out_names)):
+            _, _, ext = split_filename(in_file)
+            out_dir = os.path.abspath('image{:04d}'.format(i))
+            out_files.append(os.path.join(out_dir, out_name+ext))
+            out_masks.append(os.path.join(out_dir, out_name+'_mask'+ext))
+
+        return out_files, out_masks
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_files'], outputs['out_masks'] = self._gen_outfilenames()
+
+        return outputs
+
+
 class HDGlioPredictInputSpec(CommandLineInputSpec):
 
     t1 = traits.File(mandatory=True, exists=True, argstr='-t1 %s',
@@ -112,11 +242,16 @@ class HDGlioPredictInputSpec(CommandLineInputSpec):
     flair = traits.File(mandatory=True, exists=True, argstr='-flair %s',
                         desc='T1 weighted image')
     out_file = traits.Str(argstr='-o %s', desc='output file (or folder) name.')
+    service_socket = traits.Str(desc=(
+        'Unix socket of the predictor service (see run_predictor_service.py). '
+        'If provided, or if $RADIANTS_PREDICTOR_SOCKET is set, the job is sent '
+        'to the service instead of running hd_glio_predict.'))
 
 
 class HDGlioPredictOutputSpec(TraitedSpec):
 
     out_file = File(desc='Brain extracted image.')
+    inference_time = traits.Float(desc='Time spent in the segmentation, in s.')
 
 
 class HDGlioPredict(CommandLine):
@@ -125,9 +260,31 @@ class HDGlioPredict(CommandLine):
     input_spec = HDGlioPredictInputSpec
     output_spec = HDGlioPredictOutputSpec
 
+    def _run_interface(self, runtime):
+
+        start = time.time()
+        runtime = self._predict(runtime)
+        self.inference_time = time.time()-start
+
+        return runtime
+
+    def _predict(self, runtime):
+
+        socket_path = service_socket(self.inputs.service_socket if isdefined(
+            self.inputs.service_socket) else None)
+        if socket_path is None:
+            return super()._run_interface(runtime)
+        submit('hd_glio', socket_path, t1=self.inputs.t1, ct1=self.inputs.ct1,
+               t2=self.inputs.t2, flair=self.inputs.flair,
+               out_file=self._gen_outfilename())
+        runtime.returncode = 0
+
+        return runtime
+
     def _list_outputs(self):
         outputs = self.output_spec().get()
         outputs['out_file'] = self._gen_outfilename()
+        outputs['inference_time'] = self.inference_time
 
         return outputs
 
@@ -155,6 +312,30 @@ class NNUnetInferenceInputSpec(CommandLineInputSpec):
                              desc='Folder with the results of the nnUnet'
                              'training.', argstr='-m %s')
     prefix = traits.Str()
+    case_ids = traits.List(traits.Str, desc=(
+        'Cases in the input folder (e.g. staged by NNUnetCohortPreparation). '
+        'If provided, their segmentations are returned, in the same order, '
+        'as case_files.'))
+    num_threads_preprocessing = traits.Int(
+        argstr='--num_threads_preprocessing %d', desc=(
+            'Number of processes preprocessing the cases while the previous '
+            'ones are predicted. nnUNet default is 6.'))
+    num_threads_nifti_save = traits.Int(
+        argstr='--num_threads_nifti_save %d', desc=(
+            'Number of processes saving the segmentations. nnUNet default is 2.'))
+    service_socket = traits.Str(desc=(
+        'Unix socket of the predictor service (see run_predictor_service.py). '
+        'If provided, or if $RADIANTS_PREDICTOR_SOCKET is set, the job is sent '
+        'to the service instead of running predict_simple.py.'))
+    fold_parallel = traits.Bool(False, usedefault=True, desc=(
+        'Whether or not to evaluate the folds in parallel on CPU, one process '
+        'per fold, instead of running predict_simple.py.'))
+    processes = traits.Int(desc=(
+        'Number of processes used with fold_parallel. By default one per '
+        'fold, up to the available cores.'))
+    threads_per_process = traits.Int(desc=(
+        'Number of threads of each process used with fold_parallel. By '
+        'default the available cores are divided among the processes.'))
 
 
 class NNUnetInferenceOutputSpec(TraitedSpec):
@@ -162,6 +343,9 @@ class NNUnetInferenceOutputSpec(TraitedSpec):
     output_folder = Directory(exist=True, desc='Output directory')
     output_file = File(exists=True, desc='First nifti file inside the'
                        ' output folder.')
+    case_files = traits.List(File(exists=True), desc=(
+        'Segmentation of each case in case_ids.'))
+    inference_time = traits.Float(desc='Time spent in the segmentation, in s.')
 
 
 class NNUnetInference(CommandLine):
@@ -170,12 +354,49 @@ class NNUnetInference(CommandLine):
     input_spec = NNUnetInferenceInputSpec
     output_spec = NNUnetInferenceOutputSpec
 
+    def _run_interface(self, runtime):
+
+        start = time.time()
+        runtime = self._predict(runtime)
+        self.inference_time = time.time()-start
+
+        return runtime
+
+    def _predict(self, runtime):
+
+        if self.inputs.fold_parallel:
+            nnunet_parallel(
+                self.inputs.model_folder, self.inputs.input_folder,
+                self._gen_outfilename(),
+                processes=defined_or_none(self.inputs.processes),
+                threads=defined_or_none(self.inputs.threads_per_process))
+            runtime.returncode = 0
+            return runtime
+        socket_path = service_socket(self.inputs.service_socket if isdefined(
+            self.inputs.service_socket) else None)
+        if socket_path is None:
+            return super()._run_interface(runtime)
+        kwargs = {}
+        for name in ['num_threads_preprocessing', 'num_threads_nifti_save']:
+            if isdefined(getattr(self.inputs, name)):
+                kwargs[name] = getattr(self.inputs, name)
+        submit('nnunet', socket_path, model_folder=self.inputs.model_folder,
+               input_folder=self.inputs.input_folder,
+               output_folder=self._gen_outfilename(), **kwargs)
+        runtime.returncode = 0
+
+        return runtime
+
     def _list_outputs(self):
         outputs = self._outputs().get()
         output_folder = self._gen_outfilename()
         outputs['output_folder'] = output_folder
         outputs['output_file'] = sorted(glob.glob(
             os.path.join(output_folder, '*.nii.gz')))[0]
+        if isdefined(self.inputs.case_ids):
+            outputs['case_files'] = [
+                os.path.join(output_folder, '{}.nii.gz'.format(case_id))
+                for case_id in self.inputs.case_ids]
 
         return outputs
     
@@ -193,3 +414,105 @@ class NNUnetInference(CommandLine):
             return self._gen_outfilename()
         return None
 
+
+
+class NNUnetMultiModelInferenceInputSpec(BaseInterfaceInputSpec):
+
+    input_folder = Directory(exists=True, mandatory=True, desc=(
+        'Input directory with one case, prepared by NNUnetPreparation.'))
+    model_folders = traits.List(Directory(exists=True), mandatory=True, desc=(
+        'Folders with the results of the nnUnet training of each model.'))
+    prefixes = traits.List(traits.Str, mandatory=True, desc=(
+        'Prefix of each model. The segmentation of each model is saved in '
+        'nnunet_inference_<prefix>.'))
+    cache_dir = traits.Str(desc=(
+        'Folder where the preprocessed case is cached. Models with the same '
+        'preprocessing plans use the same preprocessed arrays. By default '
+        'the cache is in the node folder, i.e. it is shared only by the '
+        'models of this node.'))
+    tta = traits.Bool(True, usedefault=True, desc=(
+        'Whether or not to use test time data augmentation (mirroring).'))
+    service_socket = traits.Str(desc=(
+        'Unix socket of the predictor service (see run_predictor_service.py). '
+        'If provided, or if $RADIANTS_PREDICTOR_SOCKET is set, the job is sent '
+        'to the service instead of running in this process.'))
+    fold_parallel = traits.Bool(False, usedefault=True, desc=(
+        'Whether or not to evaluate the folds in parallel on CPU, one process '
+        'per fold. The job is then never sent to the predictor service.'))
+    processes = traits.Int(desc=(
+        'Number of processes used with fold_parallel. By default one per '
+        'fold, up to the available cores.'))
+    threads_per_process = traits.Int(desc=(
+        'Number of threads of each process used with fold_parallel. By '
+        'default the available cores are divided among the processes.'))
+
+
+class NNUnetMultiModelInferenceOutputSpec(TraitedSpec):
+
+    output_files = traits.List(File(exists=True), desc=(
+        'Segmentation of each model, in the same order as model_folders.'))
+    inference_times = traits.List(traits.Float, desc=(
+        'Time spent in the segmentation with each model, in s. The shared '
+        'preprocessing is counted for the model that ran it.'))
+
+
+class NNUnetMultiModelInference(BaseInterface):
+    """nnUNet inference of several models on one case, which is preprocessed
+    only once for all the models with the same preprocessing plans.
+    """
+    input_spec = NNUnetMultiModelInferenceInputSpec
+    output_spec = NNUnetMultiModelInferenceOutputSpec
+
+    def _run_interface(self, runtime):
+
+        if len(self.inputs.model_folders) != len(self.inputs.prefixes):
+            raise Exception('{0} model folders but {1} prefixes provided!'.format(
+                len(self.inputs.model_folders), len(self.inputs.prefixes)))
+        files = self._input_files()
+        out_files = self._gen_outfilenames()
+        cache_dir = (self.inputs.cache_dir if isdefined(self.inputs.cache_dir)
+                     else os.path.abspath('preprocessed_cache'))
+        socket_path = service_socket(self.inputs.service_socket if isdefined(
+            self.inputs.service_socket) else None)
+        if socket_path is None or self.inputs.fold_parallel:
+            times = predict_models(
+                self.inputs.model_folders, files, out_files, cache_dir,
+                tta=self.inputs.tta, fold_parallel=self.inputs.fold_parallel,
+                processes=defined_or_none(self.inputs.processes),
+                threads=defined_or_none(self.inputs.threads_per_process))
+            print('Preprocessing time: {0:.1f} s, prediction time: {1:.1f} s.'
+                  .format(times['preprocessing'], times['prediction']))
+        else:
+            times = submit(
+                'nnunet_multi', socket_path,
+                model_folders=self.inputs.model_folders, files=files,
+                out_files=out_files, cache_dir=cache_dir,
+                tta=self.inputs.tta)['result']
+        self.inference_times = times['models']
+
+        return runtime
+
+    def _input_files(self):
+
+        files = sorted(glob.glob(os.path.join(self.inputs.input_folder, '*.nii.gz')))
+        cases = set(os.path.basename(f).split('.nii.gz')[0][:-5] for f in files)
+        if len(cases) != 1:
+            raise Exception('Exactly one case must be in {0}, found {1}!'.format(
+                self.inputs.input_folder, len(cases)))
+
+        return files
+
+    def _gen_outfilenames(self):
+
+        case = os.path.basename(self._input_files()[0]).split('.nii.gz')[0][:-5]
+
+        return [os.path.abspath(os.path.join(
+            'nnunet_inference_{}'.format(prefix), case+'.nii.gz'))
+                for prefix in self.inputs.prefixes]
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['output_files'] = self._gen_outfilenames()
+        outputs['inference_times'] = self.inference_times
+
+        return outputs
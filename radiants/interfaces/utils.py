@@ -1,9 +1,13 @@
 "Utility interfaces"
 import shutil
 import os
+import json
+import numpy as np
+import nibabel as nib
 from nipype.interfaces.base import (
     BaseInterface, TraitedSpec, Directory,
     traits, BaseInterfaceInputSpec)
+from nipype.interfaces.base import isdefined
 from core.utils.filemanip import split_filename
 
 
@@ -43,3 +47,338 @@ class NNUnetPreparation(BaseInterface):
         outputs['output_folder'] = os.path.abspath('data_prepared')
 
         return outputs
+
+
+class NNUnetCohortPreparationInputSpec(BaseInterfaceInputSpec):
+
+    images = traits.List(mandatory=True, desc=(
+        'Images of all the cases, case after case, each with its modalities '
+        'in the order used to train the model.'))
+    case_ids = traits.List(traits.Str, mandatory=True, desc=(
+        'Unique identifier of each case, in the same order as the images.'))
+
+
+class NNUnetCohortPreparationOutputSpec(TraitedSpec):
+
+    output_folder = Directory(exists=True, desc='Output folder prepared for nnUNet.')
+    case_ids = traits.List(traits.Str, desc='Identifier of each case.')
+
+
+class NNUnetCohortPreparation(BaseInterface):
+    """Preparation of the images of several cases in one folder, so that a
+    single nnUNet inference predicts all of them
+    """
+    input_spec = NNUnetCohortPreparationInputSpec
+    output_spec = NNUnetCohortPreparationOutputSpec
+
+    def _run_interface(self, runtime):
+
+        images = self.inputs.images
+        case_ids = self.inputs.case_ids
+        if not images:
+            raise Exception('No images provided!Please check.')
+        if len(set(case_ids)) != len(case_ids):
+            raise Exception('The case identifiers must be unique!')
+        if len(images) % len(case_ids):
+            raise Exception('{0} images cannot be split among {1} cases!'.format(
+                len(images), len(case_ids)))
+        n_modalities = len(images)//len(case_ids)
+        new_dir = os.path.abspath('data_prepared')
+        os.mkdir(new_dir)
+        for i, image in enumerate(images):
+            _, _, ext = split_filename(image)
+            shutil.copy2(image, os.path.join(new_dir, '{0}_{1}{2}'.format(
+                case_ids[i//n_modalities], str(i % n_modalities).zfill(4), ext)))
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['output_folder'] = os.path.abspath('data_prepared')
+        outputs['case_ids'] = self.inputs.case_ids
+
+        return outputs
+
+
+class BrainBoundingBoxCropInputSpec(BaseInterfaceInputSpec):
+
+    images = traits.List(traits.File(exists=True), mandatory=True, desc=(
+        'Images to be cropped around the brain, all in the same space.'))
+    mask = traits.File(exists=True, mandatory=True, desc=(
+        'Brain mask (e.g. from HD-BET) in the same space as the images.'))
+    margin = traits.Float(10.0, usedefault=True, desc=(
+        'Margin (in mm) added around the brain bounding box.'))
+    outdir = Directory('cropped', usedefault=True,
+                       desc='Folder to store the cropped images.')
+
+
+class BrainBoundingBoxCropOutputSpec(TraitedSpec):
+
+    cropped_images = traits.List(traits.File(exists=True), desc=(
+        'Images cropped around the brain, in the same order as images.'))
+    bounding_box = traits.List(desc=(
+        'Bounding box, as [[x0, x1], [y0, y1], [z0, z1]] voxels of the images.'))
+    voxel_ratio = traits.Float(desc=(
+        'Number of voxels of the cropped images divided by the number of '
+        'voxels of the original ones.'))
+
+
+class BrainBoundingBoxCrop(BaseInterface):
+    """Crop of the images to the bounding box (plus a margin) of the brain
+    mask, so that the segmentation networks do not run their sliding window
+    over the background.
+    """
+    input_spec = BrainBoundingBoxCropInputSpec
+    output_spec = BrainBoundingBoxCropOutputSpec
+
+    def _run_interface(self, runtime):
+
+        outdir = os.path.abspath(self.inputs.outdir)
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        mask = nib.load(self.inputs.mask)
+        mask_data = np.asanyarray(mask.dataobj)
+        spacing = np.asarray(mask.header.get_zooms()[:3])
+
+        coords = np.nonzero(mask_data)
+        if coords[0].size == 0:
+            print('The brain mask {} is empty, the whole images will be '
+                  'segmented.'.format(self.inputs.mask))
+            box = [[0, s] for s in mask_data.shape[:3]]
+        else:
+            margin = np.ceil(self.inputs.margin/spacing).astype(int)
+            box = [[int(max(0, c.min()-m)), int(min(s, c.max()+1+m))]
+                   for c, m, s in zip(coords, margin, mask_data.shape)]
+        offset = np.asarray([b[0] for b in box], dtype=np.float64)
+
+        self.cropped_images = []
+        for image in self.inputs.images:
+            ref = nib.load(image)
+            if (ref.shape[:3] != mask_data.shape[:3]
+                    or not np.allclose(ref.affine, mask.affine, atol=1e-3)):
+                raise Exception('The brain mask {0} is not in the same space as '
+                                '{1}!'.format(self.inputs.mask, image))
+            data = np.asanyarray(ref.dataobj)
+            cropped = data[box[0][0]:box[0][1], box[1][0]:box[1][1],
+                           box[2][0]:box[2][1]]
+            affine = ref.affine.copy()
+            affine[:3, 3] = np.dot(affine[:3, :3], offset) + affine[:3, 3]
+            _, fname, ext = split_filename(image)
+            out_file = os.path.join(outdir, fname+ext)
+            nib.save(nib.Nifti1Image(cropped, affine, header=ref.header),
+                     out_file)
+            self.cropped_images.append(out_file)
+
+        self.bounding_box = box
+        full = np.prod(mask_data.shape[:3])
+        self.voxel_ratio = float(np.prod([b[1]-b[0] for b in box]))/full
+        print('Brain crop of {0}: {1} -> {2} voxels per image ({3:.1f}%).'.format(
+            self.inputs.mask, full, int(round(full*self.voxel_ratio)),
+            self.voxel_ratio*100))
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['cropped_images'] = self.cropped_images
+        outputs['bounding_box'] = self.bounding_box
+        outputs['voxel_ratio'] = self.voxel_ratio
+
+        return outputs
+
+
+class BoundingBoxPasteInputSpec(BaseInterfaceInputSpec):
+
+    in_file = traits.File(exists=True, mandatory=True, desc=(
+        'Segmentation of the cropped images.'))
+    reference = traits.File(exists=True, mandatory=True, desc=(
+        'One of the original, not cropped, images.'))
+    bounding_box = traits.List(mandatory=True, desc=(
+        'Bounding box used to crop the images (see BrainBoundingBoxCrop).'))
+    voxel_ratio = traits.Float(desc=(
+        'Voxel ratio of the crop. If given with inference_time, the time saved '
+        'by the crop is estimated and printed.'))
+    inference_time = traits.Float(desc=(
+        'Time spent in the segmentation of the cropped images, as measured by '
+        'the inference interface.'))
+
+
+class BoundingBoxPasteOutputSpec(TraitedSpec):
+
+    out_file = traits.File(exists=True, desc=(
+        'Segmentation in the space of the original images, with the same '
+        'name as in_file.'))
+
+
+class BoundingBoxPaste(BaseInterface):
+    """Segmentation of cropped images pasted back into the original
+    geometry, i.e. with the grid and header of the reference image.
+    """
+    input_spec = BoundingBoxPasteInputSpec
+    output_spec = BoundingBoxPasteOutputSpec
+
+    def _run_interface(self, runtime):
+
+        box = self.inputs.bounding_box
+        _, fname, ext = split_filename(self.inputs.in_file)
+        self.out_file = os.path.abspath(fname+ext)
+        ref = nib.load(self.inputs.reference)
+        seg = nib.load(self.inputs.in_file)
+        cropped = np.asanyarray(seg.dataobj)
+        data = np.zeros(ref.shape[:3], dtype=cropped.dtype)
+        data[box[0][0]:box[0][1], box[1][0]:box[1][1],
+             box[2][0]:box[2][1]] = cropped
+
+        header = ref.header.copy()
+        header.set_data_dtype(seg.get_data_dtype())
+        header.set_slope_inter(None, None)
+        nib.save(nib.Nifti1Image(data, ref.affine, header=header), self.out_file)
+
+        if isdefined(self.inputs.voxel_ratio) and isdefined(self.inputs.inference_time):
+            # the segmentation time of the whole images is assumed linear in
+            # the number of voxels
+            elapsed = self.inputs.inference_time
+            print('{0} segmented in {1:.1f} s on {2:.1f}% of the voxels, about '
+                  '{3:.1f} s saved by the brain crop (linear estimate).'.format(
+                      self.inputs.in_file, elapsed, self.inputs.voxel_ratio*100,
+                      elapsed*(1/self.inputs.voxel_ratio-1)))
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = self.out_file
+
+        return outputs
+
+
+class ApplyBrainMaskInputSpec(BaseInterfaceInputSpec):
+
+    in_file = traits.File(exists=True, mandatory=True, desc='Image to be masked.')
+    mask = traits.File(exists=True, mandatory=True, desc=(
+        'Brain mask on the same grid as in_file (e.g. the mask of another '
+        'sequence resampled into the space of in_file).'))
+    out_name = traits.Str(mandatory=True, desc=(
+        'Name (without extension) of the brain extracted image. The mask is '
+        'saved as <out_name>_mask, as HD-BET does.'))
+
+
+class ApplyBrainMaskOutputSpec(TraitedSpec):
+
+    out_file = traits.File(exists=True, desc='Brain extracted image.')
+    out_mask = traits.File(exists=True, desc='Brain mask.')
+
+
+class ApplyBrainMask(BaseInterface):
+    """Brain extraction of one image with a given mask, equivalent to the
+    last step of HD-BET (the voxels outside the mask are set to 0).
+    """
+    input_spec = ApplyBrainMaskInputSpec
+    output_spec = ApplyBrainMaskOutputSpec
+
+    def _run_interface(self, runtime):
+
+        _, _, ext = split_filename(self.inputs.in_file)
+        self.out_file = os.path.abspath(self.inputs.out_name+ext)
+        self.out_mask = os.path.abspath(self.inputs.out_name+'_mask'+ext)
+        image = nib.load(self.inputs.in_file)
+        mask = nib.load(self.inputs.mask)
+        if (mask.shape[:3] != image.shape[:3]
+                or not np.allclose(mask.affine, image.affine, atol=1e-3)):
+            raise Exception('The mask {0} is not on the grid of {1}!'.format(
+                self.inputs.mask, self.inputs.in_file))
+
+        brain = np.asanyarray(mask.dataobj) > 0.5
+        data = np.asanyarray(image.dataobj).copy()
+        data[~brain] = 0
+        nib.save(nib.Nifti1Image(data, image.affine, header=image.header),
+                 self.out_file)
+        header = image.header.copy()
+        header.set_data_dtype(np.uint8)
+        header.set_slope_inter(None, None)
+        nib.save(nib.Nifti1Image(brain.astype(np.uint8), image.affine,
+                                 header=header), self.out_mask)
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = self.out_file
+        outputs['out_mask'] = self.out_mask
+
+        return outputs
+
+
+class BrainMaskCheckInputSpec(BaseInterfaceInputSpec):
+
+    in_file = traits.File(exists=True, mandatory=True, desc=(
+        'Image brain extracted with a propagated mask.'))
+    in_mask = traits.File(exists=True, mandatory=True, desc='Propagated mask.')
+    bet_file = traits.File(exists=True, mandatory=True, desc=(
+        'Same image brain extracted with HD-BET.'))
+    bet_mask = traits.File(exists=True, mandatory=True, desc='HD-BET mask.')
+    threshold = traits.Float(0.9, usedefault=True, desc=(
+        'Minimum Dice coefficient between the two masks for the propagated '
+        'one to be used.'))
+
+
+class BrainMaskCheckOutputSpec(TraitedSpec):
+
+    out_file = traits.File(exists=True, desc=(
+        'Brain extracted image: the propagated one if the Dice coefficient is '
+        'at least threshold, the HD-BET one otherwise.'))
+    out_mask = traits.File(exists=True, desc='Mask of out_file.')
+    dice = traits.Float(desc='Dice coefficient between the two masks.')
+    fallback = traits.Bool(desc='Whether or not the HD-BET outputs are used.')
+    report = traits.File(exists=True, desc=(
+        'JSON file with the Dice coefficient, the threshold and the fallback '
+        'flag.'))
+
+
+class BrainMaskCheck(BaseInterface):
+    """Comparison of a propagated brain mask with the HD-BET mask of the
+    same image. When their Dice coefficient is below the threshold, the
+    propagation is flagged and the HD-BET outputs are used instead.
+    """
+    input_spec = BrainMaskCheckInputSpec
+    output_spec = BrainMaskCheckOutputSpec
+
+    def _run_interface(self, runtime):
+
+        propagated = np.asanyarray(nib.load(self.inputs.in_mask).dataobj) > 0.5
+        bet = np.asanyarray(nib.load(self.inputs.bet_mask).dataobj) > 0.5
+        if propagated.shape != bet.shape:
+            raise Exception('The masks {0} and {1} have different shapes!'.format(
+                self.inputs.in_mask, self.inputs.bet_mask))
+        total = propagated.sum() + bet.sum()
+        self.dice = float(2*np.logical_and(propagated, bet).sum()/total) if total else 1.0
+        self.fallback = self.dice < self.inputs.threshold
+        if self.fallback:
+            print('WARNING: Dice coefficient of {0:.3f} between the propagated mask '
+                  '{1} and the HD-BET mask, below {2}. The HD-BET outputs will be '
+                  'used.'.format(self.dice, self.inputs.in_mask, self.inputs.threshold))
+        else:
+            print('Dice coefficient of {0:.3f} between the propagated mask {1} and '
+                  'the HD-BET mask.'.format(self.dice, self.inputs.in_mask))
+
+        _, fname, _ = split_filename(self.inputs.in_mask)
+        self.report = os.path.abspath(fname+'_check.json')
+        with open(self.report, 'w') as f:
+            json.dump({'dice': self.dice, 'threshold': self.inputs.threshold,
+                       'fallback': bool(self.fallback)}, f, indent=4)
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        if self.fallback:
+            outputs['out_file'] = self.inputs.bet_file
+            outputs['out_mask'] = self.inputs.bet_mask
+        else:
+            outputs['out_file'] = self.inputs.in_file
+            outputs['out_mask'] = self.inputs.in_mask
+        outputs['dice'] = self.dice
+        outputs['fallback'] = bool(self.fallback)
+        outputs['report'] = self.report
+
+        return outputs
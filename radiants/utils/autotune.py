@@ -0,0 +1,117 @@
+"Per-host tuning of the batch size and TensorFlow threads used for the lung inference"
+import os
+import re
+import json
+import time
+import socket
+import itertools
+import multiprocessing
+import numpy as np
+from radiants.utils.model_cache import MODEL_CACHE
+
+
+def profile_path(profile_dir=None):
+    """Function to return the profile file of this host. By default it is
+    saved in $RADIANTS_PROFILE_DIR or, if not set, in ~/.radiants.
+    """
+    if profile_dir is None:
+        profile_dir = os.environ.get(
+            'RADIANTS_PROFILE_DIR', os.path.join(os.path.expanduser('~'),
+                                                 '.radiants'))
+
+    return os.path.join(profile_dir, 'inference_profile_{}.json'.format(
+        socket.gethostname()))
+
+
+def profile_key(engine, patch_size, workers=1):
+
+    return '{0}_{1}x{2}_{3}w'.format(engine, patch_size[0], patch_size[1], workers)
+
+
+def benchmark(load_model, batch_sizes, threads, input_size=(96, 96, 1),
+              n_patches=512):
+    """Function to measure the throughput (patches/s) of the network
+    returned by load_model for each batch size and (intra, inter) number of
+    threads, on a synthetic tensor of input_size patches.
+    """
+    tensor = np.random.RandomState(42).uniform(
+        0, 1, (n_patches,)+tuple(input_size)).astype(np.float16)
+    results = []
+    for intra, inter in threads:
+        MODEL_CACHE.configure_threads(intra, inter)
+        model = load_model()
+        for batch_size in batch_sizes:
+            # the first batch includes the graph set-up
+            model.predict(tensor[:batch_size], batch_size=batch_size)
+            start = time.time()
+            model.predict(tensor, batch_size=batch_size)
+            speed = n_patches/(time.time()-start)
+            print('Batch size {0:4d}, {1:2d} intra-op and {2:2d} inter-op threads: '
+                  '{3:.1f} patches/s.'.format(batch_size, intra, inter, speed))
+            results.append({'batch_size': batch_size, 'intra_op_threads': intra,
+                            'inter_op_threads': inter, 'patches_per_second': speed})
+
+    return results
+
+
+def thread_grid(workers=1, intra_op_threads=None, inter_op_threads=(1, 2)):
+    """Function to return the (intra, inter) thread pairs to test, using at
+    most the cores of this host divided by the number of workers (e.g.
+    nipype processes) running the inference at the same time.
+    """
+    cores = max(multiprocessing.cpu_count()//workers, 1)
+    if intra_op_threads is None:
+        intra_op_threads = sorted(set([2**i for i in range(cores.bit_length())]
+                                      + [cores]))
+
+    return [(intra, inter) for intra, inter in itertools.product(
+        intra_op_threads, inter_op_threads) if intra*inter <= max(cores, 2)]
+
+
+def save_profile(results, engine, patch_size, workers=1, profile_dir=None):
+    """Function to add the benchmark results to the profile of this host.
+    The fastest configuration is stored as "best" and the host information
+    is saved too, so the profiles of different hosts can be compared.
+    """
+    path = profile_path(profile_dir)
+    profile = {}
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            profile = json.load(f)
+    profile['host'] = socket.gethostname()
+    profile['cpu_count'] = multiprocessing.cpu_count()
+    profile[profile_key(engine, patch_size, workers)] = {
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'best': max(results, key=lambda x: x['patches_per_second']),
+        'results': results}
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        json.dump(profile, f, indent=4)
+
+    return path
+
+
+def load_profile(engine, patch_size, workers=1, profile_dir=None):
+    """Function to return the best configuration (batch size, threads and
+    throughput) of this host for the engine and patch size, if tuned. If
+    this number of workers was not tuned, the closest tuned one is used
+    (the larger one if two are equally close, so the cores are not
+    oversubscribed).
+    """
+    path = profile_path(profile_dir)
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as f:
+        profile = json.load(f)
+    prefix = profile_key(engine, patch_size, workers).rsplit('_', 1)[0]
+    tuned = [int(key[len(prefix)+1:-1]) for key in profile
+             if re.match(r'^{}_\d+w$'.format(re.escape(prefix)), key)]
+    if not tuned:
+        return None
+    closest = min(tuned, key=lambda x: (abs(x-workers), -x))
+    if closest != workers:
+        print('No inference profile tuned for {0} workers, the one tuned for '
+              '{1} workers will be used.'.format(workers, closest))
+
+    return profile[profile_key(engine, patch_size, closest)]['best']
@@ -1,7 +1,12 @@
 import numpy as np
 import os
 import glob
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import nrrd
+from scipy import ndimage
 
 
 def normalize(image, method='zscore'):
@@ -25,20 +30,8 @@ def normalize(image, method='zscore'):
     return res
 
 
-def load_data_2D(data_dir, data_type, data_list=[], array=None, mb=[], bs=None, init=None, prediction=False,
-                 img_size=(192, 192), patch_size=(96, 96), binarize=False, normalization=True, result_dict=None):
-
-    if array is not None:
-        data_list = [1]
-    else:
-        if data_list:
-            data_list = data_list
-        elif bs is not None and init is not None:
-            data_list = sorted(glob.glob(os.path.join(data_dir, data_type)))[init:bs]
-        else:
-            data_list = sorted(glob.glob(os.path.join(data_dir, data_type)))
-
-
+def patch_tiling(img_size, patch_size=(96, 96), mb=[]):
+    "Function to compute the (possibly overlapping) patch grid of a 2D image"
     patch_width = patch_size[0]
     patch_height = patch_size[1]
 
@@ -69,6 +62,49 @@ def load_data_2D(data_dir, data_type, data_list=[], array=None, mb=[], bs=None,
         yy.append([indY, indY+patch_height])
         indY = indY + overlapY
 
+    return xx, yy
+
+
+def plan_tiling(img_size, patch_size=(96, 96), min_overlap=0):
+    """Function to compute the smallest grid of patches covering a 2D image
+    with at least min_overlap voxels of overlap between neighbouring
+    patches. The patches are spread evenly, the first one starts at 0 and
+    the last one ends at the image border. Images smaller than the patch
+    are covered by one (padded) patch, as in patch_tiling.
+    """
+    grid = []
+    for size, patch in zip(img_size, patch_size):
+        if min_overlap >= patch:
+            raise Exception('The overlap ({0}) must be smaller than the patch '
+                            'size ({1})!'.format(min_overlap, patch))
+        if size <= patch:
+            grid.append([[0, patch]])
+            continue
+        n = int(np.ceil(float(size-min_overlap)/(patch-min_overlap)))
+        starts = [k*(size-patch)//(n-1) for k in range(n)]
+        grid.append([[start, start+patch] for start in starts])
+
+    return grid[0], grid[1]
+
+
+def load_data_2D(data_dir, data_type, data_list=[], array=None, mb=[], bs=None, init=None, prediction=False,
+                 img_size=(192, 192), patch_size=(96, 96), binarize=False, normalization=True, result_dict=None):
+
+    if array is not None:
+        data_list = [1]
+    else:
+        if data_list:
+            data_list = data_list
+        elif bs is not None and init is not None:
+            data_list = sorted(glob.glob(os.path.join(data_dir, data_type)))[init:bs]
+        else:
+            data_list = sorted(glob.glob(os.path.join(data_dir, data_type)))
+
+
+    patch_width = patch_size[0]
+    patch_height = patch_size[1]
+    xx, yy = patch_tiling(img_size, patch_size, mb)
+
     final_array = None
 
     for index in range(len(data_list)):
@@ -125,3 +161,419 @@ def load_data_2D(data_dir, data_type, data_list=[], array=None, mb=[], bs=None,
 
 
     return final_array, results_dict
+
+
+def body_mask(slices, threshold=0.15, margin=8):
+    """Function to compute a coarse body mask of a stack of normalized axial
+    slices (first dimension). Each slice is thresholded, its holes (i.e. the
+    lungs) are filled and the result is dilated by margin pixels.
+    """
+    mask = np.asarray(slices) > threshold
+    for n in range(mask.shape[0]):
+        mask[n] = ndimage.binary_fill_holes(mask[n])
+    if margin:
+        mask = ndimage.maximum_filter(mask, size=(1, 2*margin+1, 2*margin+1))
+
+    return mask
+
+
+def sliding_patches(slices, patch_size=(96, 96)):
+    """Function to return a read-only strided view of all the patches of a
+    stack of slices, with shape (slices, y positions, x positions,
+    patch_size[0], patch_size[1]), so that the patch starting at (x, y) is
+    view[:, y, x]
+    """
+    s_z, s_x, s_y = slices.strides
+    n, size_x, size_y = slices.shape
+
+    return np.lib.stride_tricks.as_strided(
+        slices, shape=(n, size_y-patch_size[1]+1, size_x-patch_size[0]+1,
+                       patch_size[0], patch_size[1]),
+        strides=(s_z, s_y, s_x, s_x, s_y), writeable=False)
+
+
+def load_volume_2D(volume, patch_size=(96, 96), mb=None, normalization=True,
+                   binarize=False, dtype=np.float16, slab=16,
+                   body_threshold=None, body_margin=8, out_file=None,
+                   min_overlap=None):
+    """Function to extract the 2D patches of every axial slice of a 3D volume
+    in one go. The output is equivalent to calling load_data_2D (with
+    prediction=True) on each slice and concatenating the results, but the
+    tiling is computed only once, the normalization is done in float32 on
+    slabs of slices and the patches are gathered with a strided view
+    directly into one preallocated array.
+    If body_threshold is not None, the patches that do not overlap the body
+    mask (see body_mask) of their slice are flagged as background and
+    image_info['foreground'] is a boolean array with one entry per patch.
+    volume can also be a SlabReader, in which case only slab slices at a time
+    are read from disk, and with out_file the patches are written directly
+    to that .npy file (returned as a memory-mapped array).
+    If min_overlap is not None, the patch grid is computed by plan_tiling
+    instead of patch_tiling (mb is then ignored).
+    """
+    streaming = hasattr(volume, 'slab')
+    if not streaming:
+        volume = np.asanyarray(volume)
+        if volume.ndim == 2:
+            volume = volume[:, :, np.newaxis]
+    if mb is None:
+        mb = []
+    img_size = volume.shape[:2]
+    n_slices = volume.shape[2]
+    patch_width = patch_size[0]
+    patch_height = patch_size[1]
+    if min_overlap is None:
+        xx, yy = patch_tiling(img_size, patch_size, mb)
+    else:
+        xx, yy = plan_tiling(img_size, patch_size, min_overlap)
+    n_patches = len(xx)*len(yy)
+
+    delta_x = (patch_width - img_size[0]) if img_size[0] < patch_width else 0
+    delta_y = (patch_height - img_size[1]) if img_size[1] < patch_height else 0
+    slab = max(1, min(slab, n_slices))
+    # the working buffers follow the memory layout of the input (nibabel and
+    # pynrrd return Fortran ordered arrays) and the padded region is never
+    # written, so it stays 0 as in load_data_2D
+    if streaming:
+        order = 'F'
+    else:
+        order = 'F' if volume.strides[0] <= volume.strides[1] else 'C'
+    buffer_shape = (img_size[0]+delta_x, img_size[1]+delta_y, slab)
+    work = np.moveaxis(np.zeros(buffer_shape, dtype=np.float32, order=order),
+                       2, 0)
+    buffer = np.moveaxis(np.zeros(buffer_shape, dtype=dtype, order=order),
+                         2, 0)
+    # start of each patch, the grid does not need to be regular
+    start_x = np.array([i[0] for i in xx])
+    start_y = np.array([j[0] for j in yy])
+
+    final_shape = (n_slices*n_patches, patch_width, patch_height, 1)
+    if out_file is not None:
+        final_array = np.lib.format.open_memmap(
+            out_file, mode='w+', dtype=dtype, shape=final_shape)
+    else:
+        final_array = np.empty(final_shape, dtype=dtype)
+    foreground = []
+    for z0 in range(0, n_slices, slab):
+        z1 = min(z0+slab, n_slices)
+        n = z1 - z0
+        if streaming:
+            sub = np.moveaxis(volume.slab(z0, z1), 2, 0)
+        else:
+            sub = np.moveaxis(volume[:, :, z0:z1], 2, 0)
+        work_sub = work[:n, delta_x:, delta_y:]
+        if normalization:
+            m = sub.min(axis=(1, 2), keepdims=True).astype(np.float32)
+            M = sub.max(axis=(1, 2), keepdims=True).astype(np.float32)
+            # constant slices are left untouched, as in normalize()
+            offset = np.where(M - m > 0, m, 0).astype(np.float32)
+            scale = np.where(M - m > 0, M - m, 1).astype(np.float32)
+            np.subtract(sub, offset, out=work_sub, casting='unsafe')
+            np.divide(work[:n], scale, out=buffer[:n], casting='unsafe')
+        else:
+            np.copyto(buffer[:n, delta_x:, delta_y:], sub, casting='unsafe')
+        if binarize:
+            buffer[:n][buffer[:n] != 0] = 1
+        patches = sliding_patches(buffer[:n], patch_size)[
+            :, start_y[:, np.newaxis], start_x[np.newaxis, :]]
+        final_array[z0*n_patches:z1*n_patches, :, :, 0] = patches.reshape(
+            (-1, patch_width, patch_height))
+        if body_threshold is not None:
+            body = body_mask(buffer[:n], threshold=body_threshold,
+                             margin=body_margin)
+            body = sliding_patches(body, patch_size)[
+                :, start_y[:, np.newaxis], start_x[np.newaxis, :]]
+            foreground.append(body.any(axis=(3, 4)).ravel())
+    if out_file is not None:
+        final_array.flush()
+
+    image_info = {}
+    image_info['image_dim'] = tuple(img_size)
+    image_info['indexes'] = [xx, yy]
+    image_info['deltas'] = [delta_x, delta_y]
+    image_info['patches'] = n_patches
+    image_info['slices'] = n_slices
+    image_info['patch_size'] = (patch_width, patch_height)
+    if body_threshold is not None:
+        image_info['foreground'] = np.concatenate(foreground)
+
+    return final_array, image_info
+
+
+def patch_weights(patch_size=(96, 96), blending='mean', sigma_scale=1./8):
+    "Function to compute the weights used to blend overlapping patches"
+    if blending == 'mean':
+        weights = np.ones(patch_size, dtype=np.float32)
+    elif blending == 'gaussian':
+        coords = [np.arange(p) - (p - 1)/2. for p in patch_size]
+        sigmas = [p*sigma_scale for p in patch_size]
+        weights = np.exp(-0.5*((coords[0][:, np.newaxis]/sigmas[0])**2
+                               + (coords[1][np.newaxis, :]/sigmas[1])**2))
+        weights = weights/weights.max()
+        # the patch borders must still count where they are the only coverage
+        weights = np.maximum(weights, 1e-3).astype(np.float32)
+    else:
+        raise NotImplementedError('Blending method called "{}" has not been implemented yet!'.format(blending))
+
+    return weights
+
+
+def reconstruct_volume_2D(patches, dims, indexes, deltas, blending='mean'):
+    """Function to put the 2D patches created by load_volume_2D (or
+    load_data_2D) back together. Overlapping patches are accumulated slice
+    by slice in a float32 sum buffer, weighted by patch_weights, and divided
+    by the sum of the weights, which only depends on the patch grid. Voxels
+    not covered by any patch are set to 0. The output has shape
+    (slices, dims[0], dims[1]).
+    """
+    xx, yy = indexes
+    n_patches = len(xx)*len(yy)
+    patch_width, patch_height = patches.shape[1:3]
+    patches = patches.reshape((-1, n_patches, patch_width, patch_height))
+    weights = patch_weights((patch_width, patch_height), blending=blending)
+    weights = weights[deltas[0]:, deltas[1]:]
+
+    final_image = np.zeros((patches.shape[0], dims[0], dims[1]),
+                           dtype=np.float32)
+    norm = np.zeros((dims[0], dims[1]), dtype=np.float32)
+    k = 0
+    for j in yy:
+        for i in xx:
+            target = final_image[:, i[0]:i[1], j[0]:j[1]]
+            size_x, size_y = target.shape[1:]
+            tile = patches[:, k, deltas[0]:deltas[0]+size_x,
+                           deltas[1]:deltas[1]+size_y]
+            w = weights[:size_x, :size_y]
+            if blending == 'mean':
+                target += tile
+            else:
+                target += tile*w
+            norm[i[0]:i[1], j[0]:j[1]] += w
+            k += 1
+    norm[norm == 0] = 1
+    final_image /= norm
+
+    return final_image
+
+
+def nearest_indices(n_in, n_out):
+    """Function to return, for each of the n_out voxels of one resized axis,
+    the input voxel used by nearest neighbour interpolation. The coordinates
+    and the rounding (half up) are the ones of skimage resize, so that ties
+    are broken in the same way.
+    """
+    zoom = n_in/n_out
+    coords = (np.arange(n_out)+0.5)*zoom - 0.5
+
+    return np.clip(np.floor(coords+0.5).astype(int), 0, n_in-1)
+
+
+class TensorStack(object):
+    """Read-only concatenation, along the first axis, of several patch
+    tensors (e.g. memory-mapped .npy files of different images). Only the
+    requested patches are read and copied when it is indexed with a slice or
+    an array of indexes.
+    """
+    def __init__(self, tensors):
+
+        self.tensors = tensors
+        self.offsets = np.cumsum([0]+[t.shape[0] for t in tensors])
+        self.shape = (int(self.offsets[-1]),) + tuple(tensors[0].shape[1:])
+        self.dtype = tensors[0].dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, indexes):
+
+        if isinstance(indexes, slice):
+            start, stop, _ = indexes.indices(self.shape[0])
+            pieces = []
+            for n, tensor in enumerate(self.tensors):
+                begin = max(start, self.offsets[n]) - self.offsets[n]
+                end = min(stop, self.offsets[n+1]) - self.offsets[n]
+                if end > begin:
+                    pieces.append(tensor[begin:end])
+            if not pieces:
+                return np.empty((0,)+self.shape[1:], dtype=self.dtype)
+            return np.concatenate(pieces, axis=0)
+
+        indexes = np.asarray(indexes)
+        out = np.empty((indexes.shape[0],)+self.shape[1:], dtype=self.dtype)
+        member = np.searchsorted(self.offsets, indexes, side='right') - 1
+        for n in np.unique(member):
+            selected = member == n
+            out[selected] = self.tensors[n][indexes[selected]-self.offsets[n]]
+
+        return out
+
+
+class PatchLoader(object):
+    """Batched loader of the 2D patches of a list of NRRD files (and of the
+    corresponding masks), tiled as in load_data_2D. The files are read and
+    tiled by a pool of workers threads in a background thread, which fills
+    preallocated batches and keeps up to prefetch of them ready, so the
+    network does not wait for the disk.
+    The loader is a generator of x (or (x, y) if masks are given) batches
+    that can be passed to Keras fit_generator/predict_generator, with
+    steps=len(loader) and workers=0 (the prefetching is done here). With
+    loop=True the batches are generated epoch after epoch, with
+    loop=False only once; with shuffle=True the file order changes at each
+    epoch.
+    """
+    def __init__(self, data_dir=None, data_type=None, mask_type=None,
+                 data_list=None, mask_list=None, batch_size=32,
+                 img_size=(192, 192), patch_size=(96, 96), mb=None,
+                 normalization=True, dtype=np.float32, shuffle=False,
+                 loop=True, prefetch=4, workers=2, seed=None):
+
+        if data_list is None:
+            data_list = sorted(glob.glob(os.path.join(data_dir, data_type)))
+        if mask_list is None and mask_type is not None:
+            mask_list = sorted(glob.glob(os.path.join(data_dir, mask_type)))
+        if mask_list is not None and len(mask_list) != len(data_list):
+            raise Exception('Found {0} images but {1} masks!'.format(
+                len(data_list), len(mask_list)))
+        if not data_list:
+            raise Exception('No images to load!')
+        self.data_list = data_list
+        self.mask_list = mask_list
+        self.batch_size = batch_size
+        self.img_size = img_size
+        self.patch_size = patch_size
+        self.normalization = normalization
+        self.dtype = dtype
+        self.shuffle = shuffle
+        self.loop = loop
+        self.prefetch = prefetch
+        self.workers = workers
+        self.rng = np.random.RandomState(seed)
+        # patch_tiling fills mb, so the same grid is used for every file
+        self.mb = [] if mb is None else list(mb)
+        xx, yy = patch_tiling(img_size, patch_size, self.mb)
+        self.file_patches = []
+        for data_path in data_list:
+            sizes = nrrd.read_header(data_path)['sizes']
+            self.file_patches.append(
+                len(xx)*len(yy)*int(np.prod(sizes[2:], dtype=int)))
+        self.n_patches = sum(self.file_patches)
+        self._iterator = None
+        self._stop = threading.Event()
+
+    def __len__(self):
+        "Number of batches per epoch"
+        return int(np.ceil(float(self.n_patches)/self.batch_size))
+
+    def read_file(self, index):
+        "Function to read and tile one image (and its mask)"
+        x, _ = load_data_2D(None, None, data_list=[self.data_list[index]],
+                            mb=list(self.mb), img_size=self.img_size,
+                            patch_size=self.patch_size,
+                            normalization=self.normalization)
+        if self.mask_list is None:
+            return x, None
+        y, _ = load_data_2D(None, None, data_list=[self.mask_list[index]],
+                            mb=list(self.mb), img_size=self.img_size,
+                            patch_size=self.patch_size, binarize=True,
+                            normalization=self.normalization)
+        if y.shape[0] != x.shape[0]:
+            raise Exception('{0} and {1} have different sizes!'.format(
+                self.data_list[index], self.mask_list[index]))
+
+        return x, y
+
+    def new_batch(self):
+
+        shape = (self.batch_size,)+tuple(self.patch_size)+(1,)
+        x = np.empty(shape, dtype=self.dtype)
+        y = np.empty(shape, dtype=self.dtype) if self.mask_list is not None else None
+
+        return x, y
+
+    def _put(self, batches, item):
+        "Function to wait for a free prefetch slot, unless the loader is closed"
+        while not self._stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _fill(self, batches, order):
+        "Function to read the files in order and split their patches in batches"
+        with ThreadPoolExecutor(self.workers) as pool:
+            pending = deque()
+            files = iter(order)
+            for index in files:
+                pending.append(pool.submit(self.read_file, index))
+                if len(pending) >= self.workers+1:
+                    break
+            x_batch, y_batch = self.new_batch()
+            filled = 0
+            while pending and not self._stop.is_set():
+                x, y = pending.popleft().result()
+                index = next(files, None)
+                if index is not None:
+                    pending.append(pool.submit(self.read_file, index))
+                start = 0
+                while start < x.shape[0]:
+                    n = min(x.shape[0]-start, self.batch_size-filled)
+                    x_batch[filled:filled+n] = x[start:start+n]
+                    if y_batch is not None:
+                        y_batch[filled:filled+n] = y[start:start+n]
+                    filled += n
+                    start += n
+                    if filled == self.batch_size:
+                        self._put(batches, (x_batch, y_batch))
+                        x_batch, y_batch = self.new_batch()
+                        filled = 0
+            for future in pending:
+                future.cancel()
+            if filled:
+                self._put(batches, (x_batch[:filled], None if y_batch is None
+                                    else y_batch[:filled]))
+
+    def _produce(self, batches):
+
+        try:
+            while not self._stop.is_set():
+                order = (self.rng.permutation(len(self.data_list)) if self.shuffle
+                         else np.arange(len(self.data_list)))
+                self._fill(batches, order)
+                if not self.loop:
+                    break
+            self._put(batches, None)
+        except Exception as e:
+            self._put(batches, e)
+
+    def __iter__(self):
+
+        self._stop.clear()
+        batches = queue.Queue(maxsize=self.prefetch)
+        thread = threading.Thread(target=self._produce, args=(batches,))
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                x, y = item
+                yield x if y is None else (x, y)
+        finally:
+            self._stop.set()
+            thread.join()
+
+    def __next__(self):
+
+        if self._iterator is None:
+            self._iterator = iter(self)
+        return next(self._iterator)
+
+    def close(self):
+        "Function to stop the background reading"
+        if self._iterator is not None:
+            self._iterator.close()
+            self._iterator = None
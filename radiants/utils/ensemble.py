@@ -0,0 +1,200 @@
+"""Fold-parallel CPU execution of the HD-BET and nnU-Net ensembles. The
+members of the ensemble (the 5 HD-BET parameter sets in accurate mode, the
+nnU-Net folds) are evaluated by a pool of processes, each one with a fixed
+number of threads and pinned to its own cores, instead of one after the
+other in a single process. The softmax of the members are then averaged in
+the same order as the sequential evaluation does.
+"""
+import os
+import glob
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+
+THREAD_VARIABLES = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+
+# networks and checkpoints loaded by each worker process
+_MEMBERS = {}
+
+
+def pool_size(n_members, processes=None, threads=None):
+    """Function to return the number of processes and threads per process
+    used for an ensemble of n_members: by default one process per member, up
+    to the available cores, which are divided among the processes.
+    """
+    cores = multiprocessing.cpu_count()
+    if processes is None:
+        processes = min(n_members, max(cores//(threads or 1), 1))
+    if threads is None:
+        threads = max(cores//processes, 1)
+
+    return processes, threads
+
+
+def pin_worker(counter, threads):
+    "Function to set the threads of one worker and to pin it to its own cores"
+    for name in THREAD_VARIABLES:
+        os.environ[name] = str(threads)
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    if hasattr(os, 'sched_setaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        if len(cores) >= (index+1)*threads:
+            os.sched_setaffinity(0, cores[index*threads:(index+1)*threads])
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ModuleNotFoundError:
+        pass
+
+
+def ensemble_pool(processes, threads):
+    "Function to create the pool of worker processes"
+    # torch is not fork safe once its thread pool is running
+    context = multiprocessing.get_context('spawn')
+    counter = context.Value('i', 0)
+
+    return ProcessPoolExecutor(processes, mp_context=context,
+                               initializer=pin_worker, initargs=(counter, threads))
+
+
+def run_ensemble(member, args, processes=None, threads=None, pool=None):
+    """Function to evaluate member(*a) for each a in args in a process pool.
+    The results are returned in the order of args.
+    """
+    if pool is not None:
+        return [f.result() for f in [pool.submit(member, *a) for a in args]]
+    processes, threads = pool_size(len(args), processes, threads)
+    with ensemble_pool(processes, threads) as pool:
+        return run_ensemble(member, args, pool=pool)
+
+
+def average_softmax(softmax):
+    "Function to average the softmax of the members, as the sequential ensembles"
+    return np.vstack([s[None] for s in softmax]).mean(0)
+
+
+def stub_member(kernel_file, data):
+    """Function to evaluate one member of the stub ensemble used by the
+    benchmark: a 3D convolution followed by a two-class softmax.
+    """
+    from scipy import ndimage
+
+    logits = ndimage.convolve(data, np.load(kernel_file))
+    foreground = 1/(1+np.exp(-logits))
+
+    return np.stack([1-foreground, foreground]).astype(np.float32)
+
+
+def hd_bet_member(param_file, data, tta=True):
+    "Function to evaluate one HD-BET parameter set on the preprocessed data"
+    import torch
+    from HD_BET.config import config
+    from HD_BET.predict_case import predict_case_3D_net
+    from HD_BET.utils import SetNetworkToVal
+
+    if 'hd_bet' not in _MEMBERS:
+        cf = config()
+        net, _ = cf.get_network(cf.val_use_train_mode, None)
+        _MEMBERS['hd_bet'] = (cf, net.cpu())
+    if param_file not in _MEMBERS:
+        _MEMBERS[param_file] = torch.load(
+            param_file, map_location=lambda storage, loc: storage)
+    cf, net = _MEMBERS['hd_bet']
+    net.load_state_dict(_MEMBERS[param_file])
+    net.eval()
+    net.apply(SetNetworkToVal(False, False))
+    _, _, softmax, _ = predict_case_3D_net(
+        net, data, tta, cf.val_num_repeats, cf.val_batch_size,
+        cf.net_input_must_be_divisible_by, cf.val_min_size, 'cpu',
+        cf.da_mirror_axes)
+
+    return softmax
+
+
+def hd_bet_parallel(in_files, out_files, mask_files, mode='accurate', tta=True,
+                    postprocess=True, keep_mask=True, processes=None,
+                    threads=None):
+    """Function equivalent to HD-BET run_hd_bet on CPU, with the parameter
+    sets evaluated in parallel. Lists of images can be given, in which case
+    the pool is kept for all of them, so each worker loads its parameters
+    once.
+    """
+    from HD_BET.utils import (
+        get_params_fname, maybe_download_parameters, postprocess_prediction)
+    from HD_BET.data_loading import load_and_preprocess, save_segmentation_nifti
+    from HD_BET.run import apply_bet
+
+    if isinstance(in_files, str):
+        in_files, out_files, mask_files = [in_files], [out_files], [mask_files]
+    param_files = []
+    for i in range(5 if mode == 'accurate' else 1):
+        maybe_download_parameters(i)
+        param_files.append(get_params_fname(i))
+
+    processes, threads = pool_size(len(param_files), processes, threads)
+    with ensemble_pool(processes, threads) as pool:
+        for in_file, out_file, mask_file in zip(in_files, out_files, mask_files):
+            data, data_dict = load_and_preprocess(in_file)
+            softmax = run_ensemble(
+                hd_bet_member, [(p, data, tta) for p in param_files], pool=pool)
+            seg = np.argmax(average_softmax(softmax), 0)
+            if postprocess:
+                seg = postprocess_prediction(seg)
+            save_segmentation_nifti(seg, data_dict, mask_file)
+            apply_bet(in_file, mask_file, out_file)
+            if not keep_mask:
+                os.remove(mask_file)
+
+
+def nnunet_folds(model_folder):
+    "Function to list the folds of a model in the order used by nnU-Net"
+    folds = sorted(os.path.basename(f) for f in glob.glob(
+        os.path.join(model_folder, 'fold_*')) if os.path.isdir(f))
+
+    return [int(f[5:]) for f in folds if f[5:].isdigit()]
+
+
+def nnunet_member(model_folder, fold, data, tta=True):
+    "Function to evaluate one nnU-Net fold on the preprocessed data"
+    from nnunet.inference.predict import load_model_and_checkpoint_files
+    from radiants.utils.nnunet_inference import fold_softmax
+
+    key = (model_folder, fold)
+    if key not in _MEMBERS:
+        _MEMBERS[key] = load_model_and_checkpoint_files(model_folder, [fold])
+    trainer, params = _MEMBERS[key]
+
+    return fold_softmax(trainer, params[0], data, tta)
+
+
+def nnunet_parallel(model_folder, input_folder, output_folder, folds=None,
+                    tta=True, processes=None, threads=None):
+    """Function equivalent to nnU-Net predict_from_folder on CPU, with the
+    folds evaluated in parallel. The pool is kept for all the cases in
+    input_folder, so each worker loads its folds once.
+    """
+    from nnunet.inference.predict import load_model_and_checkpoint_files
+    from radiants.utils.nnunet_inference import merge_softmax, save_segmentation
+
+    if folds is None:
+        folds = nnunet_folds(model_folder)
+    trainer, _ = load_model_and_checkpoint_files(model_folder, folds[:1])
+    cases = OrderedDict()
+    for f in sorted(glob.glob(os.path.join(input_folder, '*.nii.gz'))):
+        cases.setdefault(os.path.basename(f)[:-12], []).append(f)
+    if not os.path.isdir(output_folder):
+        os.makedirs(output_folder)
+
+    processes, threads = pool_size(len(folds), processes, threads)
+    with ensemble_pool(processes, threads) as pool:
+        for case, files in cases.items():
+            data, _, properties = trainer.preprocess_patient(files)
+            softmax = run_ensemble(
+                nnunet_member, [(model_folder, fold, data, tta) for fold in folds],
+                pool=pool)
+            save_segmentation(trainer, merge_softmax(trainer, softmax), properties,
+                              os.path.join(output_folder, case+'.nii.gz'))
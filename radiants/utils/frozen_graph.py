@@ -0,0 +1,221 @@
+"Export of the Keras lung networks to frozen TensorFlow graphs for CPU inference"
+import os
+import time
+import numpy as np
+import tensorflow as tf
+
+
+def layer_specs(model):
+    """Function to describe each layer of a Keras model (in topological
+    order) with its type, inputs and weights as numpy arrays. Only the
+    layers used by unet_lung are supported.
+    """
+    specs = []
+    for layer in model.layers:
+        kind = layer.__class__.__name__
+        spec = {'name': layer.name, 'type': kind, 'inputs': [
+            l.name for l in layer._inbound_nodes[0].inbound_layers]}
+        if kind == 'InputLayer':
+            pass
+        elif kind == 'Conv2D':
+            if layer.strides != (1, 1) or layer.dilation_rate != (1, 1):
+                raise NotImplementedError('Only Conv2D layers with stride and '
+                                          'dilation 1 can be exported.')
+            spec['kernel'], spec['bias'] = layer.get_weights()
+            spec['padding'] = layer.padding.upper()
+            spec['activation'] = layer.activation.__name__
+        elif kind == 'BatchNormalization':
+            gamma, beta, mean, variance = layer.get_weights()
+            # inference-time batch normalization is x*scale+shift
+            spec['scale'] = gamma/np.sqrt(variance+layer.epsilon)
+            spec['shift'] = beta - mean*spec['scale']
+            spec['type'] = 'Affine'
+        elif kind == 'MaxPooling2D':
+            spec['pool_size'] = layer.pool_size
+            spec['strides'] = layer.strides
+            spec['padding'] = layer.padding.upper()
+        elif kind == 'UpSampling2D':
+            spec['size'] = layer.size
+        elif kind == 'Concatenate':
+            spec['axis'] = layer.axis
+        elif kind == 'Dropout':
+            spec['type'] = 'Identity'
+        else:
+            raise NotImplementedError('Layer {0} ({1}) cannot be exported to '
+                                      'a frozen graph yet!'.format(layer.name, kind))
+        specs.append(spec)
+
+    return specs
+
+
+def fold_batchnorm(specs):
+    """Function to fold the batch normalizations (Affine layers) into the
+    convolutions. In unet_lung every batch normalization follows the ReLU of
+    its convolution, so it can be folded into the preceding convolution only
+    where its scale is positive (relu(z)*a = relu(z*a) for a > 0) and only
+    the shift is left. A batch normalization followed only by 1x1
+    convolutions (the last one) is folded into them entirely. The result is
+    numerically equivalent to the original network.
+    """
+    specs = [dict(spec) for spec in specs]
+    by_name = {spec['name']: spec for spec in specs}
+    consumers = {spec['name']: [] for spec in specs}
+    for spec in specs:
+        for name in spec['inputs']:
+            consumers[name].append(spec['name'])
+
+    for spec in specs:
+        if spec['type'] != 'Affine':
+            continue
+        conv = by_name[spec['inputs'][0]]
+        if (conv['type'] == 'Conv2D' and consumers[conv['name']] == [spec['name']]
+                and conv['activation'] in ['relu', 'linear']):
+            fold = spec['scale'] > 0 if conv['activation'] == 'relu' else (
+                np.ones_like(spec['scale'], dtype=bool))
+            conv['kernel'] = conv['kernel']*np.where(fold, spec['scale'], 1)
+            conv['bias'] = conv['bias']*np.where(fold, spec['scale'], 1)
+            spec['scale'] = np.where(fold, 1, spec['scale']).astype(np.float32)
+        nexts = [by_name[name] for name in consumers[spec['name']]]
+        if nexts and all(n['type'] == 'Conv2D' and n['kernel'].shape[:2] == (1, 1)
+                         for n in nexts):
+            for n in nexts:
+                n['bias'] = n['bias'] + np.tensordot(
+                    spec['shift'], n['kernel'][0, 0], axes=(0, 0))
+                n['kernel'] = n['kernel']*spec['scale'][:, np.newaxis]
+            spec['type'] = 'Identity'
+
+    for spec in specs:
+        for key in ['kernel', 'bias', 'scale', 'shift']:
+            if key in spec:
+                spec[key] = np.asarray(spec[key], dtype=np.float32)
+
+    return specs
+
+
+def build_graph(specs, input_size=(96, 96, 1)):
+    """Function to build the inference graph, with the weights stored as
+    constants, of the layers returned by layer_specs (or fold_batchnorm).
+    The graph has one placeholder, "input", and one output, "output".
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        tensors = {}
+        for spec in specs:
+            inputs = [tensors[name] for name in spec['inputs']]
+            kind = spec['type']
+            if kind == 'InputLayer':
+                x = tf.placeholder(tf.float32, (None,)+tuple(input_size),
+                                   name='input')
+            elif kind == 'Conv2D':
+                x = tf.nn.conv2d(inputs[0], tf.constant(spec['kernel']),
+                                 strides=[1, 1, 1, 1], padding=spec['padding'])
+                x = tf.nn.bias_add(x, tf.constant(spec['bias']))
+                if spec['activation'] == 'relu':
+                    x = tf.nn.relu(x)
+                elif spec['activation'] == 'sigmoid':
+                    x = tf.nn.sigmoid(x)
+                elif spec['activation'] != 'linear':
+                    raise NotImplementedError('Activation {} cannot be exported '
+                                              'yet!'.format(spec['activation']))
+            elif kind == 'Affine':
+                x = inputs[0]
+                if not np.all(spec['scale'] == 1):
+                    x = x*tf.constant(spec['scale'])
+                x = tf.nn.bias_add(x, tf.constant(spec['shift']))
+            elif kind == 'MaxPooling2D':
+                x = tf.nn.max_pool(
+                    inputs[0], ksize=(1,)+tuple(spec['pool_size'])+(1,),
+                    strides=(1,)+tuple(spec['strides'])+(1,),
+                    padding=spec['padding'])
+            elif kind == 'UpSampling2D':
+                shape = inputs[0].get_shape().as_list()
+                x = tf.image.resize_nearest_neighbor(
+                    inputs[0], (shape[1]*spec['size'][0],
+                                shape[2]*spec['size'][1]))
+            elif kind == 'Concatenate':
+                x = tf.concat(inputs, axis=spec['axis'])
+            elif kind == 'Identity':
+                x = inputs[0]
+            tensors[spec['name']] = x
+        tf.identity(x, name='output')
+
+    return graph
+
+
+def frozen_graph_path(weight_file, input_size=(96, 96, 1), outdir=None):
+    "Function to return the name of the frozen graph of one weight file"
+    base, fname = os.path.split(os.path.abspath(weight_file))
+    if outdir is not None:
+        base = outdir
+
+    return os.path.join(base, '{0}_frozen_{1}x{2}.pb'.format(
+        os.path.splitext(fname)[0], input_size[0], input_size[1]))
+
+
+def export_frozen_graph(model, out_file, input_size=(96, 96, 1)):
+    """Function to fold the batch normalizations of model and save it as
+    frozen graph. The graph is written to a temporary file and renamed, so
+    parallel nodes never read a partial graph.
+    """
+    graph = build_graph(fold_batchnorm(layer_specs(model)), input_size)
+    tmp_file = '{0}_{1}'.format(out_file, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        f.write(graph.as_graph_def().SerializeToString())
+    os.replace(tmp_file, out_file)
+
+    return out_file
+
+
+class FrozenGraphModel(object):
+    """Lean inference runner of a frozen graph, with the same predict
+    interface of the Keras models. intra_op_threads and inter_op_threads
+    are passed to the TensorFlow session (0 means TensorFlow's default).
+    """
+    def __init__(self, graph_file, intra_op_threads=0, inter_op_threads=0):
+
+        graph_def = tf.GraphDef()
+        with open(graph_file, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.input = self.graph.get_tensor_by_name('input:0')
+        self.output = self.graph.get_tensor_by_name('output:0')
+        config = tf.ConfigProto(
+            intra_op_parallelism_threads=intra_op_threads,
+            inter_op_parallelism_threads=inter_op_threads)
+        self.session = tf.Session(graph=self.graph, config=config)
+        self.nbytes = os.path.getsize(graph_file)
+
+    def predict(self, x, batch_size=32):
+
+        results = [self.session.run(self.output, feed_dict={
+            self.input: np.asarray(x[i:i+batch_size], dtype=np.float32)})
+                   for i in range(0, x.shape[0], batch_size)]
+
+        return np.concatenate(results)
+
+    def close(self):
+
+        self.session.close()
+
+
+def compare_models(reference, model, patches, batch_size=32):
+    """Function to compare the predictions of two models on the same patches.
+    It returns the maximum absolute difference, the Dice coefficient of the
+    binarized (0.5) predictions and the patches per second of both models.
+    """
+    results = []
+    for m in [reference, model]:
+        start = time.time()
+        prediction = m.predict(patches, batch_size=batch_size)
+        results.append((prediction, patches.shape[0]/(time.time()-start)))
+    a = results[0][0] >= 0.5
+    b = results[1][0] >= 0.5
+    dice = 2.*np.sum(a & b)/max(np.sum(a)+np.sum(b), 1)
+    if not np.any(a) and not np.any(b):
+        dice = 1.0
+
+    return {'max_abs_diff': float(np.max(np.abs(results[0][0]-results[1][0]))),
+            'dice': float(dice), 'reference_speed': results[0][1],
+            'speed': results[1][1]}
@@ -0,0 +1,215 @@
+"Functions to read and write images, as a whole or in slabs"
+import gzip
+import zlib
+import numpy as np
+import nibabel as nib
+import nrrd
+# private pynrrd helpers, setup.py pins the versions they were tested with
+from nrrd.reader import _determine_datatype
+from nrrd.writer import _write_header, _TYPEMAP_NUMPY2NRRD
+from core.utils.filemanip import split_filename
+
+
+def read_header(image):
+    """Function to read only the header of an NRRD or NIfTI image. For NIfTI
+    images the whole (lazy) nibabel image is returned, so both the header and
+    the affine are available without loading the data.
+    """
+    _, _, ext = split_filename(image)
+    if ext == '.nrrd':
+        return nrrd.read_header(image)
+    elif ext == '.nii.gz' or ext == '.nii':
+        return nib.load(image)
+    raise Exception('Unsupported image format {}!'.format(ext))
+
+
+def write_image(array, outname, reference, dtype=np.uint8, compression_level=6,
+                scale=None, reference_header=None):
+    """Function to write array in outname, with the geometry of reference.
+    The array is saved as dtype; if scale is provided, the values are stored
+    as round(array/scale) and (for NIfTI) scale is written as scl_slope, so
+    readers get back the original values. compression_level (0-9) is the gzip
+    level used for NRRD and .nii.gz files, 0 means no compression.
+    The header of reference is read only if reference_header is not provided.
+    """
+    _, _, ext = split_filename(outname)
+    if scale is not None:
+        array = np.round(array/scale)
+    array = np.asarray(array).astype(dtype, copy=False)
+    if reference_header is None:
+        reference_header = read_header(reference)
+
+    if ext == '.nrrd':
+        hd = dict(reference_header)
+        hd['encoding'] = 'gzip' if compression_level else 'raw'
+        nrrd.write(outname, array, header=hd,
+                   compression_level=compression_level)
+    elif ext == '.nii.gz' or ext == '.nii':
+        im2save = nib.Nifti1Image(array, affine=reference_header.affine)
+        if scale is not None:
+            im2save.header.set_slope_inter(scale, 0)
+        if ext == '.nii.gz':
+            # nibabel always uses its default gzip level
+            with gzip.open(outname, 'wb', compresslevel=compression_level) as f:
+                f.write(im2save.to_bytes())
+        else:
+            nib.save(im2save, outname)
+    else:
+        raise Exception('Unsupported image format {}!'.format(ext))
+
+    return outname
+
+
+class SlabReader(object):
+    """Reader of the axial slabs of a 3D NRRD or NIfTI image, to process
+    volumes slice-wise without loading them in memory.
+    NIfTI images are read through the nibabel array proxy, kept open, so
+    uncompressed files are memory-mapped and .nii.gz files are decompressed
+    only once when the slabs are read in order (or randomly accessed if
+    indexed_gzip is installed). Uncompressed NRRD images are memory-mapped
+    and gzip NRRD images are decompressed sequentially, restarting only when
+    a previous slab is requested. Any other NRRD encoding is read at once.
+    The slabs are returned as Fortran ordered (x, y, z) arrays of dtype.
+    """
+    def __init__(self, image, dtype=np.float32):
+
+        self.image = image
+        self.dtype = dtype
+        self._data = None
+        self._stream = None
+        _, _, ext = split_filename(image)
+        if ext == '.nrrd':
+            self._fh = open(image, 'rb')
+            hd = nrrd.read_header(self._fh)
+            self.shape = tuple(int(x) for x in hd['sizes'])
+            self._offset = self._fh.tell()
+            self._encoding = hd['encoding']
+            self._datatype = _determine_datatype(hd)
+            if ('data file' in hd or 'datafile' in hd or 'line skip' in hd
+                    or 'byte skip' in hd
+                    or self._encoding not in ['raw', 'gzip', 'gz']):
+                self._data, _ = nrrd.read(image)
+            elif self._encoding == 'raw':
+                self._data = np.memmap(self._fh, dtype=self._datatype,
+                                       mode='r', offset=self._offset,
+                                       shape=self.shape, order='F')
+        elif ext == '.nii.gz' or ext == '.nii':
+            self._data = nib.load(image, keep_file_open=True).dataobj
+            self.shape = tuple(self._data.shape)
+        else:
+            raise Exception('Unsupported image format {}!'.format(ext))
+        if len(self.shape) != 3:
+            raise Exception('Only 3D images can be read in slabs, {0} has '
+                            'shape {1}!'.format(image, self.shape))
+        self.ndim = 3
+
+    def slab(self, z0, z1):
+        "Function to read the slices from z0 to z1 (excluded)"
+        z1 = min(z1, self.shape[2])
+        if self._data is not None:
+            data = self._data[:, :, z0:z1]
+        else:
+            slice_size = self.shape[0]*self.shape[1]*self._datatype.itemsize
+            start = z0*slice_size
+            if self._stream is None or self._stream.tell() > start:
+                # gzip streams can only be read forward
+                self._fh.seek(self._offset)
+                self._stream = gzip.GzipFile(fileobj=self._fh, mode='rb')
+            self._stream.seek(start)
+            data = np.frombuffer(
+                self._stream.read((z1-z0)*slice_size), dtype=self._datatype)
+            data = data.reshape(self.shape[:2]+(z1-z0,), order='F')
+
+        return np.asfortranarray(data, dtype=self.dtype)
+
+    def slabs(self, thickness=16):
+        "Generator of (z0, slab) pairs covering the whole volume"
+        for z0 in range(0, self.shape[2], thickness):
+            yield z0, self.slab(z0, z0+thickness)
+
+    def close(self):
+
+        if self._stream is not None:
+            self._stream.close()
+        if hasattr(self, '_fh'):
+            self._fh.close()
+        self._data = self._stream = None
+
+
+class SlabWriter(object):
+    """Writer of a 3D NRRD or NIfTI image one axial slab at a time, with the
+    geometry of reference. Both formats store the first axis fastest, so
+    each (x, y, z) slab is appended (and compressed with compression_level,
+    0 means no compression) to the data written so far. See write_image for
+    dtype and scale.
+    """
+    def __init__(self, outname, reference, shape, dtype=np.uint8,
+                 compression_level=6, scale=None, reference_header=None):
+
+        _, _, ext = split_filename(outname)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        self.scale = scale
+        self._compressor = None
+        self._written = 0
+        if reference_header is None:
+            reference_header = read_header(reference)
+
+        if ext == '.nrrd':
+            hd = dict(reference_header)
+            for field in ['data file', 'datafile', 'endian', 'line skip',
+                          'byte skip']:
+                hd.pop(field, None)
+            if 'space' in hd:
+                hd.pop('space dimension', None)
+            hd['type'] = _TYPEMAP_NUMPY2NRRD[self.dtype.str[1:]]
+            hd['dimension'] = 3
+            hd['sizes'] = list(self.shape)
+            hd['encoding'] = 'gzip' if compression_level else 'raw'
+            if self.dtype.itemsize > 1:
+                hd['endian'] = 'little'
+            self._fh = open(outname, 'wb')
+            _write_header(self._fh, hd)
+            if compression_level:
+                self._compressor = zlib.compressobj(
+                    compression_level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        elif ext == '.nii.gz' or ext == '.nii':
+            # zero-strided placeholder, only used to fill the header
+            placeholder = np.broadcast_to(np.zeros((), dtype=self.dtype),
+                                          self.shape)
+            hd = nib.Nifti1Image(placeholder, reference_header.affine).header
+            hd.set_data_offset(352)
+            if scale is not None:
+                hd.set_slope_inter(scale, 0)
+            if ext == '.nii.gz':
+                self._fh = gzip.open(outname, 'wb',
+                                     compresslevel=compression_level)
+            else:
+                self._fh = open(outname, 'wb')
+            # 348 bytes of header and 4 of (empty) extension flags
+            self._fh.write(hd.binaryblock+b'\x00'*4)
+        else:
+            raise Exception('Unsupported image format {}!'.format(ext))
+
+    def write(self, slab):
+        "Function to append the next (x, y, z) slab"
+        slab = np.asarray(slab)
+        if slab.shape[:2] != self.shape[:2]:
+            raise Exception('Slab of shape {0} cannot be written into an '
+                            'image of shape {1}!'.format(slab.shape, self.shape))
+        if self.scale is not None:
+            slab = np.round(slab/self.scale)
+        data = slab.astype(self.dtype).tobytes(order='F')
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self._fh.write(data)
+        self._written += slab.shape[2]
+
+    def close(self):
+
+        if self._written != self.shape[2]:
+            raise Exception('Only {0} out of {1} slices were written!'.format(
+                self._written, self.shape[2]))
+        if self._compressor is not None:
+            self._fh.write(self._compressor.flush())
+        self._fh.close()
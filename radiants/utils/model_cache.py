@@ -0,0 +1,182 @@
+"Process-level cache of built networks and of their weights"
+import os
+from collections import OrderedDict
+import tensorflow as tf
+from keras import backend as K
+from radiants.utils.networks import unet_lung
+from radiants.utils.frozen_graph import (
+    FrozenGraphModel, export_frozen_graph, frozen_graph_path)
+from radiants.utils.quantization import (
+    TFLiteModel, quantized_model_path, quantize_and_validate, load_report)
+
+
+class ModelCache(object):
+    """Registry shared by all the inference interfaces running in the same
+    process. Each architecture is built only once, while the weights read
+    from the HDF5 files are kept in memory (keyed by architecture, weight
+    file path and modification time) and evicted in least recently used
+    order when their total size exceeds max_memory (in MB). The frozen
+    graphs and the int8 models (see load_frozen and load_quantized) are
+    kept in the same cache.
+    """
+    def __init__(self, max_memory=2048):
+
+        self.max_memory = max_memory
+        self._models = {}
+        self._weights = OrderedDict()
+        self._frozen = OrderedDict()
+        self.threads = None
+
+    @staticmethod
+    def _architecture_key(architecture, kwargs):
+
+        return (architecture.__name__, tuple(sorted(kwargs.items())))
+
+    @property
+    def memory(self):
+        "Memory used by the cached weights, in MB"
+        return (sum(sum(w.nbytes for w in weights)
+                    for weights in self._weights.values())
+                + sum(m.nbytes for m in self._frozen.values()))/1024**2
+
+    def model(self, architecture=unet_lung, **kwargs):
+        "Function to return the built network, without loading any weights"
+        key = self._architecture_key(architecture, kwargs)
+        if key not in self._models:
+            self._models[key] = architecture(**kwargs)
+
+        return self._models[key]
+
+    def load(self, weight_file, architecture=unet_lung, **kwargs):
+        "Function to return the network with the given weights loaded"
+        model = self.model(architecture, **kwargs)
+        weight_file = os.path.abspath(weight_file)
+        key = (self._architecture_key(architecture, kwargs), weight_file,
+               os.path.getmtime(weight_file))
+        if key in self._weights:
+            self._weights.move_to_end(key)
+            model.set_weights(self._weights[key])
+        else:
+            model.load_weights(weight_file)
+            self._weights[key] = model.get_weights()
+            self._evict()
+
+        return model
+
+    def load_frozen(self, weight_file, architecture=unet_lung, outdir=None,
+                    **kwargs):
+        """Function to return the frozen graph runner of the network with the
+        given weights. The graph is exported (in outdir, by default next to
+        the weights) the first time, or when the weights are newer than it.
+        """
+        weight_file = os.path.abspath(weight_file)
+        graph_file = frozen_graph_path(
+            weight_file, kwargs.get('input_size', (96, 96, 1)), outdir=outdir)
+        if self._stale(graph_file, weight_file):
+            model = self.load(weight_file, architecture, **kwargs)
+            # checked again, another node may have exported it meanwhile
+            if self._stale(graph_file, weight_file):
+                export_frozen_graph(model, graph_file,
+                                    kwargs.get('input_size', (96, 96, 1)))
+        key = (graph_file, os.path.getmtime(graph_file))
+        if key in self._frozen:
+            self._frozen.move_to_end(key)
+        else:
+            self._frozen[key] = FrozenGraphModel(
+                graph_file, *(self.threads or (0, 0)))
+            self._evict()
+
+        return self._frozen[key]
+
+    def load_quantized(self, weight_file, patches, architecture=unet_lung,
+                       outdir=None, threshold=0.98, **kwargs):
+        """Function to return the int8 model of the network with the given
+        weights. The first time (or when the frozen graph is newer) the model
+        is quantized, calibrating it on part of patches, and validated on the
+        others; patches can also be a function returning them, called only
+        when the model has to be quantized. If the Dice coefficient between the int8 and float
+        predictions is below threshold, or if the int8 model is slower than
+        the float one (as with the TensorFlow 1.x Lite interpreter on some
+        CPUs), the quantized model is refused and the float frozen graph is
+        returned instead.
+        """
+        float_model = self.load_frozen(weight_file, architecture, outdir,
+                                       **kwargs)
+        graph_file = frozen_graph_path(
+            os.path.abspath(weight_file), kwargs.get('input_size', (96, 96, 1)),
+            outdir=outdir)
+        model_file = quantized_model_path(graph_file)
+        report = load_report(model_file)
+        # the report is written after the model, an older one belongs to a
+        # model being replaced
+        if (report is None or self._stale(model_file, graph_file)
+                or self._stale(os.path.splitext(model_file)[0]+'.json',
+                               model_file)):
+            if callable(patches):
+                patches = patches()
+            report = quantize_and_validate(
+                graph_file, float_model, patches,
+                kwargs.get('input_size', (96, 96, 1)))
+        if report['dice'] < threshold:
+            print('The int8 model of {0} agrees with the float one with Dice '
+                  '{1:.4f}, below {2}. The float model will be used.'.format(
+                      weight_file, report['dice'], threshold))
+            return float_model
+        if report['speed'] < report['reference_speed']:
+            print('The int8 model of {0} is slower than the float one ({1:.1f} '
+                  'vs {2:.1f} patches/s). The float model will be used.'.format(
+                      weight_file, report['speed'], report['reference_speed']))
+            return float_model
+        key = (model_file, os.path.getmtime(model_file))
+        if key in self._frozen:
+            self._frozen.move_to_end(key)
+        else:
+            self._frozen[key] = TFLiteModel(
+                model_file, self.threads[0] if self.threads else None)
+            self._evict()
+
+        return self._frozen[key]
+
+    def configure_threads(self, intra_op_threads, inter_op_threads):
+        """Function to set the number of threads used by TensorFlow inside
+        (intra_op_threads) and across (inter_op_threads) the operations of
+        all the networks. The Keras session and the cached frozen graphs are
+        replaced only if the configuration changes; the Keras weights are set
+        again at the next load.
+        """
+        threads = (intra_op_threads, inter_op_threads)
+        if threads == self.threads:
+            return
+        # the previous session would keep its thread pools alive
+        K.get_session().close()
+        K.set_session(tf.Session(config=tf.ConfigProto(
+            intra_op_parallelism_threads=intra_op_threads,
+            inter_op_parallelism_threads=inter_op_threads)))
+        for model in self._frozen.values():
+            model.close()
+        self._frozen.clear()
+        self.threads = threads
+
+    @staticmethod
+    def _stale(out_file, source_file):
+        "Function to check whether out_file is missing or older than source_file"
+        return (not os.path.isfile(out_file) or os.path.getmtime(out_file)
+                < os.path.getmtime(source_file))
+
+    def _evict(self):
+        "Function to drop the least recently used weights above max_memory"
+        while self._weights and self.memory > self.max_memory:
+            self._weights.popitem(last=False)
+        while len(self._frozen) > 1 and self.memory > self.max_memory:
+            self._frozen.popitem(last=False)[1].close()
+
+    def clear(self):
+
+        self._models.clear()
+        self._weights.clear()
+        for model in self._frozen.values():
+            model.close()
+        self._frozen.clear()
+
+
+MODEL_CACHE = ModelCache()
@@ -0,0 +1,155 @@
+"""nnU-Net inference of several models on the same case, sharing the
+preprocessing. nnU-Net crops, resamples and normalizes each case before the
+prediction; models whose plans define the same preprocessing (target
+spacing, normalization and transposition) can use the same preprocessed
+arrays. These are cached on disk, keyed by the content of the input images
+and by the preprocessing plans, so they can also be shared between runs.
+"""
+import os
+import time
+import pickle
+import hashlib
+import numpy as np
+from radiants.utils.ensemble import run_ensemble, nnunet_member, nnunet_folds
+
+
+def files_hash(files):
+    "Function to identify the input images of one case by their content"
+    sha1 = hashlib.sha1()
+    for f in files:
+        with open(f, 'rb') as fid:
+            for chunk in iter(lambda: fid.read(1 << 20), b''):
+                sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+def preprocessing_key(trainer):
+    """Function to identify the preprocessing of a trained model, i.e. the
+    parts of its plans used by preprocess_patient.
+    """
+    plans = trainer.plans
+    stage = plans['plans_per_stage'][trainer.stage]
+    preprocessing = (plans.get('preprocessor_name'), trainer.threeD,
+                     getattr(trainer, 'normalization_schemes', None),
+                     getattr(trainer, 'use_mask_for_norm', None),
+                     getattr(trainer, 'transpose_forward', None),
+                     getattr(trainer, 'intensity_properties', None),
+                     np.asarray(stage['current_spacing']).tolist())
+
+    return hashlib.sha1(pickle.dumps(preprocessing, protocol=2)).hexdigest()
+
+
+def preprocess_case(trainer, files, cache_dir):
+    """Function to return the preprocessed data and properties of one case,
+    reading them from cache_dir if the case was already preprocessed with
+    the same plans. The function returns also whether they were cached.
+    """
+    basename = os.path.join(cache_dir, '{0}_{1}'.format(
+        files_hash(files), preprocessing_key(trainer)))
+    if os.path.isfile(basename+'.pkl'):
+        data = np.load(basename+'.npy')
+        with open(basename+'.pkl', 'rb') as f:
+            properties = pickle.load(f)
+        return data, properties, True
+
+    data, _, properties = trainer.preprocess_patient(files)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # properties are written last, as marker of a complete cache entry,
+    # and renamed so parallel nodes never read partial files
+    pid = os.getpid()
+    np.save('{0}_{1}.npy'.format(basename, pid), data)
+    os.replace('{0}_{1}.npy'.format(basename, pid), basename+'.npy')
+    with open('{0}_{1}.pkl'.format(basename, pid), 'wb') as f:
+        pickle.dump(properties, f)
+    os.replace('{0}_{1}.pkl'.format(basename, pid), basename+'.pkl')
+
+    return data, properties, False
+
+
+def fold_softmax(trainer, params, data, tta=True):
+    "Function to return the softmax of the data predicted by one fold"
+    mirror_axes = trainer.data_aug_params['mirror_axes']
+    trainer.load_checkpoint_ram(params, False)
+    if hasattr(trainer, 'predict_preprocessed_data_return_seg_and_softmax'):
+        return trainer.predict_preprocessed_data_return_seg_and_softmax(
+            data, do_mirroring=tta, mirror_axes=mirror_axes,
+            use_sliding_window=True, step_size=0.5, use_gaussian=True)[1]
+
+    return trainer.predict_preprocessed_data_return_softmax(
+        data, tta, 1, False, 1, mirror_axes, True, True, 2, trainer.patch_size,
+        True)
+
+
+def merge_softmax(trainer, softmax):
+    """Function to average the softmax of the folds, in the order of the
+    folds, and to transpose it back to the orientation of the images.
+    """
+    softmax = np.vstack([s[None] for s in softmax]).mean(0)
+    transpose_backward = trainer.plans.get('transpose_backward')
+    if trainer.plans.get('transpose_forward') is not None:
+        softmax = softmax.transpose([0]+[i+1 for i in transpose_backward])
+
+    return softmax
+
+
+def predict_softmax(trainer, params, data, tta=True):
+    "Function to return the softmax of the data averaged over the folds"
+    return merge_softmax(trainer, [fold_softmax(trainer, p, data, tta)
+                                   for p in params])
+
+
+def save_segmentation(trainer, softmax, properties, out_file):
+    "Function to save the segmentation in the geometry of the input images"
+    from nnunet.inference.segmentation_export import (
+        save_segmentation_nifti_from_softmax)
+
+    order = 1
+    kwargs = {}
+    export_params = trainer.plans.get('segmentation_export_params')
+    if export_params is not None:
+        order = export_params['interpolation_order']
+        kwargs['force_separate_z'] = export_params['force_separate_z']
+    save_segmentation_nifti_from_softmax(
+        softmax, out_file, properties, order,
+        getattr(trainer, 'regions_class_order', None), **kwargs)
+
+
+def predict_models(model_folders, files, out_files, cache_dir, folds=None,
+                   tta=True, fold_parallel=False, processes=None, threads=None):
+    """Function to segment one case (files, one per modality) with each
+    model in model_folders, saving the segmentations in out_files. The case
+    is preprocessed once for all the models with the same preprocessing
+    plans. With fold_parallel, the folds are evaluated by a process pool
+    (see ensemble.py). The time spent in preprocessing and prediction is
+    returned, together with the time spent for each model.
+    """
+    # looked up at each call, so the cache of the predictor service is used
+    import nnunet.inference.predict as predict
+
+    times = {'preprocessing': 0, 'prediction': 0, 'models': []}
+    for model_folder, out_file in zip(model_folders, out_files):
+        model_start = time.time()
+        trainer, params = predict.load_model_and_checkpoint_files(
+            model_folder, folds)
+        start = time.time()
+        data, properties, cached = preprocess_case(trainer, files, cache_dir)
+        times['preprocessing'] += time.time()-start
+        print('{0} the preprocessed case for {1} ({2:.1f} s).'.format(
+            'Reused' if cached else 'Cached', model_folder, time.time()-start))
+        start = time.time()
+        if fold_parallel:
+            softmax = merge_softmax(trainer, run_ensemble(
+                nnunet_member, [(model_folder, fold, data, tta) for fold in
+                                folds or nnunet_folds(model_folder)],
+                processes, threads))
+        else:
+            softmax = predict_softmax(trainer, params, data, tta)
+        if not os.path.isdir(os.path.dirname(out_file)):
+            os.makedirs(os.path.dirname(out_file))
+        save_segmentation(trainer, softmax, properties, out_file)
+        times['prediction'] += time.time()-start
+        times['models'].append(time.time()-model_start)
+
+    return times
@@ -0,0 +1,235 @@
+"""Long-lived predictor process keeping the nnU-Net (and HD-GLIO) models in
+memory, so that each segmentation job does not pay the interpreter, torch
+and nnunet imports and the loading of all the fold checkpoints.
+The service listens on a Unix socket and runs one job at a time. Each
+request is one line of JSON with the job name and its arguments, each
+answer one line of JSON with the status, the time spent and the result of
+the job, if any.
+"""
+import os
+import glob
+import json
+import time
+import socket
+import socketserver
+from collections import OrderedDict
+import numpy as np
+
+
+SOCKET_ENV = 'RADIANTS_PREDICTOR_SOCKET'
+
+
+class ModelLRU(object):
+    "Cache of the loaded models, evicted in least recently used order"
+    def __init__(self, max_models=4):
+
+        self.max_models = max_models
+        self._models = OrderedDict()
+
+    def get(self, key, loader):
+        "Function to return the model with key, loading it with loader if needed"
+        if key in self._models:
+            self._models.move_to_end(key)
+        else:
+            self._models[key] = loader()
+            while len(self._models) > max(self.max_models, 1):
+                self._models.popitem(last=False)
+
+        return self._models[key]
+
+
+def folder_key(folder):
+    "Function to identify the content of a model folder by its checkpoints"
+    files = sorted(glob.glob(os.path.join(folder, '**', '*.model*'),
+                             recursive=True) or
+                   glob.glob(os.path.join(folder, '**', '*.npy'), recursive=True))
+
+    return (os.path.abspath(folder),
+            tuple((f, os.path.getmtime(f)) for f in files))
+
+
+def load_stub_model(model_folder):
+    """Function to load the stub model used to benchmark the service. Each
+    fold is saved as fold_*.npy checkpoint, whose central 3x3x3 voxels are
+    the convolution kernel of the fold.
+    """
+    kernels = []
+    for checkpoint in sorted(glob.glob(os.path.join(model_folder, 'fold_*.npy'))):
+        weights = np.load(checkpoint)
+        c = np.array(weights.shape)//2
+        kernels.append(weights[c[0]-1:c[0]+2, c[1]-1:c[1]+2, c[2]-1:c[2]+2])
+
+    return kernels
+
+
+def run_stub_model(model, in_file, out_file):
+    "Function to segment in_file with the stub model, averaging the folds"
+    import nibabel as nib
+    from scipy import ndimage
+
+    image = nib.load(in_file)
+    data = np.asarray(image.dataobj, dtype=np.float32)
+    prediction = np.mean([ndimage.convolve(data, kernel) for kernel in model],
+                         axis=0)
+    nib.save(nib.Nifti1Image((prediction > 0).astype(np.uint8), image.affine),
+             out_file)
+
+
+def run_stub_job(model_folder, in_file, out_file):
+    "Function to run one stub job from scratch, as a subprocess would"
+    run_stub_model(load_stub_model(model_folder), in_file, out_file)
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+
+        start = time.time()
+        try:
+            request = json.loads(self.rfile.readline().decode())
+            job = request.pop('job')
+            if job not in self.server.jobs:
+                raise Exception('Unknown job {}!'.format(job))
+            result = self.server.jobs[job](**request)
+            response = {'status': 'ok'}
+            if result is not None:
+                response['result'] = result
+        except Exception as e:
+            response = {'status': 'error', 'message': '{0}: {1}'.format(
+                type(e).__name__, e)}
+        response['time'] = time.time() - start
+        self.wfile.write((json.dumps(response)+'\n').encode())
+
+
+class PredictorService(socketserver.UnixStreamServer):
+    """Predictor service listening on socket_path. Up to max_models models
+    (i.e. nnU-Net trainers with the checkpoints of their folds) are kept in
+    memory.
+    """
+    request_queue_size = 64
+
+    def __init__(self, socket_path, max_models=4):
+
+        self.models = ModelLRU(max_models)
+        self.stopped = False
+        self.jobs = {'ping': lambda: None, 'shutdown': self.stop,
+                     'nnunet': self.nnunet_job, 'hd_glio': self.hd_glio_job,
+                     'nnunet_multi': self.nnunet_multi_job,
+                     'stub': self.stub_job}
+        self._nnunet_patched = False
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.socket_path = socket_path
+        socketserver.UnixStreamServer.__init__(self, socket_path, JobHandler)
+
+    def serve(self):
+        "Function to run the jobs until a shutdown job is received"
+        print('Predictor service listening on {}.'.format(self.socket_path))
+        try:
+            while not self.stopped:
+                self.handle_request()
+        finally:
+            self.server_close()
+            os.remove(self.socket_path)
+
+    def stop(self):
+
+        self.stopped = True
+
+    def patch_nnunet(self):
+        """Function to make nnU-Net load the trainers and the fold
+        checkpoints through the model cache. Both predict_from_folder and
+        predict_cases (used by HD-GLIO) call load_model_and_checkpoint_files
+        from the nnunet.inference.predict namespace.
+        """
+        if self._nnunet_patched:
+            return
+        import nnunet.inference.predict as predict
+        load = predict.load_model_and_checkpoint_files
+
+        def cached_load(folder, *args, **kwargs):
+            key = ('nnunet', folder_key(folder), repr(args),
+                   repr(sorted(kwargs.items())))
+            return self.models.get(key, lambda: load(folder, *args, **kwargs))
+
+        predict.load_model_and_checkpoint_files = cached_load
+        self._nnunet_patched = True
+
+    def nnunet_job(self, model_folder, input_folder, output_folder, folds=None,
+                   tta=True, num_threads_preprocessing=6,
+                   num_threads_nifti_save=2):
+        "Job equivalent to bash/predict_simple.py"
+        self.patch_nnunet()
+        from nnunet.inference.predict import predict_from_folder
+        predict_from_folder(model_folder, input_folder, output_folder, folds,
+                            False, num_threads_preprocessing,
+                            num_threads_nifti_save, None, 0, 1, tta,
+                            overwrite_existing=True)
+
+    def nnunet_multi_job(self, model_folders, files, out_files, cache_dir,
+                         tta=True):
+        "Job equivalent to NNUnetMultiModelInference"
+        self.patch_nnunet()
+        from radiants.utils.nnunet_inference import predict_models
+        return predict_models(model_folders, files, out_files, cache_dir,
+                              tta=tta)
+
+    def hd_glio_job(self, t1, ct1, t2, flair, out_file):
+        "Job equivalent to hd_glio_predict"
+        self.patch_nnunet()
+        from nnunet.inference.predict import predict_cases
+        from hd_glio.paths import folder_with_parameter_files
+        from hd_glio.setup_hd_glio import maybe_download_weights
+        maybe_download_weights()
+        predict_cases(folder_with_parameter_files, [[t1, ct1, t2, flair]],
+                      [out_file], (0, 1, 2, 3, 4), False, 1, 1, None, True,
+                      None, True)
+
+    def stub_job(self, model_folder, in_file, out_file):
+        "Job running the stub model used by the benchmark"
+        model = self.models.get(('stub', folder_key(model_folder)),
+                                lambda: load_stub_model(model_folder))
+        run_stub_model(model, in_file, out_file)
+
+
+def submit(job, socket_path=None, timeout=None, **kwargs):
+    """Function to send a job to the predictor service and to wait for its
+    end. socket_path defaults to $RADIANTS_PREDICTOR_SOCKET. The answer of
+    the service is returned; an exception is raised if the job failed.
+    """
+    if socket_path is None:
+        socket_path = os.environ[SOCKET_ENV]
+    request = dict(kwargs, job=job)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(socket_path)
+        s.sendall((json.dumps(request)+'\n').encode())
+        with s.makefile('rb') as f:
+            response = json.loads(f.readline().decode())
+    if response['status'] != 'ok':
+        raise Exception('The predictor service failed to run the {0} job: '
+                        '{1}'.format(job, response['message']))
+
+    return response
+
+
+def service_socket(socket_path=None, timeout=None):
+    """Function to return the socket of the predictor service to use: the
+    given one or $RADIANTS_PREDICTOR_SOCKET, if the service answers a ping
+    job. None is returned, so the models are run in a subprocess, if there
+    is no socket or if the connection fails (e.g. the socket file was left
+    by a service that crashed). A busy service answers the ping after its
+    current job, unless timeout (in seconds) expires first.
+    """
+    if socket_path is None:
+        socket_path = os.environ.get(SOCKET_ENV)
+    if socket_path is None or not os.path.exists(socket_path):
+        return None
+    try:
+        submit('ping', socket_path, timeout=timeout)
+    except (OSError, ValueError) as e:
+        print('The predictor service on {0} does not answer ({1}), the models '
+              'will be run in a subprocess.'.format(socket_path, e))
+        return None
+
+    return socket_path
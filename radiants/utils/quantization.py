@@ -0,0 +1,146 @@
+"Post-training int8 quantization of the lung networks, gated by their agreement with the float ones"
+import os
+import json
+import numpy as np
+import tensorflow as tf
+from radiants.utils.frozen_graph import compare_models
+
+
+def sample_patches(tensor, n_patches=256, seed=42):
+    """Function to sample up to n_patches non-empty patches from a tensor
+    created by create_tensors (array or memory-mapped .npy file).
+    """
+    if isinstance(tensor, str):
+        tensor = np.load(tensor, mmap_mode='r')
+    rng = np.random.RandomState(seed)
+    indexes = np.sort(rng.permutation(tensor.shape[0])[:4*n_patches])
+    patches = np.asarray(tensor[indexes], dtype=np.float32)
+    # constant patches (i.e. air) do not help the calibration
+    flat = patches.reshape(patches.shape[0], -1)
+    patches = patches[flat.max(axis=1) > flat.min(axis=1)]
+
+    return patches[:n_patches]
+
+
+def split_patches(patches, held_out=0.25):
+    "Function to split the patches into calibration and held-out sets"
+    n_held_out = max(int(round(patches.shape[0]*held_out)), 1)
+    if n_held_out >= patches.shape[0]:
+        raise Exception('At least 2 patches are needed to calibrate and '
+                        'validate the quantized model, {} given!'.format(
+                            patches.shape[0]))
+
+    return patches[n_held_out:], patches[:n_held_out]
+
+
+def quantized_model_path(graph_file):
+    "Function to return the name of the int8 model of one frozen graph"
+    base, fname = os.path.split(graph_file)
+    fname = os.path.splitext(fname)[0].replace('_frozen_', '_int8_')
+
+    return os.path.join(base, fname+'.tflite')
+
+
+def quantize_graph(graph_file, out_file, calibration, input_size=(96, 96, 1)):
+    """Function to convert a frozen graph (see frozen_graph.py) into an int8
+    TensorFlow Lite model. Weights and activations are quantized, with the
+    activation ranges calibrated on the calibration patches. The input and
+    output stay float32, so the model is a drop-in replacement. TensorFlow
+    versions without calibration support (< 1.14) cannot be used.
+    """
+    if not hasattr(tf.lite, 'RepresentativeDataset'):
+        raise Exception('TensorFlow {} cannot calibrate the activations, so the '
+                        'int8 model cannot be created. TensorFlow 1.14 or newer '
+                        'is needed.'.format(tf.__version__))
+    converter = tf.lite.TFLiteConverter.from_frozen_graph(
+        graph_file, ['input'], ['output'],
+        input_shapes={'input': [1]+list(input_size)})
+
+    def representative_dataset():
+        for patch in calibration:
+            yield [patch[np.newaxis].astype(np.float32)]
+
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = tf.lite.RepresentativeDataset(
+        representative_dataset)
+    model = converter.convert()
+    # renamed once complete, so parallel nodes never read a partial model
+    tmp_file = '{0}_{1}'.format(out_file, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        f.write(model)
+    os.replace(tmp_file, out_file)
+
+    return out_file
+
+
+class TFLiteModel(object):
+    """Runner of a TensorFlow Lite model, with the same predict interface of
+    the Keras models. num_threads is ignored by TensorFlow versions whose
+    interpreter cannot be multi-threaded.
+    """
+    def __init__(self, model_file, num_threads=None):
+
+        try:
+            self.interpreter = tf.lite.Interpreter(model_path=model_file,
+                                                   num_threads=num_threads)
+        except TypeError:
+            self.interpreter = tf.lite.Interpreter(model_path=model_file)
+        self.input = self.interpreter.get_input_details()[0]['index']
+        self.output = self.interpreter.get_output_details()[0]['index']
+        self.nbytes = os.path.getsize(model_file)
+        self._batch_size = None
+
+    def predict(self, x, batch_size=32):
+
+        results = []
+        for i in range(0, x.shape[0], batch_size):
+            batch = np.asarray(x[i:i+batch_size], dtype=np.float32)
+            if batch.shape[0] != self._batch_size:
+                self.interpreter.resize_tensor_input(self.input, batch.shape)
+                self.interpreter.allocate_tensors()
+                self._batch_size = batch.shape[0]
+            self.interpreter.set_tensor(self.input, batch)
+            self.interpreter.invoke()
+            results.append(self.interpreter.get_tensor(self.output).copy())
+
+        return np.concatenate(results)
+
+    def close(self):
+
+        self.interpreter = None
+
+
+def quantize_and_validate(graph_file, float_model, patches,
+                          input_size=(96, 96, 1), held_out=0.25,
+                          batch_size=32):
+    """Function to quantize a frozen graph, calibrating it on part of the
+    patches, and to compare it with the float model on the held-out ones.
+    The comparison (see compare_models) is saved next to the int8 model, as
+    JSON file, and returned. The report is written after the model, so it
+    marks a complete entry.
+    """
+    calibration, validation = split_patches(patches, held_out)
+    model_file = quantize_graph(
+        graph_file, quantized_model_path(graph_file), calibration, input_size)
+    quantized = TFLiteModel(model_file)
+    report = compare_models(float_model, quantized, validation,
+                            batch_size=batch_size)
+    quantized.close()
+    report['calibration_patches'] = calibration.shape[0]
+    report['validation_patches'] = validation.shape[0]
+    report_file = os.path.splitext(model_file)[0]+'.json'
+    tmp_file = '{0}_{1}'.format(report_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(report, f, indent=4)
+    os.replace(tmp_file, report_file)
+
+    return report
+
+
+def load_report(model_file):
+    "Function to read the validation report of an int8 model, if any"
+    report = os.path.splitext(model_file)[0]+'.json'
+    if not os.path.isfile(report):
+        return None
+    with open(report, 'r') as f:
+        return json.load(f)
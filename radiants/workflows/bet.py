@@ -1,17 +1,72 @@
 "Brain extraction workflow"
+import re
 import nipype
-from radiants.interfaces.mic import HDBet
+from nipype.interfaces.utility import IdentityInterface, Merge, Split
+from radiants.interfaces.mic import HDBet, HDBetBatch
 from nipype.interfaces.fsl.utils import Reorient2Std
 from core.workflows.base import BaseWorkflow
-from nipype.interfaces.ants import N4BiasFieldCorrection
+from nipype.interfaces.ants import N4BiasFieldCorrection, ApplyTransforms
+from radiants.interfaces.ants import AntsRegSyn
+from radiants.interfaces.utils import ApplyBrainMask, BrainMaskCheck
 
 
 TON4 = ['T1KM', 'T1']
 TOBET = ['T1KM', 'T1', 'FLAIR', 'SWI', 'T2', 'ADC']
+POSSIBLE_REF = ['T1KM', 'T1'] # order is important! 
+
+
+def batch_bet(workflow, images, name, fold_parallel=False):
+    """Function to add one HDBetBatch node extracting the brain of all the
+    images. Each image is given as ((node, field), out_name, (target,
+    out_file_field, out_mask_field)), where the target receives the brain
+    extracted image and the mask.
+    """
+    merge = nipype.Node(Merge(len(images)), name='{}_inputs'.format(name))
+    bet = nipype.Node(interface=HDBetBatch(), name=name)
+    bet.inputs.out_names = [out_name for _, out_name, _ in images]
+    bet.inputs.fold_parallel = fold_parallel
+    workflow.connect(merge, 'out', bet, 'in_files')
+    splits = {}
+    for output in ['out_files', 'out_masks']:
+        splits[output] = nipype.Node(
+            Split(splits=[1]*len(images), squeeze=True),
+            name='{0}_{1}'.format(name, output))
+        workflow.connect(bet, output, splits[output], 'inlist')
+    for i, (source, _, (target, out_file, out_mask)) in enumerate(images):
+        workflow.connect(source[0], source[1], merge, 'in{}'.format(i+1))
+        workflow.connect(splits['out_files'], 'out{}'.format(i+1), target, out_file)
+        workflow.connect(splits['out_masks'], 'out{}'.format(i+1), target, out_mask)
+
+    return workflow
+
+
+def reference_sequence(sequences):
+    "Function to return the reference sequence of a session (see POSSIBLE_REF)"
+    for pr in POSSIBLE_REF:
+        if pr in sequences:
+            return pr
+
+    return None
 
 
 class BETWorkflow(BaseWorkflow):
 
+    def __init__(self, fold_parallel=False, batch=False, cohort=False,
+                 propagate_mask=False, check_propagation=False,
+                 dice_threshold=0.9, **kwargs):
+
+        super().__init__(**kwargs)
+        self.fold_parallel = fold_parallel
+        self.batch = batch
+        self.cohort = cohort
+        self.propagate_mask = propagate_mask
+        self.check_propagation = check_propagation
+        self.dice_threshold = dice_threshold
+        self.cohort_images = []
+        if check_propagation and not propagate_mask:
+            raise Exception('The propagation check can only be used together '
+                            'with the mask propagation (propagate_mask)!')
+
     @staticmethod
     def workflow_inputspecs(additional_inputs=None):
 
@@ -50,8 +105,15 @@ class BETWorkflow(BaseWorkflow):
         sub_id = self.sub_id
 
         tobet = {**dict_sequences['MR-RT'], **dict_sequences['OT']}
-        workflow = nipype.Workflow('brain_extraction_workflow',
-                                   base_dir=nipype_cache)
+        if self.cohort:
+            # the subject workflows become part of one cohort workflow
+            workflow_name = 'brain_extraction_workflow_{}'.format(
+                re.sub(r'\W', '_', sub_id))
+        else:
+            workflow_name = 'brain_extraction_workflow'
+        workflow = nipype.Workflow(workflow_name, base_dir=nipype_cache)
+        self.cohort_images = []
+        to_batch = []
         datasink = nipype.Node(nipype.DataSink(base_directory=result_dir),
                                "datasink")
         substitutions = [('subid', sub_id)]
@@ -65,17 +127,38 @@ class BETWorkflow(BaseWorkflow):
 #                 files.append(tobet[key]['ref'])
             if tobet[key]['scans'] is not None:
                 files = files + tobet[key]['scans']
-            for el in files:
-                el = el.strip(self.extention)
+            sequences = [el.strip(self.extention) for el in files]
+            ref = reference_sequence(sequences) if self.propagate_mask else None
+            ref_bet = None
+            # reference first, its mask is propagated to the other sequences
+            for el in sorted(sequences, key=lambda x: x != ref):
                 node_name = '{0}_{1}'.format(key, el)
-                bet = nipype.Node(
-                    interface=HDBet(),
-                    name='{}_bet'.format(node_name), serial=True)
-                bet.inputs.save_mask = 1
-                bet.inputs.out_file = '{}_preproc'.format(el)
-                reorient = nipype.Node(
-                    interface=Reorient2Std(),
-                    name='{}_reorient'.format(node_name))
+                reorient = None
+                if not self.cohort or (ref is not None and el != ref):
+                    reorient = nipype.Node(
+                        interface=Reorient2Std(),
+                        name='{}_reorient'.format(node_name))
+                    workflow.connect(datasource, node_name, reorient, 'in_file')
+                if ref is None or el == ref:
+                    bet = self.hd_bet(workflow, reorient, node_name, el, to_batch)
+                    ref_bet = bet
+                else:
+                    bet = self.mask_propagation(workflow, reorient, ref_bet,
+                                                node_name, el, ref)
+                    if self.check_propagation:
+                        full_bet = self.hd_bet(workflow, reorient, node_name, el,
+                                               to_batch, suffix='full_bet')
+                        check = nipype.Node(
+                            interface=BrainMaskCheck(),
+                            name='{}_bet_check'.format(node_name))
+                        check.inputs.threshold = self.dice_threshold
+                        workflow.connect(bet, 'out_file', check, 'in_file')
+                        workflow.connect(bet, 'out_mask', check, 'in_mask')
+                        workflow.connect(full_bet, 'out_file', check, 'bet_file')
+                        workflow.connect(full_bet, 'out_mask', check, 'bet_mask')
+                        workflow.connect(check, 'report', datasink,
+                             'results.subid.{0}.@{1}_preproc_mask_check'.format(key, el))
+                        bet = check
                 if el in TON4:
                     n4 = nipype.Node(
                         interface=N4BiasFieldCorrection(),
@@ -89,13 +172,123 @@ class BETWorkflow(BaseWorkflow):
                      'results.subid.{0}.@{1}_preproc'.format(key, el))
                 workflow.connect(bet, 'out_mask', datasink,
                      'results.subid.{0}.@{1}_preproc_mask'.format(key, el))
-                workflow.connect(reorient, 'out_file', bet, 'input_file')
-                workflow.connect(datasource, node_name, reorient, 'in_file')
+
+        if to_batch:
+            workflow = batch_bet(workflow, to_batch, 'hd_bet_batch',
+                                 self.fold_parallel)
 
         return workflow
 
+    def hd_bet(self, workflow, reorient, node_name, el, to_batch, suffix='bet'):
+        """Function to add the HD-BET brain extraction of one image. With batch
+        or cohort, HD-BET runs once for all the images (see batch_bet) and the
+        returned node only passes the outputs of this image on.
+        """
+        name = '{0}_{1}'.format(node_name, suffix)
+        out_name = '{}_preproc'.format(el)
+        if self.batch or self.cohort:
+            bet = nipype.Node(
+                interface=IdentityInterface(fields=['out_file', 'out_mask']),
+                name=name)
+        else:
+            bet = nipype.Node(interface=HDBet(), name=name, serial=True)
+            bet.inputs.save_mask = 1
+            bet.inputs.fold_parallel = self.fold_parallel
+            bet.inputs.out_file = out_name
+        if self.cohort:
+            self.cohort_images.append(
+                {'image': node_name, 'out_name': out_name,
+                 'out_file': '{}.out_file'.format(name),
+                 'out_mask': '{}.out_mask'.format(name)})
+        elif self.batch:
+            to_batch.append(((reorient, 'out_file'), out_name,
+                             (bet, 'out_file', 'out_mask')))
+        else:
+            workflow.connect(reorient, 'out_file', bet, 'input_file')
+
+        return bet
+
+    def mask_propagation(self, workflow, reorient, ref_bet, node_name, el, ref):
+        """Function to extract the brain of one image with the HD-BET mask of
+        the reference sequence of the same session: the image is rigidly
+        registered to the brain extracted reference and the mask is resampled
+        into the space of the image.
+        """
+        reg = nipype.Node(interface=AntsRegSyn(),
+                          name='{}_reg2ref'.format(node_name))
+        reg.inputs.transformation = 'r'
+        reg.inputs.num_dimensions = 3
+        reg.inputs.num_threads = 4
+        reg.inputs.out_prefix = '{0}_reg2{1}'.format(el, ref)
+        workflow.connect(reorient, 'out_file', reg, 'input_file')
+        workflow.connect(ref_bet, 'out_file', reg, 'ref_file')
+        workflow.connect(ref_bet, 'out_mask', reg, 'ref_mask')
+
+        mask = nipype.Node(interface=ApplyTransforms(),
+                           name='{}_ref_mask'.format(node_name))
+        mask.inputs.interpolation = 'NearestNeighbor'
+        mask.inputs.invert_transform_flags = [True]
+        mask.inputs.output_image = '{0}_{1}_mask.nii.gz'.format(el, ref)
+        workflow.connect(ref_bet, 'out_mask', mask, 'input_image')
+        workflow.connect(reorient, 'out_file', mask, 'reference_image')
+        workflow.connect(reg, 'regmat', mask, 'transforms')
+
+        bet = nipype.Node(interface=ApplyBrainMask(),
+                          name='{}_bet'.format(node_name))
+        bet.inputs.out_name = '{}_preproc'.format(el)
+        workflow.connect(reorient, 'out_file', bet, 'in_file')
+        workflow.connect(mask, 'output_image', bet, 'mask')
+
+        return bet
+
     def workflow_setup(self, create_database=True, dict_sequences=None, **kwargs):
 
         return BaseWorkflow.workflow_setup(
             self, create_database=create_database,
             dict_sequences=dict_sequences, **kwargs)
+
+
+class BETCohort(object):
+    """HD-BET brain extraction of a whole cohort with one HDBetBatch node.
+    Each subject workflow (BETWorkflow with cohort=True) only runs the N4
+    bias field correction and the datasink; the images are read and
+    reoriented in the cohort workflow, from a copy of each subject
+    datasource, otherwise the subject workflows would be both upstream and
+    downstream of the brain extraction.
+    """
+    def __init__(self, subjects, base_dir, cores=0, fold_parallel=False):
+
+        self.subjects = subjects
+        self.base_dir = base_dir
+        self.cores = cores
+        self.fold_parallel = fold_parallel
+
+    def workflow(self):
+        "Function to combine the subject workflows into the cohort workflow"
+        workflow = nipype.Workflow('brain_extraction_cohort',
+                                   base_dir=self.base_dir)
+        images = []
+        for subject, sub_workflow in self.subjects:
+            if not subject.cohort_images:
+                continue
+            sub_name = re.sub(r'\W', '_', subject.sub_id)
+            datasource = subject.data_source.clone('datasource_{}'.format(sub_name))
+            for image in subject.cohort_images:
+                reorient = nipype.Node(
+                    interface=Reorient2Std(),
+                    name='{0}_{1}_reorient'.format(sub_name, image['image']))
+                workflow.connect(datasource, image['image'], reorient, 'in_file')
+                images.append(((reorient, 'out_file'), image['out_name'],
+                               (sub_workflow, image['out_file'], image['out_mask'])))
+        if images:
+            workflow = batch_bet(workflow, images, 'hd_bet_cohort',
+                                 self.fold_parallel)
+
+        return workflow
+
+    def runner(self, workflow):
+
+        if self.cores == 0:
+            workflow.run()
+        else:
+            workflow.run('MultiProc', plugin_args={'n_procs': self.cores})
@@ -1,18 +1,45 @@
 "Lung segmentation workflows"
+import re
 import nipype
+from nipype.interfaces.utility import Merge, Select
 from core.workflows.base import BaseWorkflow
-from radiants.interfaces.custom_preproc import LungSegmentationPreproc
-from radiants.interfaces.custom import LungSegmentationInference
+from radiants.interfaces.custom_preproc import (
+    LungSegmentationPreproc, LungBoundingBoxCrop, LungBoundingBoxPaste)
+from radiants.interfaces.custom import (
+    LungSegmentationInference, LungSegmentationCohortInference)
 
 
 class LungSegmentation(BaseWorkflow):
     
     def __init__(self, network_weights, new_spacing=[0.35, 0.35, 0.35],
-                 **kwargs):
+                 tensor_on_disk=False, save_resampled=True,
+                 skip_background=False, cohort=False, coarse_spacing=None,
+                 cascade_margin=10.0, adaptive_tolerance=0.0,
+                 stream_slabs=False, streaming_inference=False,
+                 min_overlap=None, tile_size=96, engine='keras',
+                 parallel_workers=None, **kwargs):
         
         super().__init__(**kwargs)
+        if cohort and coarse_spacing is not None:
+            raise NotImplementedError('The coarse-to-fine segmentation is not '
+                                      'available in cohort mode yet!')
         self.network_weights = network_weights
         self.new_spacing = new_spacing
+        self.tensor_on_disk = tensor_on_disk
+        self.save_resampled = save_resampled
+        self.skip_background = skip_background
+        self.cohort = cohort
+        self.cohort_images = []
+        self.coarse_spacing = coarse_spacing
+        self.cascade_margin = cascade_margin
+        self.adaptive_tolerance = adaptive_tolerance
+        self.stream_slabs = stream_slabs
+        self.streaming_inference = streaming_inference
+        self.min_overlap = min_overlap
+        self.tile_size = tile_size
+        self.engine = engine
+        self.parallel_workers = parallel_workers
+        self.n_procs = kwargs.get('cores', 0)
 
     @staticmethod
     def workflow_inputspecs(additional_inputs=None):
@@ -46,23 +73,40 @@ class LungSegmentation(BaseWorkflow):
                                 dict_sequences=dict_sequences,
                                 check_dependencies=check_dependencies)
 
+    def datasink(self, name='datasink'):
+
+        datasink = nipype.Node(nipype.DataSink(base_directory=self.result_dir),
+                               name)
+        substitutions = [('subid', self.sub_id)]
+        substitutions += [('results/', '{}/'.format(self.workflow_name))]
+        substitutions += [('_preproc_corrected.', '_preproc.')]
+        datasink.inputs.substitutions = substitutions
+
+        return datasink
+
     def workflow(self):
 
         datasource = self.data_source
         dict_sequences = self.dict_sequences
         nipype_cache = self.nipype_cache
-        result_dir = self.result_dir
-        sub_id = self.sub_id
 
         toseg = {**dict_sequences['OT']}
-        workflow = nipype.Workflow('lung_segmentation_workflow',
-                                   base_dir=nipype_cache)
-        datasink = nipype.Node(nipype.DataSink(base_directory=result_dir),
-                               "datasink")
-        substitutions = [('subid', sub_id)]
-        substitutions += [('results/', '{}/'.format(self.workflow_name))]
-        substitutions += [('_preproc_corrected.', '_preproc.')]
-        datasink.inputs.substitutions = substitutions
+        if self.cohort:
+            # the subject workflows become part of one cohort workflow
+            workflow_name = 'lung_segmentation_workflow_{}'.format(
+                re.sub(r'\W', '_', self.sub_id))
+        else:
+            workflow_name = 'lung_segmentation_workflow'
+        workflow = nipype.Workflow(workflow_name, base_dir=nipype_cache)
+        datasink = self.datasink()
+        self.cohort_images = []
+        if self.parallel_workers is None:
+            # with MultiProc, up to one inference node per image at once
+            n_images = sum(len(toseg[key]['scans']) for key in toseg
+                           if toseg[key]['scans'] is not None)
+            parallel_workers = max(min(self.n_procs, n_images), 1)
+        else:
+            parallel_workers = self.parallel_workers
 
         for key in toseg:
             files = []
@@ -77,15 +121,150 @@ class LungSegmentation(BaseWorkflow):
                     interface=LungSegmentationPreproc(),
                     name='{}_ls_preproc'.format(node_name))
                 preproc.inputs.new_spacing = self.new_spacing
+                preproc.inputs.save_tensor = self.tensor_on_disk
+                preproc.inputs.save_resampled = self.save_resampled
+                preproc.inputs.skip_background = self.skip_background
+                preproc.inputs.stream_slabs = self.stream_slabs
+                preproc.inputs.tile_size = self.tile_size
+                if self.min_overlap is not None:
+                    preproc.inputs.min_overlap = self.min_overlap
+                if self.cohort:
+                    # the inference is run by LungSegmentationCohort
+                    preproc.inputs.save_tensor = True
+                    workflow.connect(datasource, node_name, preproc, 'in_file')
+                    self.cohort_images.append(
+                        ('{}_ls_preproc'.format(node_name),
+                         'results.subid.{0}.@{1}_segmented_lungs'.format(key, el)))
+                    continue
                 lung_seg = nipype.Node(
                     interface=LungSegmentationInference(),
                     name='{}_ls'.format(node_name))
                 lung_seg.inputs.weights = self.network_weights
+                lung_seg.inputs.adaptive_tolerance = self.adaptive_tolerance
+                lung_seg.inputs.streaming = self.streaming_inference
+                lung_seg.inputs.engine = self.engine
+                lung_seg.inputs.parallel_workers = parallel_workers
+                workflow = self.connect_inference(workflow, preproc, lung_seg)
+
+                if self.coarse_spacing is not None:
+                    coarse_preproc = nipype.Node(
+                        interface=LungSegmentationPreproc(),
+                        name='{}_ls_coarse_preproc'.format(node_name))
+                    coarse_preproc.inputs.new_spacing = self.coarse_spacing
+                    coarse_preproc.inputs.save_tensor = self.tensor_on_disk
+                    coarse_preproc.inputs.save_resampled = False
+                    coarse_preproc.inputs.skip_background = self.skip_background
+                    coarse_preproc.inputs.tile_size = self.tile_size
+                    if self.min_overlap is not None:
+                        coarse_preproc.inputs.min_overlap = self.min_overlap
+                    # the coarse stage only has to find the lungs
+                    coarse_seg = nipype.Node(
+                        interface=LungSegmentationInference(),
+                        name='{}_ls_coarse'.format(node_name))
+                    coarse_seg.inputs.weights = self.network_weights[:1]
+                    coarse_seg.inputs.engine = self.engine
+                    coarse_seg.inputs.parallel_workers = parallel_workers
+                    crop = nipype.Node(
+                        interface=LungBoundingBoxCrop(),
+                        name='{}_ls_crop'.format(node_name))
+                    crop.inputs.margin = self.cascade_margin
+                    crop.inputs.new_spacing = self.new_spacing
+                    crop.inputs.coarse_spacing = self.coarse_spacing
+                    paste = nipype.Node(
+                        interface=LungBoundingBoxPaste(),
+                        name='{}_ls_paste'.format(node_name))
 
-                workflow.connect(datasource, node_name, preproc, 'in_file')
-                workflow.connect(preproc, 'tensor', lung_seg, 'tensor')
-                workflow.connect(preproc, 'image_info', lung_seg, 'image_info')
-                workflow.connect(lung_seg, 'segmented_lungs', datasink,
-                     'results.subid.{0}.@{1}_segmented_lungs'.format(key, el))
+                    workflow.connect(datasource, node_name, coarse_preproc, 'in_file')
+                    workflow = self.connect_inference(
+                        workflow, coarse_preproc, coarse_seg)
+                    workflow.connect(datasource, node_name, crop, 'in_file')
+                    workflow.connect(coarse_seg, 'segmented_lungs', crop,
+                                     'coarse_mask')
+                    workflow.connect(crop, 'cropped_image', preproc, 'in_file')
+                    workflow.connect(datasource, node_name, paste, 'reference')
+                    workflow.connect(crop, 'bounding_box', paste, 'bounding_box')
+                    workflow.connect(lung_seg, 'segmented_lungs', paste, 'in_file')
+                    workflow.connect(paste, 'out_file', datasink,
+                         'results.subid.{0}.@{1}_segmented_lungs'.format(key, el))
+                else:
+                    workflow.connect(datasource, node_name, preproc, 'in_file')
+                    workflow.connect(lung_seg, 'segmented_lungs', datasink,
+                         'results.subid.{0}.@{1}_segmented_lungs'.format(key, el))
 
         return workflow
+
+    def connect_inference(self, workflow, preproc, lung_seg):
+
+        if self.tensor_on_disk:
+            workflow.connect(preproc, 'tensor_file', lung_seg, 'tensor_file')
+        else:
+            workflow.connect(preproc, 'tensor', lung_seg, 'tensor')
+        workflow.connect(preproc, 'image_info', lung_seg, 'image_info')
+
+        return workflow
+
+
+class LungSegmentationCohort(object):
+    """Lung segmentation of a whole cohort with a single inference node.
+    Each subject workflow (LungSegmentation with cohort=True) only
+    preprocesses its images, then all the tensors are segmented together by
+    LungSegmentationCohortInference, so every fold is loaded once for the
+    cohort, and the masks are sent back to the datasink of each subject.
+    """
+    def __init__(self, subjects, network_weights, base_dir, cores=0,
+                 batch_size=None, ensemble_chunk=4096, adaptive_tolerance=0.0,
+                 streaming_inference=False, engine='keras'):
+
+        self.subjects = subjects
+        self.network_weights = network_weights
+        self.base_dir = base_dir
+        self.cores = cores
+        self.batch_size = batch_size
+        self.ensemble_chunk = ensemble_chunk
+        self.adaptive_tolerance = adaptive_tolerance
+        self.streaming_inference = streaming_inference
+        self.engine = engine
+
+    def workflow(self):
+        "Function to combine the subject workflows into the cohort workflow"
+        images = [(subject, sub_workflow, image)
+                  for subject, sub_workflow in self.subjects
+                  for image in subject.cohort_images]
+        workflow = nipype.Workflow('lung_segmentation_cohort',
+                                   base_dir=self.base_dir)
+        tensors = nipype.Node(Merge(len(images)), name='tensors')
+        image_infos = nipype.Node(Merge(len(images)), name='image_infos')
+        lung_seg = nipype.Node(interface=LungSegmentationCohortInference(),
+                               name='cohort_ls')
+        lung_seg.inputs.weights = self.network_weights
+        if self.batch_size is not None:
+            lung_seg.inputs.batch_size = self.batch_size
+        lung_seg.inputs.ensemble_chunk = self.ensemble_chunk
+        lung_seg.inputs.adaptive_tolerance = self.adaptive_tolerance
+        lung_seg.inputs.streaming = self.streaming_inference
+        lung_seg.inputs.engine = self.engine
+        workflow.connect(tensors, 'out', lung_seg, 'tensor_files')
+        workflow.connect(image_infos, 'out', lung_seg, 'image_infos')
+
+        datasinks = {}
+        for n, (subject, sub_workflow, image) in enumerate(images):
+            preproc_node, datasink_entry = image
+            workflow.connect(sub_workflow, '{}.tensor_file'.format(preproc_node),
+                             tensors, 'in{}'.format(n+1))
+            workflow.connect(sub_workflow, '{}.image_info'.format(preproc_node),
+                             image_infos, 'in{}'.format(n+1))
+            if subject not in datasinks:
+                datasinks[subject] = subject.datasink(
+                    name='datasink_{}'.format(sub_workflow.name))
+            select = nipype.Node(Select(index=n), name='select_{}'.format(n))
+            workflow.connect(lung_seg, 'segmented_lungs', select, 'inlist')
+            workflow.connect(select, 'out', datasinks[subject], datasink_entry)
+
+        return workflow
+
+    def runner(self, workflow):
+
+        if self.cores == 0:
+            workflow.run()
+        else:
+            workflow.run('MultiProc', plugin_args={'n_procs': self.cores})
@@ -4,11 +4,10 @@ from nipype.interfaces.ants import ApplyTransforms
 from nipype.interfaces.utility import Merge
 from radiants.interfaces.ants import AntsRegSyn
 from core.workflows.base import BaseWorkflow
-from radiants.workflows.bet import BETWorkflow
+from radiants.workflows.bet import BETWorkflow, POSSIBLE_REF
 
 
 TOREG = ['T1KM', 'T1', 'FLAIR', 'SWI', 'T2', 'ADC']
-POSSIBLE_REF = ['T1KM', 'T1'] # order is important! 
 
 
 class RegistrationWorkflow(BaseWorkflow):
@@ -1,11 +1,16 @@
 "Segmentation workflows"
+import re
 import nipype
-from nipype.interfaces.utility import Merge
-from radiants.interfaces.utils import NNUnetPreparation
-from radiants.interfaces.mic import HDGlioPredict, NNUnetInference
+from nipype.interfaces.utility import Merge, Select, Rename
+from radiants.interfaces.utils import (
+    NNUnetPreparation, NNUnetCohortPreparation, BrainBoundingBoxCrop,
+    BoundingBoxPaste)
+from radiants.interfaces.mic import (
+    HDGlioPredict, NNUnetInference, NNUnetMultiModelInference)
 from core.workflows.base import BaseWorkflow
 from nipype.interfaces.ants import ApplyTransforms
 from radiants.workflows.registration import RegistrationWorkflow, POSSIBLE_REF
+from radiants.workflows.bet import BETWorkflow
 
 
 NEEDED_SEQUENCES = ['T1KM', 'T1', 'FLAIR', 'T2']
@@ -14,12 +19,24 @@ NEEDED_SEQUENCES = ['T1KM', 'T1', 'FLAIR', 'T2']
 class TumorSegmentation(BaseWorkflow):
     
     def __init__(self, gtv_model=None, tumor_model=None,
-                 normalize=True, **kwargs):
+                 normalize=True, predictor_socket=None, cohort=False,
+                 preprocessing_cache=None, crop_to_brain=False, crop_margin=10.0,
+                 fold_parallel=False, **kwargs):
         
         super().__init__(**kwargs)
         self.gtv_model = gtv_model
         self.tumor_model = tumor_model
         self.normalize = normalize
+        self.predictor_socket = predictor_socket
+        self.cohort = cohort
+        self.cohort_cases = []
+        self.preprocessing_cache = preprocessing_cache
+        self.crop_to_brain = crop_to_brain
+        self.crop_margin = crop_margin
+        self.fold_parallel = fold_parallel
+        if cohort and crop_to_brain:
+            raise Exception('The brain crop cannot be used with the cohort '
+                            'segmentation!')
 
     @staticmethod
     def workflow_inputspecs(additional_inputs=None):
@@ -35,13 +52,17 @@ class TumorSegmentation(BaseWorkflow):
             '_reg2MR_RT_linear_mat': {'mandatory': False, 'format': '.mat', 'dependency': RegistrationWorkflow,
                      'possible_sequences': ['T1KM', 'T1'], 'multiplicity': 'mrrt', 'composite': None},
             '_reg_reg2RTCT_linear_mat': {'mandatory': False, 'format': '.mat', 'dependency': RegistrationWorkflow,
-                     'possible_sequences': ['T1KM', 'T1'], 'multiplicity': 'rt', 'composite': None}}
+                     'possible_sequences': ['T1KM', 'T1'], 'multiplicity': 'rt', 'composite': None},
+            '_preproc_mask': {'mandatory': False, 'format': '.nii.gz', 'dependency': BETWorkflow,
+                     'possible_sequences': POSSIBLE_REF, 'multiplicity': 'all', 'composite': None}}
         dependencies = {}
         dependencies[RegistrationWorkflow] = {
             '_reg': {'mandatory': True, 'format': '.nii.gz'},
             '_reg2MR_RT_warp': {'mandatory': False, 'format': '.nii.gz'},
             '_reg2MR_RT_linear_mat': {'mandatory': False, 'format': '.mat'},
             '_reg_reg2RTCT_linear_mat': {'mandatory': False, 'format': '.mat'}}
+        dependencies[BETWorkflow] = {
+            '_preproc_mask': {'mandatory': False, 'format': '.nii.gz'}}
         formats = {}
         for k in dependencies:
             for entry in dependencies[k]:
@@ -86,8 +107,14 @@ class TumorSegmentation(BaseWorkflow):
         sub_id = self.sub_id
 
         tosegment = {**dict_sequences['MR-RT'], **dict_sequences['OT']}
-        workflow = nipype.Workflow('segmentation_workflow',
-                                   base_dir=nipype_cache)
+        if self.cohort:
+            # the subject workflows become part of one cohort workflow
+            workflow_name = 'segmentation_workflow_{}'.format(
+                re.sub(r'\W', '_', sub_id))
+        else:
+            workflow_name = 'segmentation_workflow'
+        workflow = nipype.Workflow(workflow_name, base_dir=nipype_cache)
+        self.cohort_cases = []
         datasink = nipype.Node(nipype.DataSink(base_directory=result_dir),
                                "datasink")
         substitutions = [('subid', sub_id)]
@@ -132,64 +159,143 @@ class TumorSegmentation(BaseWorkflow):
                     two_modalities_seg = False
                 else:
                     two_modalities_seg = True
+                inputs = {seq: (datasource, '{0}_{1}'.format(key, seq))
+                          for seq in ['T1KM_reg', 'FLAIR_reg', 'T1_reg', 'T2_reg']}
+                crop = None
+                if self.crop_to_brain and (hd_glio or two_modalities_seg):
+                    workflow, crop, inputs = self.brain_crop(
+                        workflow, datasource, key, scans, inputs)
                 if hd_glio:
                     tumor_seg  = nipype.Node(
                         interface=HDGlioPredict(),
                         name='{}_tumor_segmentation'.format(key))
                     tumor_seg.inputs.out_file = 'Tumor_segmentation'
-                    workflow.connect(datasource, '{}_T1KM_reg'.format(key),
-                                     tumor_seg, 'ct1')
-                    workflow.connect(datasource, '{}_T2_reg'.format(key),
-                                     tumor_seg, 't2')
-                    workflow.connect(datasource, '{}_FLAIR_reg'.format(key),
-                                     tumor_seg, 'flair')
-                    workflow.connect(datasource, '{}_T1_reg'.format(key),
-                                     tumor_seg, 't1')
+                    if self.predictor_socket is not None:
+                        tumor_seg.inputs.service_socket = self.predictor_socket
+                    workflow.connect(*inputs['T1KM_reg'], tumor_seg, 'ct1')
+                    workflow.connect(*inputs['T2_reg'], tumor_seg, 't2')
+                    workflow.connect(*inputs['FLAIR_reg'], tumor_seg, 'flair')
+                    workflow.connect(*inputs['T1_reg'], tumor_seg, 't1')
+                    workflow, tumor_seg, seg_output = self.paste(
+                        workflow, crop, tumor_seg, 'out_file',
+                        (tumor_seg, 'inference_time'))
                     workflow.connect(
-                        tumor_seg, 'out_file', datasink,
+                        tumor_seg, seg_output, datasink,
                         'results.subid.{}.@tumor_seg'.format(key))
                     workflow, datasink = self.apply_transformations(
-                        'out_file', tumor_seg, 'Tumor_segmentation', datasource,
+                        seg_output, tumor_seg, 'Tumor_segmentation', datasource,
                         workflow, mr_rt_ref, rtct, key, ref_session, datasink)
                 
-                if two_modalities_seg:
+                if two_modalities_seg and self.cohort:
+                    # the nnUNet inference is run by TumorSegmentationCohort,
+                    # which sends the segmentations to the Rename nodes
+                    case = {'inputs': ['{}_T1KM_reg'.format(key),
+                                       '{}_FLAIR_reg'.format(key)]}
+                    self.cohort_cases.append(case)
+                elif two_modalities_seg:
                     mi = nipype.Node(Merge(2), name='{}_merge'.format(key))
                     gtv_seg_data_prep = nipype.Node(
                         interface=NNUnetPreparation(),
                         name='{}_two_modalities_seg_data_prep'.format(key))
-                    workflow.connect(datasource, '{}_T1KM_reg'.format(key),
-                                     mi, 'in1')
-                    workflow.connect(datasource, '{}_FLAIR_reg'.format(key),
-                                     mi, 'in2')
+                    workflow.connect(*inputs['T1KM_reg'], mi, 'in1')
+                    workflow.connect(*inputs['FLAIR_reg'], mi, 'in2')
                     workflow.connect(mi, 'out', gtv_seg_data_prep,
                                      'images')
+                    nnunet_seg = None
+                    if gtv_model is not None and tumor_model is not None:
+                        # both models share the nnUNet preprocessing of the case
+                        nnunet_seg = nipype.Node(
+                            interface=NNUnetMultiModelInference(),
+                            name='{}_nnunet_segmentation'.format(key))
+                        nnunet_seg.inputs.model_folders = [gtv_model, tumor_model]
+                        nnunet_seg.inputs.prefixes = ['gtv', 'tumor_2mod']
+                        nnunet_seg.inputs.fold_parallel = self.fold_parallel
+                        if self.preprocessing_cache is not None:
+                            nnunet_seg.inputs.cache_dir = self.preprocessing_cache
+                        if self.predictor_socket is not None:
+                            nnunet_seg.inputs.service_socket = self.predictor_socket
+                        workflow.connect(gtv_seg_data_prep, 'output_folder',
+                                         nnunet_seg, 'input_folder')
+                if two_modalities_seg:
                     if gtv_model is not None:
-                        gtv_seg = nipype.Node(
-                            interface=NNUnetInference(),
-                            name='{}_gtv_segmentation'.format(key))
-                        gtv_seg.inputs.model_folder = gtv_model
-                        gtv_seg.inputs.prefix = 'gtv'
-                        workflow.connect(
-                            gtv_seg_data_prep, 'output_folder',
-                            gtv_seg, 'input_folder')
-                        workflow.connect(gtv_seg, 'output_file', datasink,
+                        if self.cohort:
+                            gtv_seg = nipype.Node(
+                                interface=Rename(format_string='subject1',
+                                                 keep_ext=True),
+                                name='{}_gtv_segmentation'.format(key))
+                            case['gtv'] = '{}.in_file'.format(gtv_seg.name)
+                            seg_output = 'out_file'
+                            timing = None
+                        elif nnunet_seg is not None:
+                            gtv_seg = nipype.Node(
+                                interface=Select(index=0),
+                                name='{}_gtv_segmentation'.format(key))
+                            workflow.connect(nnunet_seg, 'output_files',
+                                             gtv_seg, 'inlist')
+                            seg_output = 'out'
+                            timing = self.model_time(workflow, crop, nnunet_seg,
+                                                     0, gtv_seg.name)
+                        else:
+                            gtv_seg = nipype.Node(
+                                interface=NNUnetInference(),
+                                name='{}_gtv_segmentation'.format(key))
+                            gtv_seg.inputs.model_folder = gtv_model
+                            gtv_seg.inputs.prefix = 'gtv'
+                            gtv_seg.inputs.fold_parallel = self.fold_parallel
+                            if self.predictor_socket is not None:
+                                gtv_seg.inputs.service_socket = self.predictor_socket
+                            workflow.connect(
+                                gtv_seg_data_prep, 'output_folder',
+                                gtv_seg, 'input_folder')
+                            seg_output = 'output_file'
+                            timing = (gtv_seg, 'inference_time')
+                        workflow, gtv_seg, seg_output = self.paste(
+                            workflow, crop, gtv_seg, seg_output, timing)
+                        workflow.connect(gtv_seg, seg_output, datasink,
                                          'results.subid.{}.GTV.@gtv_seg'.format(key))
                         workflow, datasink = self.apply_transformations(
-                            'output_file', gtv_seg, 'GTV_segmentation', datasource,
+                            seg_output, gtv_seg, 'GTV_segmentation', datasource,
                             workflow, mr_rt_ref, rtct, key, ref_session, datasink)
                     if tumor_model is not None:
-                        tumor_seg_2mods = nipype.Node(
-                            interface=NNUnetInference(),
-                            name='{}_tumor_seg_2mods'.format(key))
-                        tumor_seg_2mods.inputs.model_folder = tumor_model
-                        tumor_seg_2mods.inputs.prefix = 'tumor_2mod'
-                        workflow.connect(
-                            gtv_seg_data_prep, 'output_folder',
-                            tumor_seg_2mods, 'input_folder')
-                        workflow.connect(tumor_seg_2mods, 'output_file', datasink,
+                        if self.cohort:
+                            tumor_seg_2mods = nipype.Node(
+                                interface=Rename(format_string='subject1',
+                                                 keep_ext=True),
+                                name='{}_tumor_seg_2mods'.format(key))
+                            case['tumor_2mod'] = '{}.in_file'.format(
+                                tumor_seg_2mods.name)
+                            seg_output = 'out_file'
+                            timing = None
+                        elif nnunet_seg is not None:
+                            tumor_seg_2mods = nipype.Node(
+                                interface=Select(index=1),
+                                name='{}_tumor_seg_2mods'.format(key))
+                            workflow.connect(nnunet_seg, 'output_files',
+                                             tumor_seg_2mods, 'inlist')
+                            seg_output = 'out'
+                            timing = self.model_time(workflow, crop, nnunet_seg,
+                                                     1, tumor_seg_2mods.name)
+                        else:
+                            tumor_seg_2mods = nipype.Node(
+                                interface=NNUnetInference(),
+                                name='{}_tumor_seg_2mods'.format(key))
+                            tumor_seg_2mods.inputs.model_folder = tumor_model
+                            tumor_seg_2mods.inputs.prefix = 'tumor_2mod'
+                            tumor_seg_2mods.inputs.fold_parallel = self.fold_parallel
+                            if self.predictor_socket is not None:
+                                tumor_seg_2mods.inputs.service_socket = (
+                                    self.predictor_socket)
+                            workflow.connect(
+                                gtv_seg_data_prep, 'output_folder',
+                                tumor_seg_2mods, 'input_folder')
+                            seg_output = 'output_file'
+                            timing = (tumor_seg_2mods, 'inference_time')
+                        workflow, tumor_seg_2mods, seg_output = self.paste(
+                            workflow, crop, tumor_seg_2mods, seg_output, timing)
+                        workflow.connect(tumor_seg_2mods, seg_output, datasink,
                                          'results.subid.{}.tumor.@tumor_seg2mod'.format(key))
                         workflow, datasink = self.apply_transformations(
-                            'output_file', tumor_seg_2mods, 'Tumor_segmentation_2modalities',
+                            seg_output, tumor_seg_2mods, 'Tumor_segmentation_2modalities',
                             datasource, workflow, mr_rt_ref, rtct, key, ref_session,
                             datasink)
 
@@ -197,6 +303,77 @@ class TumorSegmentation(BaseWorkflow):
 
         return workflow
 
+    def brain_crop(self, workflow, datasource, session, scans, inputs):
+        """Function to crop the images of one session to the brain, using
+        the mask of the registration reference, whose space is the one of all
+        the registered images. The segmentation inputs are then taken from the
+        crop node.
+        """
+        ref = None
+        for pr in POSSIBLE_REF:
+            if '{}_preproc_mask'.format(pr) in scans and '{}_reg'.format(pr) in scans:
+                ref = pr
+                break
+        if ref is None:
+            print('No brain mask found for session {}, the whole images will '
+                  'be segmented.'.format(session))
+            return workflow, None, inputs
+
+        to_crop = [seq for seq in inputs if seq in scans]
+        merge = nipype.Node(Merge(len(to_crop)),
+                            name='{}_merge_to_crop'.format(session))
+        crop = nipype.Node(interface=BrainBoundingBoxCrop(),
+                           name='{}_brain_crop'.format(session))
+        crop.inputs.margin = self.crop_margin
+        for i, seq in enumerate(to_crop):
+            workflow.connect(*inputs[seq], merge, 'in{}'.format(i+1))
+        workflow.connect(merge, 'out', crop, 'images')
+        workflow.connect(datasource, '{0}_{1}_preproc_mask'.format(session, ref),
+                         crop, 'mask')
+        cropped = {}
+        for i, seq in enumerate(to_crop):
+            select = nipype.Node(Select(index=i), name='{0}_{1}_cropped'.format(
+                session, seq))
+            workflow.connect(crop, 'cropped_images', select, 'inlist')
+            cropped[seq] = (select, 'out')
+        # the segmentations are pasted back into the grid of the reference
+        reference = (datasource, '{0}_{1}_reg'.format(session, ref))
+
+        return workflow, (crop, reference), cropped
+
+    def model_time(self, workflow, crop, nnunet_seg, index, name):
+        """Function to select the inference time of one model of a
+        NNUnetMultiModelInference node, if the brain crop is used.
+        """
+        if crop is None:
+            return None
+        select = nipype.Node(interface=Select(index=index),
+                             name='{}_time'.format(name))
+        workflow.connect(nnunet_seg, 'inference_times', select, 'inlist')
+
+        return select, 'out'
+
+    def paste(self, workflow, crop, node, output, timing=None):
+        """Function to paste the segmentation of the cropped images back into
+        the original geometry, if the brain crop is used. timing is the
+        (node, output) with the inference time of the segmentation, used to
+        estimate the time saved by the crop.
+        """
+        if crop is None:
+            return workflow, node, output
+
+        crop, reference = crop
+        paste = nipype.Node(interface=BoundingBoxPaste(),
+                            name='{}_paste'.format(node.name))
+        workflow.connect(node, output, paste, 'in_file')
+        workflow.connect(*reference, paste, 'reference')
+        for name in ['bounding_box', 'voxel_ratio']:
+            workflow.connect(crop, name, paste, name)
+        if timing is not None:
+            workflow.connect(*timing, paste, 'inference_time')
+
+        return workflow, paste, 'out_file'
+
     def apply_transformations(self, tonormalize, node, node_name, datasource,
                               workflow, mr_rt_ref, rtct, session, ref_session,
                               datasink):
@@ -256,3 +433,85 @@ class TumorSegmentation(BaseWorkflow):
             workflow.connect(merge_rt_ref, 'out', apply_ts_rt_ref, 'transforms')
     
         return workflow, datasink
+
+
+class TumorSegmentationCohort(object):
+    """nnUNet tumor segmentation of a whole cohort with one inference per
+    model. Each subject workflow (TumorSegmentation with cohort=True) runs
+    everything but the nnUNet inference. The T1KM/FLAIR pairs of all the
+    sessions are staged in one folder, each under a unique case ID, so
+    nnUNet loads every model once and preprocesses the next cases while
+    predicting the current one. The segmentations are then sent back to
+    the subject workflows, which save and normalize them as usual.
+    """
+    def __init__(self, subjects, gtv_model, tumor_model, base_dir, cores=0,
+                 predictor_socket=None, num_threads_preprocessing=6,
+                 num_threads_nifti_save=2, fold_parallel=False):
+
+        self.subjects = subjects
+        self.gtv_model = gtv_model
+        self.tumor_model = tumor_model
+        self.base_dir = base_dir
+        self.cores = cores
+        self.predictor_socket = predictor_socket
+        self.num_threads_preprocessing = num_threads_preprocessing
+        self.num_threads_nifti_save = num_threads_nifti_save
+        self.fold_parallel = fold_parallel
+
+    def workflow(self):
+        "Function to combine the subject workflows into the cohort workflow"
+        workflow = nipype.Workflow('tumor_segmentation_cohort',
+                                   base_dir=self.base_dir)
+        cases = []
+        sources = {}
+        for subject, sub_workflow in self.subjects:
+            if not subject.cohort_cases:
+                continue
+            # the images are read by a copy of the subject datasource,
+            # otherwise the subject workflow would be both upstream and
+            # downstream of the cohort inference
+            sources[sub_workflow.name] = subject.data_source.clone(
+                'datasource_{}'.format(re.sub(r'\W', '_', subject.sub_id)))
+            cases += [(sub_workflow, case) for case in subject.cohort_cases]
+        if not cases:
+            return workflow
+        case_ids = ['case{:04d}'.format(n) for n in range(len(cases))]
+        images = nipype.Node(Merge(2*len(cases)), name='images')
+        data_prep = nipype.Node(interface=NNUnetCohortPreparation(),
+                                name='cohort_seg_data_prep')
+        data_prep.inputs.case_ids = case_ids
+        workflow.connect(images, 'out', data_prep, 'images')
+        for n, (sub_workflow, case) in enumerate(cases):
+            for i, image in enumerate(case['inputs']):
+                workflow.connect(sources[sub_workflow.name], image, images,
+                                 'in{}'.format(2*n+i+1))
+
+        for model_folder, prefix in [(self.gtv_model, 'gtv'),
+                                     (self.tumor_model, 'tumor_2mod')]:
+            if model_folder is None:
+                continue
+            seg = nipype.Node(interface=NNUnetInference(),
+                              name='cohort_{}_segmentation'.format(prefix))
+            seg.inputs.model_folder = model_folder
+            seg.inputs.prefix = prefix
+            seg.inputs.case_ids = case_ids
+            seg.inputs.num_threads_preprocessing = self.num_threads_preprocessing
+            seg.inputs.num_threads_nifti_save = self.num_threads_nifti_save
+            seg.inputs.fold_parallel = self.fold_parallel
+            if self.predictor_socket is not None:
+                seg.inputs.service_socket = self.predictor_socket
+            workflow.connect(data_prep, 'output_folder', seg, 'input_folder')
+            for n, (sub_workflow, case) in enumerate(cases):
+                select = nipype.Node(Select(index=n),
+                                     name='select_{0}_{1}'.format(prefix, n))
+                workflow.connect(seg, 'case_files', select, 'inlist')
+                workflow.connect(select, 'out', sub_workflow, case[prefix])
+
+        return workflow
+
+    def runner(self, workflow):
+
+        if self.cores == 0:
+            workflow.run()
+        else:
+            workflow.run('MultiProc', plugin_args={'n_procs': self.cores})
@@ -0,0 +1,85 @@
+"Equivalence check and benchmark of the prefetching patch loader"
+import os
+import argparse
+import tempfile
+import shutil
+import time
+import numpy as np
+import nrrd
+from radiants.utils.dataloader import load_data_2D, PatchLoader
+
+
+def synchronous_loading(data_dir, data_type, mask_type, img_size, batch_size):
+    "Loading as done with load_data_2D, bs files at a time"
+    n_files = len(PatchLoader(data_dir, data_type, img_size=img_size).data_list)
+    for init in range(0, n_files, batch_size):
+        x, _ = load_data_2D(data_dir, data_type, mb=[], bs=init+batch_size,
+                            init=init, img_size=img_size)
+        y, _ = load_data_2D(data_dir, mask_type, mb=[], bs=init+batch_size,
+                            init=init, img_size=img_size, binarize=True)
+        yield x, y
+
+
+def main():
+
+    PARSER = argparse.ArgumentParser()
+
+    PARSER.add_argument('--n-files', type=int, default=400,
+                        help=('Number of synthetic images (and masks) to create. '
+                              'Default is 400.'))
+    PARSER.add_argument('--size', nargs=2, type=int, default=[192, 192],
+                        help=('Size of the synthetic 2D images. Default is 192 192.'))
+    PARSER.add_argument('--batch-size', '-bs', type=int, default=64,
+                        help=('Number of patches per batch. Default is 64.'))
+    PARSER.add_argument('--workers', type=int, default=2,
+                        help=('Number of threads reading the files. Default is 2.'))
+    PARSER.add_argument('--step-time', type=float, default=0.01,
+                        help=('Time (in seconds) spent by the simulated network on each '
+                              'batch. Default is 0.01.'))
+
+    ARGS = PARSER.parse_args()
+
+    img_size = tuple(ARGS.size)
+    data_dir = tempfile.mkdtemp()
+    try:
+        for n in range(ARGS.n_files):
+            image = np.random.uniform(-1024, 2000, img_size).astype(np.int16)
+            nrrd.write(os.path.join(data_dir, 'image_{:04d}.nrrd'.format(n)), image,
+                       header={'encoding': 'gzip'})
+            nrrd.write(os.path.join(data_dir, 'mask_{:04d}.nrrd'.format(n)),
+                       (image > 0).astype(np.uint8), header={'encoding': 'gzip'})
+        loader = PatchLoader(data_dir, 'image_*.nrrd', 'mask_*.nrrd',
+                             batch_size=ARGS.batch_size, img_size=img_size,
+                             loop=False, workers=ARGS.workers)
+        # one synchronous call per batch worth of files
+        files_per_batch = max(ARGS.batch_size*len(loader.data_list)
+                              // loader.n_patches, 1)
+
+        start = time.time()
+        reference = []
+        for x, y in synchronous_loading(data_dir, 'image_*.nrrd', 'mask_*.nrrd',
+                                        img_size, files_per_batch):
+            time.sleep(ARGS.step_time)
+            reference.append((x, y))
+        t_reference = time.time() - start
+        start = time.time()
+        batches = []
+        for x, y in loader:
+            time.sleep(ARGS.step_time)
+            batches.append((x, y))
+        t_loader = time.time() - start
+
+        same = all(np.array_equal(np.concatenate([b[i] for b in reference]),
+                                  np.concatenate([b[i] for b in batches]))
+                   for i in range(2))
+        print('{0} patches in {1} batches: {2:.2f} s -> {3:.2f} s, identical '
+              'patches: {4}.'.format(loader.n_patches, len(loader), t_reference,
+                                     t_loader, same))
+        if not same:
+            raise Exception('The patches of the two loaders are different!')
+    finally:
+        shutil.rmtree(data_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"Benchmark of the fold-parallel ensemble evaluation against the sequential one, for increasing core counts"
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+import nibabel as nib
+from radiants.utils.ensemble import (
+    run_ensemble, stub_member, average_softmax, hd_bet_parallel)
+
+
+def core_counts(max_cores):
+
+    counts = [2**i for i in range(max_cores.bit_length()) if 2**i <= max_cores]
+
+    return sorted(set(counts + [max_cores]))
+
+
+def stub_benchmark(work_dir, n_members, size, kernel_size, counts):
+    "Function to benchmark the stub ensemble (3D convolutions) on a synthetic image"
+    rng = np.random.RandomState(42)
+    data = rng.normal(size=size).astype(np.float32)
+    args = []
+    for i in range(n_members):
+        kernel_file = os.path.join(work_dir, 'member_{}.npy'.format(i))
+        np.save(kernel_file, rng.uniform(-1, 1, [kernel_size]*3).astype(np.float32))
+        args.append((kernel_file, data))
+
+    start = time.time()
+    reference = average_softmax([stub_member(*a) for a in args])
+    t_sequential = time.time() - start
+    print('Sequential evaluation of {0} members: {1:.2f} s.'.format(
+        n_members, t_sequential))
+    for cores in counts:
+        processes = min(n_members, cores)
+        start = time.time()
+        softmax = average_softmax(run_ensemble(
+            stub_member, args, processes, max(cores//processes, 1)))
+        t_parallel = time.time() - start
+        print('{0:3d} cores ({1} processes): {2:.2f} s, speedup {3:.2f}. Identical '
+              'softmax: {4}.'.format(cores, processes, t_parallel,
+                                     t_sequential/t_parallel,
+                                     np.array_equal(reference, softmax)))
+        if not np.array_equal(reference, softmax):
+            raise Exception('The parallel ensemble is different from the '
+                            'sequential one!')
+
+
+def hd_bet_benchmark(work_dir, image, counts):
+    """Function to benchmark HD-BET (accurate mode, on CPU) on one image. For
+    each core count, the sequential run uses as many torch threads.
+    """
+    import torch
+    from HD_BET.run import run_hd_bet
+
+    for cores in counts:
+        torch.set_num_threads(cores)
+        sequential = os.path.join(work_dir, 'sequential_{}.nii.gz'.format(cores))
+        start = time.time()
+        run_hd_bet(image, sequential, mode='accurate', device='cpu',
+                   postprocess=True, do_tta=True)
+        t_sequential = time.time() - start
+        parallel = os.path.join(work_dir, 'parallel_{}.nii.gz'.format(cores))
+        processes = min(5, cores)
+        start = time.time()
+        hd_bet_parallel(image, parallel, parallel.replace('.nii.gz', '_mask.nii.gz'),
+                        processes=processes, threads=max(cores//processes, 1))
+        t_parallel = time.time() - start
+        same = np.array_equal(
+            nib.load(sequential.replace('.nii.gz', '_mask.nii.gz')).get_fdata(),
+            nib.load(parallel.replace('.nii.gz', '_mask.nii.gz')).get_fdata())
+        print('{0:3d} cores: {1:.1f} s sequential, {2:.1f} s with {3} processes, '
+              'speedup {4:.2f}. Identical masks: {5}.'.format(
+                  cores, t_sequential, t_parallel, processes,
+                  t_sequential/t_parallel, same))
+
+
+def main():
+
+    PARSER = argparse.ArgumentParser()
+
+    PARSER.add_argument('--hd-bet', type=str, default=None,
+                        help=('Image to extract the brain from with HD-BET. If not '
+                              'provided, a stub ensemble of 3D convolutions is used. '
+                              'Default is None.'))
+    PARSER.add_argument('--members', type=int, default=5,
+                        help=('Number of members of the stub ensemble. Default is 5.'))
+    PARSER.add_argument('--size', nargs=3, type=int, default=[128, 128, 128],
+                        help=('Size of the synthetic image of the stub ensemble. '
+                              'Default is 128 128 128.'))
+    PARSER.add_argument('--kernel-size', type=int, default=7,
+                        help=('Size of the convolution kernel of each stub member. '
+                              'Default is 7.'))
+    PARSER.add_argument('--max-cores', type=int, default=multiprocessing.cpu_count(),
+                        help=('Maximum number of cores to test. Default is the number '
+                              'of cores of this host.'))
+
+    ARGS = PARSER.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        counts = core_counts(ARGS.max_cores)
+        if ARGS.hd_bet is None:
+            stub_benchmark(work_dir, ARGS.members, ARGS.size, ARGS.kernel_size,
+                           counts)
+        else:
+            hd_bet_benchmark(work_dir, ARGS.hd_bet, counts)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
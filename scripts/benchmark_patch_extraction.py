@@ -0,0 +1,61 @@
+"Benchmark of the per-slice and whole-volume 2D patch extraction"
+import argparse
+import time
+import numpy as np
+from radiants.utils.dataloader import load_data_2D, load_volume_2D
+
+
+def slice_loop(volume, patch_size):
+    "Patch extraction as it was done in LungSegmentationPreproc.create_tensors"
+    image_tensor = []
+    im_size = volume.shape[:2]
+    for n_slice in range(volume.shape[2]):
+        im_array, _ = load_data_2D(
+            '', '', array=volume[:, :, n_slice], img_size=im_size,
+            patch_size=patch_size, binarize=False, normalization=True,
+            mb=[], prediction=True)
+        for j in range(im_array.shape[0]):
+            image_tensor.append(im_array[j, :])
+
+    return np.asarray(image_tensor).reshape(
+        -1, im_array.shape[1], im_array.shape[2], 1)
+
+
+def main():
+
+    PARSER = argparse.ArgumentParser()
+
+    PARSER.add_argument('--size', '-s', nargs=3, type=int, default=[512, 512, 300],
+                        help=('Size of the synthetic volume. Default is 512 512 300.'))
+    PARSER.add_argument('--patch-size', '-p', nargs=2, type=int, default=[96, 96],
+                        help=('Patch size. Default is 96 96.'))
+    PARSER.add_argument('--repeats', '-r', type=int, default=3,
+                        help=('Number of times each method is run. Default is 3.'))
+
+    ARGS = PARSER.parse_args()
+
+    # nibabel returns Fortran ordered arrays
+    volume = np.asfortranarray(np.random.uniform(-1024, 2000, ARGS.size))
+    patch_size = tuple(ARGS.patch_size)
+
+    timings = {'slice loop': [], 'volume': []}
+    for _ in range(ARGS.repeats):
+        t0 = time.perf_counter()
+        reference = slice_loop(volume, patch_size)
+        timings['slice loop'].append(time.perf_counter()-t0)
+        t0 = time.perf_counter()
+        tensor, _ = load_volume_2D(volume, patch_size=patch_size)
+        timings['volume'].append(time.perf_counter()-t0)
+
+    max_diff = np.max(np.abs(reference.astype(np.float32)-tensor))
+    print('Volume size: {0}, patches: {1}, max abs difference: {2}'.format(
+        ARGS.size, tensor.shape[0], max_diff))
+    for method, times in timings.items():
+        print('{0:>12}: best {1:.3f} s, mean {2:.3f} s'.format(
+            method, np.min(times), np.mean(times)))
+    print('Speed-up: {:.1f}x'.format(
+        np.min(timings['slice loop'])/np.min(timings['volume'])))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"Benchmark of the predictor service against one subprocess per job, with a stub model"
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import nibabel as nib
+from radiants.utils.predictor_service import submit
+
+
+STUB_JOB = ('import sys; from radiants.utils.predictor_service import run_stub_job; '
+            'run_stub_job(*sys.argv[1:])')
+
+
+def main():
+
+    PARSER = argparse.ArgumentParser()
+
+    PARSER.add_argument('--n-jobs', type=int, default=10,
+                        help=('Number of segmentation jobs. Default is 10.'))
+    PARSER.add_argument('--size', nargs=3, type=int, default=[64, 64, 64],
+                        help=('Size of the synthetic images. Default is 64 64 64.'))
+    PARSER.add_argument('--folds', type=int, default=5,
+                        help=('Number of folds of the stub model. Default is 5.'))
+    PARSER.add_argument('--checkpoint-size', type=int, default=50,
+                        help=('Size, in MB, of the checkpoint of each fold. Default '
+                              'is 50.'))
+
+    ARGS = PARSER.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    model_folder = os.path.join(work_dir, 'model')
+    os.mkdir(model_folder)
+    try:
+        rng = np.random.RandomState(42)
+        side = int(round((ARGS.checkpoint_size*1024**2/4.)**(1/3.)))
+        for fold in range(ARGS.folds):
+            # only the central 3x3x3 voxels are used, the rest is loading cost
+            checkpoint = rng.uniform(-1, 1, (side, side, side)).astype(np.float32)
+            np.save(os.path.join(model_folder, 'fold_{}.npy'.format(fold)),
+                    checkpoint)
+        images = []
+        for n in range(ARGS.n_jobs):
+            images.append(os.path.join(work_dir, 'image_{}.nii.gz'.format(n)))
+            nib.save(nib.Nifti1Image(rng.normal(size=ARGS.size).astype(np.float32),
+                                     np.eye(4)), images[-1])
+
+        start = time.time()
+        for image in images:
+            subprocess.check_call([sys.executable, '-c', STUB_JOB, model_folder,
+                                   image, image.replace('.nii.gz', '_sub.nii.gz')])
+        t_subprocess = time.time() - start
+
+        socket_path = os.path.join(work_dir, 'predictor.sock')
+        service = subprocess.Popen([
+            sys.executable, '-c', 'import sys; from radiants.utils.predictor_service '
+            'import PredictorService; PredictorService(sys.argv[1]).serve()',
+            socket_path])
+        while not os.path.exists(socket_path):
+            if service.poll() is not None:
+                raise Exception('The predictor service could not be started!')
+            time.sleep(0.05)
+        start = time.time()
+        job_times = []
+        for image in images:
+            response = submit('stub', socket_path, model_folder=model_folder,
+                              in_file=image,
+                              out_file=image.replace('.nii.gz', '_service.nii.gz'))
+            job_times.append(response['time'])
+        t_service = time.time() - start
+        submit('shutdown', socket_path)
+        service.wait()
+
+        same = all(np.array_equal(
+            nib.load(image.replace('.nii.gz', '_sub.nii.gz')).get_fdata(),
+            nib.load(image.replace('.nii.gz', '_service.nii.gz')).get_fdata())
+                   for image in images)
+        print('{0} jobs: {1:.2f} s with one subprocess per job, {2:.2f} s with the '
+              'service (first job {3:.2f} s, then {4:.3f} s per job). Identical '
+              'segmentations: {5}.'.format(ARGS.n_jobs, t_subprocess, t_service,
+                                           job_times[0], np.mean(job_times[1:]),
+                                           same))
+        if not same:
+            raise Exception('The segmentations of the service are different!')
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"Equivalence check and benchmark of the 2D patch reconstruction"
+import argparse
+import time
+import numpy as np
+from radiants.utils.dataloader import load_volume_2D, reconstruct_volume_2D
+
+
+def nanmean_reconstruction(generated_images, patches, slices, dims, indexes,
+                           deltas):
+    "Reconstruction as it was done in LungSegmentationInference"
+    if patches > 1:
+        sl = 0
+        final_image = np.zeros((slices, dims[0], dims[1], patches),
+                               dtype=np.float32)-2
+        for n in range(0, generated_images.shape[0], patches):
+            k = 0
+            for j in indexes[1]:
+                for i in indexes[0]:
+                    final_image[sl, i[0]:i[1], j[0]:j[1], k] = (
+                        generated_images[n+k, deltas[0]:, deltas[1]:])
+                    k += 1
+            sl = sl + 1
+        final_image[final_image==-2] = np.nan
+        final_image = np.nanmean(final_image, axis=-1)
+        final_image[np.isnan(final_image)] = 0
+    else:
+        final_image = generated_images[:, deltas[0]:, deltas[1]:]
+
+    return final_image
+
+
+def check(size, patch_size):
+    "Function to compare the two reconstructions on a random prediction"
+    volume = np.random.uniform(-1024, 2000, size)
+    tensor, info = load_volume_2D(volume, patch_size=patch_size)
+    prediction = np.random.uniform(
+        0, 1, tensor.shape[:3]).astype(np.float32)
+    t0 = time.perf_counter()
+    reference = nanmean_reconstruction(
+        prediction, info['patches'], info['slices'], info['image_dim'],
+        info['indexes'], info['deltas'])
+    t_reference = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    reconstructed = reconstruct_volume_2D(
+        prediction, info['image_dim'], info['indexes'], info['deltas'])
+    t_new = time.perf_counter() - t0
+    # identical patches must give back the original image where the patch
+    # grid covers it (the last rows/columns may not be covered)
+    coverage = reconstruct_volume_2D(
+        np.ones_like(prediction), info['image_dim'], info['indexes'],
+        info['deltas'])
+    ones = reconstruct_volume_2D(
+        np.ones_like(prediction), info['image_dim'], info['indexes'],
+        info['deltas'], blending='gaussian')
+    max_diff = np.max(np.abs(reference - reconstructed))
+    print('{0} patches per slice: {1:3d}, max abs difference: {2:.2e}, '
+          'gaussian max error: {3:.2e}, time: {4:.3f} s -> {5:.3f} s'.format(
+              size, info['patches'], max_diff, np.max(np.abs(ones - coverage)),
+              t_reference, t_new))
+
+    return max_diff < 1e-5 and np.allclose(ones, coverage, atol=1e-5)
+
+
+def main():
+
+    PARSER = argparse.ArgumentParser()
+
+    PARSER.add_argument('--size', '-s', nargs=3, type=int, default=[512, 512, 50],
+                        help=('Size of the synthetic volume used for the benchmark. '
+                              'Default is 512 512 50.'))
+
+    ARGS = PARSER.parse_args()
+
+    sizes = [(96, 96, 3), (60, 130, 4), (130, 60, 4), (97, 191, 5),
+             (200, 250, 5), (288, 288, 5), tuple(ARGS.size)]
+    results = [check(size, (96, 96)) for size in sizes]
+    if not all(results):
+        raise Exception('The reconstructions are not equivalent!')
+    print('All the reconstructions are equivalent.')
+
+
+if __name__ == "__main__":
+    main()
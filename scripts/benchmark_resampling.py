@@ -0,0 +1,124 @@
+"Benchmark of the skimage and SimpleITK resampling used in the lung preprocessing"
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import nibabel as nib
+import nrrd
+from skimage.transform import resize
+from core.utils.filemanip import split_filename
+from radiants.interfaces.custom_preproc import LungSegmentationPreproc
+
+
+def skimage_resize(image, order=0, new_spacing=(0.1, 0.1, 0.1), outdir=None):
+    "Resampling as it was done in LungSegmentationPreproc.resize_image"
+    _, fname, ext = split_filename(image)
+    outname = os.path.join(outdir, fname+'_resampled'+ext)
+    if ext == '.nrrd':
+        image, hd = nrrd.read(image)
+        space_x = np.abs(hd['space directions'][0, 0])
+        space_y = np.abs(hd['space directions'][1, 1])
+        space_z = np.abs(hd['space directions'][2, 2])
+    elif ext == '.nii.gz' or ext == '.nii':
+        hd = nib.load(image).header
+        affine = nib.load(image).affine
+        image = nib.load(image).get_data()
+        space_x, space_y, space_z = hd.get_zooms()
+
+    resampling_factor = (new_spacing[0]/space_x, new_spacing[1]/space_y, new_spacing[2]/space_z)
+    new_shape = (image.shape[0]//resampling_factor[0], image.shape[1]//resampling_factor[1],
+                 image.shape[2]//resampling_factor[2])
+    new_image = resize(image.astype(np.float64), new_shape, order=order, mode='edge',
+                       cval=0, anti_aliasing=False)
+    if ext == '.nrrd':
+        hd['sizes'] = np.array(new_image.shape)
+        hd['space directions'][0, 0] = new_spacing[0]
+        hd['space directions'][1, 1] = new_spacing[1]
+        hd['space directions'][2, 2] = new_spacing[2]
+        nrrd.write(outname, new_image, header=hd)
+    elif ext == '.nii.gz' or ext == '.nii':
+        im2save = nib.Nifti1Image(new_image, affine=affine)
+        nib.save(im2save, outname)
+    return new_image, tuple(map(int, new_shape)), outname, image.shape
+
+
+def run(method, image, new_spacing, outdir, num_threads):
+    "Function to run one resampling in a fresh process and measure it"
+    t0 = time.perf_counter()
+    if method == 'skimage':
+        resampled = skimage_resize(image, new_spacing=new_spacing,
+                                   outdir=outdir)[0]
+    else:
+        preproc = LungSegmentationPreproc(num_threads=num_threads)
+        resampled = preproc.resize_image(image, new_spacing=new_spacing,
+                                         outdir=outdir)[0]
+    elapsed = time.perf_counter() - t0
+    # VmHWM (unlike ru_maxrss) is not inherited from the parent process
+    with open('/proc/self/status') as f:
+        peak = [int(l.split()[1]) for l in f if l.startswith('VmHWM')][0]/1024
+
+    return elapsed, peak, resampled
+
+
+def main():
+
+    PARSER = argparse.ArgumentParser()
+
+    PARSER.add_argument('--size', '-s', nargs=3, type=int, default=[512, 512, 300],
+                        help=('Size of the synthetic CT. Default is 512 512 300.'))
+    PARSER.add_argument('--spacing', nargs=3, type=float, default=[0.8, 0.8, 1.5],
+                        help=('Spacing of the synthetic CT. Default is 0.8 0.8 1.5.'))
+    PARSER.add_argument('--new-spacing', nargs=3, type=float, default=[1.0, 1.0, 1.0],
+                        help=('Spacing used for the resampling. Default is 1 1 1.'))
+    PARSER.add_argument('--ext', type=str, default='.nii.gz',
+                        help=('File extension of the synthetic CT (.nii.gz, .nii or '
+                              '.nrrd). Default is .nii.gz.'))
+    PARSER.add_argument('--num-threads', '-nt', type=int, default=0,
+                        help=('Number of threads used by SimpleITK. Default is 0, which '
+                              'means all the available cores.'))
+
+    ARGS = PARSER.parse_args()
+
+    outdir = tempfile.mkdtemp()
+    image = os.path.join(outdir, 'ct'+ARGS.ext)
+    ct = np.random.randint(-1024, 2000, ARGS.size).astype(np.int16)
+    if ARGS.ext == '.nrrd':
+        nrrd.write(image, ct, header={
+            'space': 'left-posterior-superior', 'space origin': [0., 0., 0.],
+            'space directions': np.diag(ARGS.spacing)})
+    else:
+        nib.save(nib.Nifti1Image(ct, np.diag(ARGS.spacing+[1])), image)
+    del ct
+
+    results = {}
+    try:
+        for method in ['skimage', 'SimpleITK']:
+            # one new (not forked) process per method, so the peak RSS are
+            # independent
+            with ProcessPoolExecutor(
+                    max_workers=1,
+                    mp_context=multiprocessing.get_context('spawn')) as executor:
+                results[method] = executor.submit(
+                    run, method, image, ARGS.new_spacing, outdir,
+                    ARGS.num_threads).result()
+    finally:
+        shutil.rmtree(outdir)
+
+    reference = results['skimage'][2]
+    resampled = results['SimpleITK'][2]
+    print('Image size: {0}, resampled size: {1}, voxels different: {2:.4f}%'.format(
+        ARGS.size, resampled.shape,
+        np.mean(reference != resampled)*100 if reference.shape == resampled.shape
+        else 100))
+    for method, (elapsed, peak, _) in results.items():
+        print('{0:>10}: time {1:.2f} s, peak RSS {2:.0f} MB'.format(
+            method, elapsed, peak))
+    print('Speed-up: {:.1f}x'.format(results['skimage'][0]/results['SimpleITK'][0]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"Export of the lung segmentation folds to frozen graphs, with equivalence check and benchmark"
+import os
+import argparse
+import shutil
+import tempfile
+import numpy as np
+from radiants.utils.model_cache import MODEL_CACHE
+from radiants.utils.frozen_graph import (
+    FrozenGraphModel, export_frozen_graph, frozen_graph_path, compare_models)
+
+
+def random_weights(out_file, input_size=(96, 96, 1), seed=42):
+    """Function to save the weights of a randomly initialised network, whose
+    batch normalizations have random statistics (with negative scales too),
+    so that every folding case of fold_batchnorm is used.
+    """
+    rng = np.random.RandomState(seed)
+    kwargs = {} if input_size == (96, 96, 1) else {'input_size': input_size}
+    model = MODEL_CACHE.model(**kwargs)
+    for layer in model.layers:
+        if layer.__class__.__name__ == 'BatchNormalization':
+            shapes = [w.shape for w in layer.get_weights()]
+            layer.set_weights([rng.uniform(-1.5, 1.5, shapes[0]),
+                               rng.normal(0, 0.5, shapes[1]),
+                               rng.normal(0, 0.5, shapes[2]),
+                               rng.uniform(0.5, 2, shapes[3])])
+    model.save_weights(out_file)
+
+    return out_file
+
+
+def main():
+
+    PARSER = argparse.ArgumentParser()
+
+    PARSER.add_argument('--weights', '-w', nargs='+', type=str, default=None,
+                        help=('Network weights (one file per fold) to export.'))
+    PARSER.add_argument('--random-check', action='store_true',
+                        help=('Whether or not to export and check a randomly initialised '
+                              'network (with random batch normalization statistics) '
+                              'instead of trained weights, to verify the export on this '
+                              'TensorFlow version. Default is False.'))
+    PARSER.add_argument('--outdir', type=str, default=None,
+                        help=('Folder where to save the frozen graphs. Default is None, '
+                              'which means next to the weights.'))
+    PARSER.add_argument('--tile-size', type=int, default=96,
+                        help=('Size of the patches fed to the network. Default is 96.'))
+    PARSER.add_argument('--tensor', type=str, default=None,
+                        help=('Tensor (.npy file created by the lung preprocessing) '
+                              'used to compare and benchmark the models. Default is None, '
+                              'which means random patches.'))
+    PARSER.add_argument('--n-patches', type=int, default=512,
+                        help=('Number of patches used to compare and benchmark the '
+                              'models. Default is 512.'))
+    PARSER.add_argument('--batch-size', '-bs', type=int, default=32,
+                        help=('Number of patches fed to the network at once. '
+                              'Default is 32.'))
+    PARSER.add_argument('--tolerance', type=float, default=1e-4,
+                        help=('Maximum absolute difference allowed between the Keras '
+                              'and frozen graph predictions. Default is 1e-4.'))
+
+    ARGS = PARSER.parse_args()
+
+    input_size = (ARGS.tile_size, ARGS.tile_size, 1)
+    tmp_dir = None
+    if ARGS.random_check:
+        tmp_dir = tempfile.mkdtemp()
+        ARGS.weights = [random_weights(os.path.join(tmp_dir, 'random.h5'),
+                                       input_size)]
+    elif ARGS.weights is None:
+        raise Exception('Either --weights or --random-check must be given!')
+    kwargs = {} if ARGS.tile_size == 96 else {'input_size': input_size}
+    if ARGS.tensor is not None:
+        patches = np.load(ARGS.tensor, mmap_mode='r')[:ARGS.n_patches]
+        patches = np.asarray(patches, dtype=np.float32)
+    else:
+        patches = np.random.uniform(
+            0, 1, (ARGS.n_patches,)+input_size).astype(np.float32)
+
+    failed = []
+    for weight in ARGS.weights:
+        model = MODEL_CACHE.load(weight, **kwargs)
+        graph_file = export_frozen_graph(
+            model, frozen_graph_path(weight, input_size, outdir=(
+                tmp_dir if ARGS.random_check else ARGS.outdir)), input_size)
+        frozen = FrozenGraphModel(graph_file)
+        results = compare_models(model, frozen, patches,
+                                 batch_size=ARGS.batch_size)
+        frozen.close()
+        print('{0}: max abs difference {1:.2e}, Dice {2:.4f}, {3:.1f} -> {4:.1f} '
+              'patches/s.'.format(graph_file, results['max_abs_diff'],
+                                  results['dice'], results['reference_speed'],
+                                  results['speed']))
+        if results['max_abs_diff'] > ARGS.tolerance:
+            failed.append(weight)
+    if tmp_dir is not None:
+        shutil.rmtree(tmp_dir)
+    if failed:
+        raise Exception('The frozen graphs of {} are not equivalent to the Keras '
+                        'models!'.format(failed))
+    print('All the frozen graphs are equivalent to the Keras models.')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"Int8 quantization of the lung segmentation folds, validated against the float models"
+import os
+import argparse
+import numpy as np
+from radiants.utils.model_cache import MODEL_CACHE
+from radiants.utils.quantization import sample_patches, quantized_model_path
+from radiants.utils.frozen_graph import frozen_graph_path
+
+
+def main():
+
+    PARSER = argparse.ArgumentParser()
+
+    PARSER.add_argument('--weights', '-w', nargs='+', type=str, required=True,
+                        help=('Network weights (one file per fold) to quantize.'))
+    PARSER.add_argument('--tensors', '-t', nargs='+', type=str, required=True,
+                        help=('Tensors (.npy files created by the lung preprocessing) '
+                              'from which the calibration and held-out patches are '
+                              'sampled.'))
+    PARSER.add_argument('--n-patches', type=int, default=1024,
+                        help=('Total number of patches sampled from the tensors. 3/4 '
+                              'are used for the calibration and 1/4 for the validation. '
+                              'Default is 1024.'))
+    PARSER.add_argument('--threshold', type=float, default=0.98,
+                        help=('Minimum Dice coefficient between the int8 and float '
+                              'predictions of the held-out patches for the int8 model '
+                              'to be used. Default is 0.98.'))
+    PARSER.add_argument('--outdir', type=str, default=None,
+                        help=('Folder where to save the frozen graphs and the int8 '
+                              'models. Default is None, which means next to the weights.'))
+    PARSER.add_argument('--tile-size', type=int, default=96,
+                        help=('Size of the patches fed to the network. Default is 96.'))
+
+    ARGS = PARSER.parse_args()
+
+    if ARGS.outdir is not None and not os.path.isdir(ARGS.outdir):
+        os.makedirs(ARGS.outdir)
+    input_size = (ARGS.tile_size, ARGS.tile_size, 1)
+    kwargs = {} if ARGS.tile_size == 96 else {'input_size': input_size}
+    per_tensor = int(np.ceil(ARGS.n_patches/float(len(ARGS.tensors))))
+    patches = np.concatenate([sample_patches(t, per_tensor) for t in ARGS.tensors])
+    # the held-out patches (the first ones) must come from all the tensors
+    patches = patches[np.random.RandomState(42).permutation(patches.shape[0])]
+    print('{} patches sampled for calibration and validation.'.format(
+        patches.shape[0]))
+
+    refused = []
+    for weight in ARGS.weights:
+        model = MODEL_CACHE.load_quantized(weight, patches, outdir=ARGS.outdir,
+                                           threshold=ARGS.threshold, **kwargs)
+        model_file = quantized_model_path(
+            frozen_graph_path(weight, input_size, outdir=ARGS.outdir))
+        if model is MODEL_CACHE.load_frozen(weight, outdir=ARGS.outdir, **kwargs):
+            refused.append(weight)
+        else:
+            print('{} will be used for int8 inference.'.format(model_file))
+    if refused:
+        print('The int8 models of {} were refused, the float models will be '
+              'used for them.'.format(refused))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 "Script to run brain extraction using HD-BET"
-from radiants.workflows.bet import BETWorkflow
+import os
+from radiants.workflows.bet import BETWorkflow, BETCohort
 from core.utils.config import cmdline_input_config, create_subject_list
 
 
@@ -7,6 +8,37 @@ if __name__ == "__main__":
 
     PARSER = cmdline_input_config()
 
+    PARSER.add_argument('--fold-parallel', action='store_true',
+                        help=('Whether or not to evaluate the members of the HD-BET '
+                              'ensemble in parallel on CPU, one process per member, each '
+                              'with its own cores. Default is False.'))
+    PARSER.add_argument('--batch', action='store_true',
+                        help=('Whether or not to extract the brain of all the images of '
+                              'each subject with one HD-BET run, which loads the network '
+                              'parameters once, instead of one run per image. Default is '
+                              'False.'))
+    PARSER.add_argument('--cohort', action='store_true',
+                        help=('Whether or not to extract the brain of all the images of '
+                              'all the subjects with one HD-BET run. Default is False.'))
+    PARSER.add_argument('--cohort-cores', type=int, default=0,
+                        help=('Number of cores used to run the cohort workflow in parallel. '
+                              'Default is 0, which means the workflow will run linearly.'))
+
+    PARSER.add_argument('--propagate-mask', action='store_true',
+                        help=('Whether or not to run HD-BET only on the reference sequence '
+                              'of each session (T1KM or T1) and to extract the brain of '
+                              'the other sequences with its mask, after a rigid '
+                              'registration to the reference. Default is False.'))
+    PARSER.add_argument('--check-propagation', action='store_true',
+                        help=('Whether or not to run HD-BET also on the sequences whose '
+                              'mask is propagated, in order to compare the two masks. '
+                              'The HD-BET outputs are used when the Dice coefficient is '
+                              'below --dice-threshold. It requires --propagate-mask. '
+                              'Default is False.'))
+    PARSER.add_argument('--dice-threshold', type=float, default=0.9,
+                        help=('Minimum Dice coefficient between propagated and HD-BET '
+                              'masks used by --check-propagation. Default is 0.9.'))
+
     ARGS = PARSER.parse_args()
 
     BASE_DIR = ARGS.input_dir
@@ -15,17 +47,31 @@ if __name__ == "__main__":
                                              ARGS.cluster_source,
                                              subjects_to_process=[])
 
+    subjects = []
     for sub_id in sub_list:
 
         print('Processing subject {}'.format(sub_id))
 
         workflow = BETWorkflow(
+            fold_parallel=ARGS.fold_parallel, batch=ARGS.batch, cohort=ARGS.cohort,
+            propagate_mask=ARGS.propagate_mask,
+            check_propagation=ARGS.check_propagation,
+            dice_threshold=ARGS.dice_threshold,
             sub_id=sub_id, input_dir=BASE_DIR, work_dir=ARGS.work_dir,
             local_source=ARGS.local_source, local_sink=ARGS.local_sink,
             local_project_id=ARGS.local_project_id,
             local_basedir=ARGS.local_dir)
 
         wf = workflow.workflow_setup()
-        workflow.runner(wf)
+        if ARGS.cohort:
+            subjects.append((workflow, wf))
+        else:
+            workflow.runner(wf)
+
+    if ARGS.cohort and subjects:
+        print('Extracting the brain of {} subjects together'.format(len(subjects)))
+        cohort = BETCohort(subjects, os.path.join(ARGS.work_dir, 'cohort_cache'),
+                           cores=ARGS.cohort_cores, fold_parallel=ARGS.fold_parallel)
+        cohort.runner(cohort.workflow())
 
     print('Done!')
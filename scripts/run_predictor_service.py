@@ -0,0 +1,28 @@
+"Start the predictor service used by the nnU-Net and HD-GLIO interfaces"
+import os
+import argparse
+from radiants.utils.predictor_service import PredictorService, SOCKET_ENV
+
+
+def main():
+
+    PARSER = argparse.ArgumentParser()
+
+    PARSER.add_argument('--socket', '-s', type=str, default=os.environ.get(SOCKET_ENV),
+                        help=('Unix socket the service listens on. The interfaces use '
+                              'it if it is given to them or exported as {}. Default is '
+                              'the value of that variable.'.format(SOCKET_ENV)))
+    PARSER.add_argument('--max-models', type=int, default=4,
+                        help=('Maximum number of models (with the checkpoints of all '
+                              'their folds) kept in memory. Default is 4.'))
+
+    ARGS = PARSER.parse_args()
+
+    if ARGS.socket is None:
+        raise Exception('Please provide the socket with --socket or {}!'.format(
+            SOCKET_ENV))
+    PredictorService(os.path.abspath(ARGS.socket), ARGS.max_models).serve()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
-from radiants.workflows.segmentation import TumorSegmentation
+import os
+from radiants.workflows.segmentation import TumorSegmentation, TumorSegmentationCohort
 from core.utils.config import cmdline_input_config, create_subject_list
 
 
@@ -13,6 +14,41 @@ if __name__ == "__main__":
     PARSER.add_argument('--normalize', '-n', action='store_true',
                         help=('Whether or not to normalize the segmented tumors to the '
                               '"reference" and/or "T10" images, if present.'))
+    PARSER.add_argument('--predictor-socket', type=str, default=None,
+                        help=('Unix socket of a running predictor service (see '
+                              'run_predictor_service.py). If provided, the nnUNet and '
+                              'HD-GLIO segmentations are run by the service, which keeps '
+                              'the models in memory, instead of one process per image. '
+                              'Default is None.'))
+    PARSER.add_argument('--preprocessing-cache', type=str, default=None,
+                        help=('Folder where the nnUNet preprocessing of each session is '
+                              'cached. The GTV and tumor models are always run on the '
+                              'same preprocessed case when their plans match; with this '
+                              'folder the cache is kept also between runs. Default is '
+                              'None, which means the cache is kept only in the nipype '
+                              'working directory.'))
+    PARSER.add_argument('--crop-to-brain', action='store_true',
+                        help=('Whether or not to crop the images to the brain mask computed '
+                              'by the brain extraction (plus a margin) before the '
+                              'segmentation. The networks only process the cropped images '
+                              'and the segmentations are pasted back into the original '
+                              'space. Cannot be used with --cohort. Default is False.'))
+    PARSER.add_argument('--crop-margin', type=float, default=10.0,
+                        help=('Margin (in mm) added around the brain bounding box. '
+                              'Default is 10.'))
+    PARSER.add_argument('--fold-parallel', action='store_true',
+                        help=('Whether or not to evaluate the members of the nnUNet '
+                              'ensemble in parallel on CPU, one process per member, each '
+                              'with its own cores. Default is False.'))
+    PARSER.add_argument('--cohort', action='store_true',
+                        help=('Whether or not to run each nnUNet model once for all the '
+                              'subjects, instead of once per session. The T1KM/FLAIR pairs '
+                              'of all the sessions are predicted together, so the model is '
+                              'loaded once and the preprocessing of the next case overlaps '
+                              'with the prediction of the current one. Default is False.'))
+    PARSER.add_argument('--cohort-cores', type=int, default=0,
+                        help=('Number of cores used to run the cohort workflow in parallel. '
+                              'Default is 0, which means the workflow will run linearly.'))
 
     ARGS = PARSER.parse_args()
 
@@ -22,18 +58,34 @@ if __name__ == "__main__":
                                              ARGS.cluster_source,
                                              subjects_to_process=[])
 
+    subjects = []
     for sub_id in sub_list:
 
         print('Processing subject {}'.format(sub_id))
 
         workflow = TumorSegmentation(
             ARGS.gtv_seg_model_dir, ARGS.tumor_seg_model_dir, normalize=ARGS.normalize,
+            predictor_socket=ARGS.predictor_socket, cohort=ARGS.cohort,
+            preprocessing_cache=ARGS.preprocessing_cache,
+            crop_to_brain=ARGS.crop_to_brain, crop_margin=ARGS.crop_margin,
+            fold_parallel=ARGS.fold_parallel,
             sub_id=sub_id, input_dir=BASE_DIR, work_dir=ARGS.work_dir,
             local_source=ARGS.local_source, local_sink=ARGS.local_sink,
             local_project_id=ARGS.local_project_id,
             local_basedir=ARGS.local_dir)
 
         wf = workflow.workflow_setup(check_dependencies=True)
-        workflow.runner(wf)
+        if ARGS.cohort:
+            subjects.append((workflow, wf))
+        else:
+            workflow.runner(wf)
+
+    if ARGS.cohort and subjects:
+        print('Segmenting {} subjects together'.format(len(subjects)))
+        cohort = TumorSegmentationCohort(
+            subjects, ARGS.gtv_seg_model_dir, ARGS.tumor_seg_model_dir,
+            os.path.join(ARGS.work_dir, 'cohort_cache'), cores=ARGS.cohort_cores,
+            predictor_socket=ARGS.predictor_socket, fold_parallel=ARGS.fold_parallel)
+        cohort.runner(cohort.workflow())
 
     print('Done!')
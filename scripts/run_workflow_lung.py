@@ -1,5 +1,7 @@
 import argparse
-from radiants.workflows.lung_segmentation import LungSegmentation
+import os
+from radiants.workflows.lung_segmentation import (
+    LungSegmentation, LungSegmentationCohort)
 from radiants.utils.config import create_subject_list
 
 
@@ -15,6 +17,70 @@ def main():
                         help=('Path to the CNN weights to be used for the inference '
                               ' More than one weight can be used, in that case the median '
                               'prediction will be returned.'))
+    PARSER.add_argument('--tensor-on-disk', '-tod', action='store_true',
+                        help=('Whether or not to pass the network input tensor between '
+                              'the preprocessing and the inference nodes as a memory-mapped '
+                              '.npy file instead of storing it in the nipype results. '
+                              'Recommended for high resolution images. Default is False.'))
+    PARSER.add_argument('--no-resampled', action='store_true',
+                        help=('Do not save the resampled image, only the tensor will be '
+                              'created. Default is False.'))
+    PARSER.add_argument('--skip-background', '-sb', action='store_true',
+                        help=('Whether or not to skip the network inference for the '
+                              'patches outside the body, which will be labelled as '
+                              'background. Default is False.'))
+    PARSER.add_argument('--stream-slabs', action='store_true',
+                        help=('Whether or not to create the tensors reading the resampled '
+                              'images from disk a few slices at a time, instead of keeping '
+                              'the whole resampled images in memory. Default is False.'))
+    PARSER.add_argument('--streaming-inference', action='store_true',
+                        help=('Whether or not to segment, reconstruct and save the images '
+                              'a few slices at a time, instead of keeping the whole '
+                              'prediction in memory. Default is False.'))
+    PARSER.add_argument('--min-overlap', type=int, default=None,
+                        help=('If provided, each slice is tiled with the smallest grid of '
+                              'patches covering it with at least this overlap (in voxels). '
+                              'Default is None, which means the original tiling.'))
+    PARSER.add_argument('--tile-size', type=int, default=96,
+                        help=('Size of the patches fed to the network. It must be a '
+                              'multiple of 16. Default is 96.'))
+    PARSER.add_argument('--coarse-spacing', nargs=3, type=float, default=None,
+                        help=('If provided, the lungs are first segmented on the image '
+                              'resampled to this spacing, then only their bounding box is '
+                              'segmented at full resolution. Not available in cohort mode. '
+                              'Default is None (single-pass segmentation).'))
+    PARSER.add_argument('--cascade-margin', type=float, default=10.0,
+                        help=('Margin, in mm, added around the lung bounding box found '
+                              'by the coarse segmentation. Default is 10.'))
+    PARSER.add_argument('--cohort', action='store_true',
+                        help=('Whether or not to run the CNN inference once for all the '
+                              'subjects, instead of once per subject. The patches of all '
+                              'the images are predicted together in large batches and each '
+                              'network weight is loaded only once. Default is False.'))
+    PARSER.add_argument('--batch-size', '-bs', type=int, default=None,
+                        help=('Number of patches fed to the network at once in cohort mode. '
+                              'If given, it is used even if a profile tuned for this host '
+                              '(see tune_lung_inference.py) exists. Default is None, which '
+                              'means the tuned batch size or, without profile, 128.'))
+    PARSER.add_argument('--adaptive-tolerance', '-at', type=float, default=0.0,
+                        help=('If greater than 0, each patch is only fed to the remaining '
+                              'folds while the mean absolute difference between the last '
+                              'fold prediction and the running mean is above this value '
+                              '(a patch is always predicted by at least 2 folds). Default '
+                              'is 0, which means all the folds predict all the patches.'))
+    PARSER.add_argument('--engine', choices=['keras', 'frozen_graph', 'int8'],
+                        default='keras',
+                        help=('Runner used for the network inference. "frozen_graph" exports '
+                              'each fold, with the batch normalizations folded, to a frozen '
+                              'TensorFlow graph saved next to the weights and runs it without '
+                              'Keras. "int8" also quantizes the graphs (see '
+                              'quantize_lung_model.py) and uses them only if they agree with '
+                              'the float ones and are faster. Default is keras.'))
+    PARSER.add_argument('--parallel-workers', type=int, default=None,
+                        help=('Number of inference nodes running at the same time, used to '
+                              'choose the profile tuned for this host (see the --workers '
+                              'option of tune_lung_inference.py). Default is None, which '
+                              'means the number of cores (or of images, if smaller).'))
     PARSER.add_argument('--num-cores', '-nc', type=int, default=0,
                         help=('Number of cores to use to run the workflow '
                               'in parallel. Default is 0, which means the workflow '
@@ -26,16 +92,39 @@ def main():
 
     sub_list, BASE_DIR = create_subject_list(BASE_DIR, subjects_to_process=[])
 
+    subjects = []
     for sub_id in sub_list:
 
         print('Processing subject {}'.format(sub_id))
 
         workflow_st = LungSegmentation(
             sub_id=sub_id, input_dir=BASE_DIR, work_dir=ARGS.work_dir,
-            network_weights=ARGS.weights, cores=ARGS.num_cores)
+            network_weights=ARGS.weights, cores=ARGS.num_cores,
+            tensor_on_disk=ARGS.tensor_on_disk,
+            save_resampled=not ARGS.no_resampled,
+            skip_background=ARGS.skip_background, cohort=ARGS.cohort,
+            coarse_spacing=ARGS.coarse_spacing,
+            cascade_margin=ARGS.cascade_margin,
+            adaptive_tolerance=ARGS.adaptive_tolerance,
+            stream_slabs=ARGS.stream_slabs,
+            streaming_inference=ARGS.streaming_inference,
+            min_overlap=ARGS.min_overlap, tile_size=ARGS.tile_size,
+            engine=ARGS.engine, parallel_workers=ARGS.parallel_workers)
 
         wf = workflow_st.workflow_setup(check_dependencies=True)
-        workflow_st.runner(wf)
+        if ARGS.cohort:
+            subjects.append((workflow_st, wf))
+        else:
+            workflow_st.runner(wf)
+
+    if ARGS.cohort and subjects:
+        print('Segmenting {} subjects together'.format(len(subjects)))
+        cohort = LungSegmentationCohort(
+            subjects, ARGS.weights, os.path.join(ARGS.work_dir, 'cohort_cache'),
+            cores=ARGS.num_cores, batch_size=ARGS.batch_size,
+            adaptive_tolerance=ARGS.adaptive_tolerance,
+            streaming_inference=ARGS.streaming_inference, engine=ARGS.engine)
+        cohort.runner(cohort.workflow())
 
     print('Done!')
 
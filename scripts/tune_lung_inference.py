@@ -0,0 +1,72 @@
+"Tuning of the batch size and TensorFlow threads of the lung inference on this host"
+import argparse
+from radiants.utils.model_cache import MODEL_CACHE
+from radiants.utils.autotune import (
+    benchmark, thread_grid, save_profile)
+
+
+def main():
+
+    PARSER = argparse.ArgumentParser()
+
+    PARSER.add_argument('--weights', '-w', type=str, required=True,
+                        help=('Network weights of one fold. All the folds have the same '
+                              'architecture, so one is enough.'))
+    PARSER.add_argument('--engine', choices=['keras', 'frozen_graph', 'int8'],
+                        default='keras',
+                        help=('Runner to tune (see run_workflow_lung.py). Default is '
+                              'keras.'))
+    PARSER.add_argument('--tile-size', type=int, default=96,
+                        help=('Size of the patches fed to the network. Default is 96.'))
+    PARSER.add_argument('--batch-sizes', nargs='+', type=int,
+                        default=[8, 16, 32, 64, 128, 256],
+                        help=('Batch sizes to test. Default is 8 16 32 64 128 256.'))
+    PARSER.add_argument('--intra-op-threads', nargs='+', type=int, default=None,
+                        help=('Numbers of intra-op threads to test. Default is None, '
+                              'which means the powers of 2 up to the available cores.'))
+    PARSER.add_argument('--inter-op-threads', nargs='+', type=int, default=[1, 2],
+                        help=('Numbers of inter-op threads to test. Default is 1 2.'))
+    PARSER.add_argument('--workers', type=int, default=1,
+                        help=('Number of inference nodes that will run at the same time '
+                              'on this host (e.g. nipype processes). The cores available '
+                              'to each of them are divided accordingly. Default is 1.'))
+    PARSER.add_argument('--n-patches', type=int, default=512,
+                        help=('Number of synthetic patches predicted for each '
+                              'configuration. Default is 512.'))
+    PARSER.add_argument('--profile-dir', type=str, default=None,
+                        help=('Folder where to save the profile. Default is None, which '
+                              'means $RADIANTS_PROFILE_DIR or ~/.radiants.'))
+
+    ARGS = PARSER.parse_args()
+
+    input_size = (ARGS.tile_size, ARGS.tile_size, 1)
+    kwargs = {} if ARGS.tile_size == 96 else {'input_size': input_size}
+
+    def not_quantized():
+        # synthetic patches cannot be used to calibrate the int8 model
+        raise Exception('The int8 model of {} must be created with '
+                        'quantize_lung_model.py first!'.format(ARGS.weights))
+
+    def load_model():
+        if ARGS.engine == 'frozen_graph':
+            return MODEL_CACHE.load_frozen(ARGS.weights, **kwargs)
+        elif ARGS.engine == 'int8':
+            return MODEL_CACHE.load_quantized(ARGS.weights, not_quantized,
+                                              **kwargs)
+        return MODEL_CACHE.load(ARGS.weights, **kwargs)
+
+    threads = thread_grid(ARGS.workers, ARGS.intra_op_threads,
+                          ARGS.inter_op_threads)
+    results = benchmark(load_model, ARGS.batch_sizes, threads, input_size,
+                        ARGS.n_patches)
+    path = save_profile(results, ARGS.engine, input_size[:2], ARGS.workers,
+                        ARGS.profile_dir)
+    best = max(results, key=lambda x: x['patches_per_second'])
+    print('Best configuration: batch size {0}, {1} intra-op and {2} inter-op '
+          'threads, {3:.1f} patches/s. Profile saved in {4}.'.format(
+              best['batch_size'], best['intra_op_threads'],
+              best['inter_op_threads'], best['patches_per_second'], path))
+
+
+if __name__ == "__main__":
+    main()
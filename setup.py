@@ -4,7 +4,7 @@ setup(name='radiants',
       version='1.0',
       description='Radiomics analysis for Radiotherpy studies',
       url='https://github.com/TransRadOnc-HIT/RADIANTS.git',
-      python_requires='>=3.5',
+      python_requires='>=3.7',
       author='Francesco Sforazzini',
       author_email='f.sforazzini@dkfz.de',
       license='Apache 2.0',
@@ -15,7 +15,7 @@ setup(name='radiants',
       'nibabel',
       'pandas',
       'pydicom',
-      'pynrrd',
+      'pynrrd>=1.0.0,<1.2',
       'scikit-image',
       'opencv-python',
       'requests',
@@ -26,7 +26,7 @@ setup(name='radiants',
       'hd-bet',
       'nnunet',
       'h5py==2.10.0',
-      'tensorflow==1.13.1',
+      'tensorflow==1.15.5',
       'keras==2.2.4'],
       dependency_links=['git+https://github.com/TransRadOnc-HIT/core.git#egg=core',
                         'git+https://github.com/MIC-DKFZ/HD-BET#egg=hd-bet',